@@ -1,101 +1,3376 @@
-import os, csv, time, logging, traceback, random
-import concurrent.futures, queue, threading
+import os, sys, csv, time, logging, traceback, random, argparse, getpass
+import concurrent.futures, queue, threading, urllib.parse, collections, asyncio, sqlite3, zlib, shutil
+import bisect, contextlib, http.server, logging.handlers, atexit
+
+if os.name == 'nt':
+	import msvcrt
+else:
+	import fcntl
 import PySimpleGUI as sg
 import pandas as pd
+import numpy as np
 import ujson as json
 
-from openpyxl import load_workbook
+from openpyxl import load_workbook, Workbook
 from linkedin_api import Linkedin
+from linkedin_api.client import ChallengeException
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# map profile keys to CRM-compatible column names
+COLUMN_MAP = {
+	'firstName': 'First name',
+	'lastName': 'Last name',
+	'profile_id': 'Linkedin profile ID',
+	'headline': 'Linkedin headline',
+	'summary': 'Linkedin summary',
+	'industryName': 'Industry',
+	'geoCountryName': 'Location',
+	'languages': 'Languages',
+	'birthdate': 'Birthday',
+	'email_address': 'Email address',
+	'phone_numbers': 'Phone number'
+}
+
+# optional columns, added after the default ones
+EXTRA_COLUMNS = {
+	'experience': 'Experience',
+	'education': 'Education',
+	'skills': 'Skills',
+	'url': 'Linkedin URL',
+	'fetched': 'Last fetched'
+}
+
+# keys read from get_profile_contact_info responses: the rest come from get_profile
+CONTACT_KEYS = {'birthdate', 'email_address', 'phone_numbers'}
+
+# columns with few distinct values: stored as categoricals in bulk output
+CATEGORICAL_COLUMNS = {COLUMN_MAP['industryName'], COLUMN_MAP['geoCountryName']}
+
+
+def format_value(value):
+	if value is None:
+		return ''
+	elif isinstance(value, (list, tuple)):
+		return ', '.join(format_value(item) for item in value)
+	elif isinstance(value, dict):
+		return ', '.join(f'{key}: {format_value(val)}' for key, val in value.items())
+
+	return value
+
+
+def format_names(items):
+	'''
+	Languages and skills: a list of dictionaries with a name
+	'''
+	return ', '.join(item['name'] for item in items if 'name' in item)
+
+
+def format_phone_numbers(items):
+	return ', '.join(f'{item["number"]} ({item["type"]})' for item in items if 'number' in item)
+
+
+def format_birthdate(birthdate):
+	day_month = f'{birthdate.get("day", "")}.{birthdate.get("month", "")}.'
+	return f'{day_month}{birthdate["year"]}' if 'year' in birthdate else day_month
+
+
+def format_experience(items):
+	return '; '.join(
+		' @ '.join(part for part in (item.get('title'), item.get('companyName')) if part)
+		for item in items)
+
+
+def format_education(items):
+	return '; '.join(
+		', '.join(part for part in (item.get('schoolName'), item.get('degreeName'), item.get('fieldOfStudy')) if part)
+		for item in items)
+
+
+class FieldMapper:
+	'''
+	FieldMapper turns raw get_profile and get_profile_contact_info responses
+	into flat rows keyed by column name. The field list is compiled once, and
+	the responses are never modified.
+	'''
+	# keys that need more than a plain copy
+	formatters = {
+		'languages': format_names,
+		'skills': format_names,
+		'phone_numbers': format_phone_numbers,
+		'birthdate': format_birthdate,
+		'experience': format_experience,
+		'education': format_education
+	}
+
+	def __init__(self, extra_columns=(), only=None):
+		'''
+		The default columns and extra_columns, or only the columns whose keys
+		are in only: the profile ID is always kept, as duplicates are found by it
+		'''
+		all_columns = {**COLUMN_MAP, **EXTRA_COLUMNS}
+		if only is None:
+			keys = list(COLUMN_MAP)
+		else:
+			keys = [key for key in all_columns if key in only or key == 'profile_id']
+
+		keys += [key for key in extra_columns if key not in keys]
+
+		self.fields = []
+		for key in keys:
+			source = 'contact' if key in CONTACT_KEYS else 'profile'
+			self.fields.append((all_columns[key], source, key, self.formatters.get(key, format_value)))
+
+		self.columns = [field[0] for field in self.fields]
+
+		# without contact columns, the contact info request can be left out
+		self.needs_contact_info = any(field[1] == 'contact' for field in self.fields)
+
+		# get_profile has no skills: they take a request of their own
+		self.needs_skills = 'skills' in keys
+
+
+	def row(self, profile, contact_info, public_id=None):
+		'''
+		Map one profile into a row: missing keys become empty strings, as do
+		contact columns if contact_info wasn't fetched
+		'''
+		sources = {'profile': profile, 'contact': {} if contact_info is None else contact_info}
+		row = {}
+		for column, source, key, formatter in self.fields:
+			if key == 'url':
+				profile_public_id = profile.get('public_id', public_id)
+				row[column] = f'https://www.linkedin.com/in/{profile_public_id}' if profile_public_id else ''
+				continue
+
+			if key == 'fetched':
+				row[column] = time.strftime('%Y-%m-%d %H:%M:%S')
+				continue
+
+			value = sources[source].get(key)
+			if value is None:
+				row[column] = ''
+				continue
+
+			try:
+				row[column] = formatter(value)
+			except Exception as error:
+				logging.exception(f'Error formatting {key}: {error}')
+				row[column] = ''
+
+		return row
+
+
+	def rows(self, responses):
+		'''
+		Map an iterable of (profile, contact_info) or (profile, contact_info,
+		public_id) tuples, one row at a time
+		'''
+		for response in responses:
+			yield self.row(*response)
+
+
+def parse_profile_url(profile_url):
+	'''
+	Strip query parameters and trailing slashes from a profile URL, and
+	return the public profile ID at the end of it.
+	'''
+	profile_url = profile_url.strip().split('?')[0]
+	if profile_url.endswith('/'):
+		profile_url = profile_url[0:-1]
+
+	return profile_url.split('/')[-1] if '/' in profile_url else profile_url
+
+
+def normalise_public_id(public_id):
+	'''
+	Public IDs are case-insensitive and may arrive URL-encoded
+	'''
+	return urllib.parse.unquote(public_id).strip().lower()
+
+
+def atomic_write(path, text):
+	'''
+	Write a file through a temporary file and a rename, so readers and
+	crashes never see a half-written file
+	'''
+	tmp_path = f'{path}.tmp'
+	with open(tmp_path, 'w') as tmp_file:
+		tmp_file.write(text)
+		tmp_file.flush()
+		os.fsync(tmp_file.fileno())
+
+	os.replace(tmp_path, path)
+
+
+class FileLock:
+	'''
+	Cross-process exclusive lock on a lock file, used as a context manager
+	'''
+	def __init__(self, lock_path):
+		self.lock_path = lock_path
+		self.file = None
+
+
+	def __enter__(self):
+		self.file = open(self.lock_path, 'a+')
+		self.file.seek(0)
+		if os.name == 'nt':
+			msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+		else:
+			fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+
+		return self
+
+
+	def __exit__(self, exc_type, exc_value, exc_traceback):
+		if os.name == 'nt':
+			self.file.seek(0)
+			msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+		else:
+			fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+		self.file.close()
+		self.file = None
+
+
+def is_challenge(error):
+	'''
+	Linkedin wants the account to solve a sign-in challenge before continuing
+	'''
+	return isinstance(error, ChallengeException) or 'CHALLENGE' in error.args
+
+
+def check_profile(profile_id, profile):
+	'''
+	linkedin_api returns an empty profile when the request is refused or the
+	profile doesn't exist
+	'''
+	if not profile:
+		raise Exception(f'Empty response for profile {profile_id}')
+
+
+def is_transient(error):
+	'''
+	Errors worth retrying: dropped connections, timeouts, rate limiting and
+	server errors. A throttled or failed request has no JSON body, so it shows
+	up as a ValueError when linkedin_api decodes the response.
+	'''
+	if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+		return True
+
+	if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+		return error.response.status_code == 429 or error.response.status_code >= 500
+
+	return isinstance(error, ValueError)
+
+
+def count_csv_records(csv_path, chunk_size=1024 * 1024):
+	'''
+	Count the records in a csv file, header included, without the csv parser:
+	newlines are counted in binary chunks, except those inside quoted fields
+	'''
+	records, quoted, last = 0, 0, b'\n'
+	with open(csv_path, 'rb') as csv_file:
+		while True:
+			chunk = csv_file.read(chunk_size)
+			if len(chunk) == 0:
+				break
+
+			if quoted == 0 and b'"' not in chunk:
+				records += chunk.count(b'\n')
+			else:
+				# an escaped quote is two quotes, so the parity still tells if we're in a field
+				data = np.frombuffer(chunk, dtype=np.uint8)
+				parity = (np.cumsum(data == ord('"')) + quoted) % 2
+				records += int(np.count_nonzero((data == ord('\n')) & (parity == 0)))
+				quoted = int(parity[-1])
+
+			last = chunk[-1:]
+
+	# the last record may not end in a newline
+	return records if last == b'\n' else records + 1
+
+
+def csv_shard_path(csv_path, shard):
+	'''
+	The file name of a csv output's nth shard: the first is the output itself
+	'''
+	if shard == 0:
+		return csv_path
+
+	root, extension = os.path.splitext(csv_path)
+	return f'{root}.{shard}{extension}'
+
+
+def csv_shards(csv_path):
+	'''
+	Shard files of a csv output, in write order: the output itself, then
+	any shards it was rotated to
+	'''
+	shards = [csv_path]
+	while os.path.isfile(csv_shard_path(csv_path, len(shards))):
+		shards.append(csv_shard_path(csv_path, len(shards)))
+
+	return shards
+
+
+def excel_sheet_names(sheet_path):
+	book = load_workbook(sheet_path, read_only=True)
+	names = book.sheetnames
+	book.close()
+	return names
+
+
+def count_excel_rows(sheet):
+	'''
+	Count the rows of a read-only worksheet, header included: use the
+	dimensions stored in the workbook, and only stream the rows if there are none
+	'''
+	if sheet.max_row is not None and sheet.max_row > 1:
+		return sheet.max_row
+
+	return sum(1 for row in sheet.iter_rows(values_only=True))
+
+
+def percentile(values, percent):
+	'''
+	Nearest-rank percentile of a sorted list
+	'''
+	if len(values) == 0:
+		return 0
+
+	return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class RateLimiter:
+	'''
+	Sliding-window rate limiter enforcing several windows at once, e.g. a
+	per-minute burst limit alongside hourly and daily limits. Each window keeps
+	a time-ordered deque of admitted calls, so admitting a call and expiring
+	old ones are both amortised O(1).
+	'''
+	def __init__(self, windows):
+		# windows: a list of (length in seconds, call limit) tuples
+		self.windows = [(length, limit) for length, limit in windows if limit is not None]
+		self.calls = [collections.deque() for window in self.windows]
+		self.condition = threading.Condition()
+
+		# once closed, calls that would have to wait are refused instead
+		self.closed = False
+
+
+	def seed(self, timestamps):
+		'''
+		Load previously made calls, e.g. from stored history
+		'''
+		now = time.time()
+		with self.condition:
+			for timestamp in sorted(timestamps):
+				for (length, limit), calls in zip(self.windows, self.calls):
+					if now - timestamp < length:
+						calls.append(timestamp)
+
+
+	def expire(self, now):
+		for (length, limit), calls in zip(self.windows, self.calls):
+			while len(calls) > 0 and now - calls[0] >= length:
+				calls.popleft()
+
+
+	def next_slot(self, now=None):
+		'''
+		Seconds until a call can be admitted: 0 if one can be made right away
+		'''
+		now = time.time() if now is None else now
+		with self.condition:
+			self.expire(now)
+			wait = 0
+			for (length, limit), calls in zip(self.windows, self.calls):
+				if len(calls) >= limit:
+					# the slot opens once enough of the oldest calls have left the window
+					wait = max(wait, calls[len(calls) - limit] + length - now)
+
+			return wait
+
+
+	def headroom(self):
+		'''
+		Calls that can still be made before the tightest window is full
+		'''
+		with self.condition:
+			self.expire(time.time())
+			return min(
+				(limit - len(calls) for (length, limit), calls in zip(self.windows, self.calls)),
+				default=float('inf'))
+
+
+	def try_acquire(self):
+		'''
+		Admit a call if there is room in every window. Returns the time stamp
+		of the admitted call, or None.
+		'''
+		with self.condition:
+			now = time.time()
+			if self.next_slot(now) > 0:
+				return None
+
+			for calls in self.calls:
+				calls.append(now)
+
+			return now
+
+
+	def acquire(self, timeout=None):
+		'''
+		Block until a call is admitted, or until timeout seconds have passed
+		'''
+		deadline = None if timeout is None else time.time() + timeout
+		with self.condition:
+			while True:
+				admitted = self.try_acquire()
+				if admitted is not None or self.closed:
+					return admitted
+
+				wait = self.next_slot()
+				if deadline is not None:
+					if time.time() + wait > deadline:
+						return None
+
+				self.condition.wait(wait)
+
+
+	def close(self):
+		'''
+		Refuse calls waiting for a slot, and any that would have to wait
+		'''
+		with self.condition:
+			self.closed = True
+			self.condition.notify_all()
+
+
+class RetryPolicy:
+	'''
+	Exponential backoff with full jitter: retry n waits a random time of up
+	to base_delay * 2^n seconds, capped at max_delay. Only transient errors
+	are retried.
+	'''
+	def __init__(self, attempts=4, base_delay=2, max_delay=120):
+		self.attempts = attempts
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+
+
+	def delay(self, attempt):
+		return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+	def should_retry(self, error, attempt):
+		return attempt < self.attempts and is_transient(error)
+
+
+	def call(self, function, *args, attempt=0):
+		'''
+		Call function, retrying transient errors. attempt is the number of
+		tries already made: if it's not zero, back off before the first call.
+		'''
+		while True:
+			if attempt > 0:
+				time.sleep(self.delay(attempt - 1))
+
+			try:
+				return function(*args)
+			except Exception as error:
+				if not self.should_retry(error, attempt):
+					raise
+
+				logging.warning(f'Retrying {getattr(function, "__name__", function)} after error: {error}')
+				attempt += 1
+
+
+class CircuitBreaker:
+	'''
+	CircuitBreaker pauses every fetch once LinkedIn starts refusing requests.
+	After `threshold` consecutive failures it opens for `cooldown` seconds,
+	then lets requests through again: another failure reopens it with twice
+	the cooldown, up to max_cooldown, and a success closes it.
+	'''
+	def __init__(self, threshold=5, cooldown=60, max_cooldown=3600, label='all fetches'):
+		self.threshold = threshold
+		self.label = label
+		self.base_cooldown = cooldown
+		self.max_cooldown = max_cooldown
+
+		self.cooldown = cooldown
+		self.failures = 0
+		self.open_until = 0
+		self.lock = threading.Lock()
+
+
+	def remaining(self):
+		'''
+		Seconds until the breaker lets requests through: 0 if it's closed
+		'''
+		return max(self.open_until - time.time(), 0)
+
+
+	def wait(self):
+		while self.remaining() > 0:
+			time.sleep(min(self.remaining(), 1))
+
+
+	def record_success(self):
+		with self.lock:
+			self.failures = 0
+			self.cooldown = self.base_cooldown
+
+
+	def record_failure(self):
+		with self.lock:
+			self.failures += 1
+			if self.failures >= self.threshold:
+				self.open()
+
+
+	def trip(self):
+		'''
+		Open the breaker straight away: the account can't continue as it is
+		'''
+		with self.lock:
+			self.failures = max(self.failures, self.threshold)
+			self.open()
+
+
+	def open(self):
+		'''
+		Called with the lock held: requests already waiting extend the same pause
+		'''
+		if self.remaining() > 0:
+			return
+
+		self.open_until = time.time() + self.cooldown
+		print(f'⏸ LinkedIn is refusing requests: pausing {self.label} for {self.cooldown:.0f} seconds')
+		logging.warning(f'Circuit breaker open for {self.cooldown} s after {self.failures} failures')
+		self.cooldown = min(2 * self.cooldown, self.max_cooldown)
+
+
+class DeadLetter:
+	'''
+	DeadLetter records the profiles that could not be fetched as profile URLs,
+	one per line with the reason in a comment line above, so the file can be
+	fed straight back to `liscrape.py batch`.
+	'''
+	def __init__(self, dead_letter_path='liscrape-dead-letter.txt'):
+		self.dead_letter_path = dead_letter_path
+		self.lock = threading.Lock()
+
+
+	def add(self, profile_id, reason):
+		if profile_id is None:
+			return
+
+		# keep the reason on its comment line
+		reason = ' '.join(str(reason).split())
+		with self.lock:
+			with open(self.dead_letter_path, 'a') as dead_letter_file:
+				dead_letter_file.write(f'# {time.strftime("%Y-%m-%d %H:%M:%S")} {reason}\n')
+				dead_letter_file.write(f'https://www.linkedin.com/in/{profile_id}\n')
+
+		logging.info(f'Profile {profile_id} added to {self.dead_letter_path}: {reason}')
+
+
+	def take(self):
+		'''
+		Move the recorded profiles aside to retry them, so new failures start a
+		fresh file. Returns the path of the moved file, or None if it's empty.
+		'''
+		retry_path = f'{self.dead_letter_path}.retry'
+		with self.lock:
+			if os.path.isfile(self.dead_letter_path):
+				# an interrupted retry left profiles behind: retry those too
+				with open(self.dead_letter_path, 'r') as dead_letter_file, open(retry_path, 'a') as retry_file:
+					retry_file.write(dead_letter_file.read())
+
+				os.remove(self.dead_letter_path)
+
+		return retry_path if os.path.isfile(retry_path) else None
+
+
+class JsonLineFormatter(logging.Formatter):
+	'''
+	Format a log record as one JSON object per line, with any traceback as a
+	field of its own
+	'''
+	def format(self, record):
+		entry = {
+			'time': self.formatTime(record, '%Y-%m-%d %H:%M:%S'),
+			'level': record.levelname,
+			'thread': record.threadName,
+			'message': record.getMessage()
+		}
+
+		if record.exc_info:
+			entry['exception'] = self.formatException(record.exc_info)
+
+		return json.dumps(entry, ensure_ascii=False)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+	'''
+	Hand records to the log listener thread through a bounded queue. When
+	the listener falls behind, records are dropped and counted instead of
+	blocking the thread that logs.
+	'''
+	def __init__(self, log_queue):
+		super().__init__(log_queue)
+		self.dropped = 0
+
+
+	def enqueue(self, record):
+		try:
+			self.queue.put_nowait(record)
+		except queue.Full:
+			self.dropped += 1
+
+
+class LogListener(logging.handlers.QueueListener):
+	'''
+	Write queued log records from a thread of its own
+	'''
+	def enqueue_sentinel(self):
+		# the queue may be full: wait for room rather than fail to stop
+		self.queue.put(self._sentinel)
+
+
+class Config:
+	'''
+	Config loads config.json once and keeps it in memory. Changes are written
+	back after a short delay, so a burst of changes costs a single write, and
+	every write is atomic and done under a file lock.
+	'''
+	def __init__(self, config_path='config.json', save_delay=1.0):
+		self.config_path = config_path
+		self.lock_path = f'{config_path}.lock'
+		self.save_delay = save_delay
+
+		self.config = {'users': {}, 'theme': None}
+		self.legacy_history = {}
+		self.timer = None
+		self.lock = threading.Lock()
+
+
+	def load(self):
+		if not os.path.isfile(self.config_path):
+			return
+
+		with FileLock(self.lock_path):
+			try:
+				with open(self.config_path, 'r') as config_file:
+					config = json.load(config_file)
+			except Exception as error:
+				logging.exception(error)
+				os.remove(self.config_path)
+				return
+
+		# history used to live in config.json: hand it over to History, then drop it
+		self.legacy_history = config.pop('history', {})
+		self.config['users'] = config.get('users', {})
+		self.config['theme'] = config.get('theme')
+		if len(self.legacy_history) > 0:
+			self.save()
+
+
+	def save(self):
+		'''
+		Schedule a write, unless one is already pending
+		'''
+		with self.lock:
+			if self.timer is None:
+				self.timer = threading.Timer(self.save_delay, self.flush)
+				self.timer.daemon = True
+				self.timer.start()
+
+
+	def flush(self):
+		'''
+		Write pending changes now
+		'''
+		with self.lock:
+			if self.timer is None:
+				return
+
+			self.timer.cancel()
+			self.timer = None
+			text = json.dumps(self.config, indent=4)
+
+		with FileLock(self.lock_path):
+			atomic_write(self.config_path, text)
+
+
+	def users(self):
+		return tuple(self.config['users'].keys())
+
+
+	def password(self, username):
+		return self.config['users'][username]
+
+
+	def store_login(self, username, password):
+		self.config['users'][username] = password
+		self.save()
+
+
+	def theme(self):
+		return self.config['theme'] if self.config['theme'] is not None else 'SystemDefault'
+
+
+	def set_theme(self, theme):
+		self.config['theme'] = theme
+		self.save()
+
+
+	def clear(self):
+		'''
+		Reset everything except stored logins
+		'''
+		self.config['theme'] = None
+		self.save()
+
+
+class History:
+	'''
+	History class loads, stores, and enforces a simple API call-limit to prevent
+	users from getting themselves banned by spamming Linkedin's API.
+	'''
+	def __init__(self, session):
+		self.parent_session = session
+		self.burst_limit = 10
+		self.hourly_limit = 90
+		self.daily_limit = 500
+		self.history = {}
+		self.history_path = 'liscrape-history.json'
+		self.limiters = {}
+		self.closed = False
+
+		# fetch workers record calls while the writer stores history
+		self.lock = threading.RLock()
+
+
+	def create_limiter(self):
+		return RateLimiter([
+			(60, self.burst_limit),
+			(3600, self.hourly_limit),
+			(86400, self.daily_limit)
+		])
+
+
+	@staticmethod
+	def entry_account(val):
+		'''
+		History entries are [profile ID, account]: older entries are a bare profile ID
+		'''
+		return val[1] if isinstance(val, list) else None
+
+
+	def limiter_for(self, username):
+		'''
+		Every account has its own quota windows, seeded from stored history.
+		Entries without an account count towards every account's quota.
+		'''
+		with self.lock:
+			if username not in self.limiters:
+				limiter = self.create_limiter()
+				limiter.seed(
+					float(key) for key, val in self.history.items()
+					if self.entry_account(val) in (None, username))
+
+				limiter.closed = self.closed
+				self.limiters[username] = limiter
+
+			return self.limiters[username]
+
+
+	def stop_waiting(self):
+		'''
+		Make calls that would wait for a slot fail instead: used when the
+		program closes, so it doesn't linger until the quota frees up
+		'''
+		with self.lock:
+			self.closed = True
+			for limiter in self.limiters.values():
+				limiter.close()
+
+
+	@property
+	def limiter(self):
+		return self.limiter_for(self.parent_session.username)
+
+
+	def load(self):
+		'''
+		Load history from its own file, or from an older configuration file
+		'''
+		if not os.path.isfile(self.history_path):
+			# move history out of an older config.json before it is rewritten without it
+			self.history = {float(key): val for key, val in self.parent_session.config.legacy_history.items()}
+			if len(self.history) > 0:
+				self.store()
+
+			return self.history
+
+		with open(self.history_path, 'r') as history_file:
+			try:
+				# stored compactly as a list of [time stamp, profile ID, account]
+				return {entry[0]: [entry[1], entry[2]] for entry in json.load(history_file)}
+			except Exception as error:
+				logging.exception(error)
+				os.remove(self.history_path)
+				return {}
+
+
+	def store(self):
+		'''
+		Store history into its own file
+		'''
+		# calls older than the longest window no longer count towards any limit
+		longest_window = max(length for length, limit in self.limiter.windows) if len(self.limiter.windows) > 0 else 0
+		with self.lock:
+			self.history = {
+				key: val for key, val in self.history.items()
+				if time.time() - float(key) < longest_window
+			}
+
+			entries = [
+				[float(key), val[0], val[1]] if isinstance(val, list) else [float(key), val, None]
+				for key, val in self.history.items()
+			]
+
+		with FileLock(f'{self.history_path}.lock'):
+			atomic_write(self.history_path, json.dumps(entries))
+
+
+	def add(self, user_id, ignore_duplicates):
+		'''
+		Add a stored user profile into the duplicate index
+		'''
+		not_added = self.parent_session.index.add_profile_id(user_id)
+		return not_added if not ignore_duplicates else True
+
+
+	def acquire(self, profile_id, blocking=True, username=None):
+		'''
+		Record an API call for profile_id, with the current unix time stamp. If
+		blocking, wait for a slot in the quota instead of failing. The call counts
+		towards the quota of username, or of the signed-in account.
+		'''
+		if self.parent_session.debug:
+			return True
+
+		username = self.parent_session.username if username is None else username
+		limiter = self.limiter_for(username)
+		admitted = limiter.acquire() if blocking else limiter.try_acquire()
+		if admitted is None:
+			return False
+
+		with self.lock:
+			self.history[admitted] = [profile_id, username]
+
+		self.parent_session.journal.append({'type': 'call', 'time': admitted, 'profile': profile_id, 'account': username})
+		return True
+
+
+	def restore(self, timestamp, profile_id, username):
+		'''
+		Restore a call replayed from the journal, unless it is already in history
+		'''
+		with self.lock:
+			if timestamp in self.history:
+				return
+
+			self.history[timestamp] = [profile_id, username]
+
+			# limiters are re-seeded from history when next used
+			self.limiters = {}
+
+
+	def check_validity(self):
+		'''
+		Checks if we have API calls left in our quota. Returns a tuple of
+		(valid, time until the next slot opens).
+		'''
+		if self.parent_session.debug:
+			return True, None
+
+		wait = self.limiter.next_slot()
+		if wait > 0:
+			return False, f'{int(wait / 60)} minutes' if wait >= 60 else f'{int(wait) + 1} seconds'
+
+		return True, None
+
+
+class Journal:
+	'''
+	Journal is an append-only JSON lines write-ahead log of every API call and
+	every fetched profile. Each record is flushed to the OS as it is written
+	and fsynced in batches. On startup the journal is replayed into the sheet
+	and history; a checkpoint persists both and empties the journal.
+	'''
+	def __init__(self, journal_path='liscrape-journal.jsonl', sync_every=50, sync_interval=5, checkpoint_size=16 * 1024 * 1024):
+		self.journal_path = journal_path
+		self.sync_every = sync_every
+		self.sync_interval = sync_interval
+		self.checkpoint_size = checkpoint_size
+
+		self.file = None
+		self.size = 0
+		self.unsynced = 0
+		self.last_sync = time.time()
+		self.lock = threading.Lock()
+
+
+	def open(self):
+		self.file = open(self.journal_path, 'a')
+		self.size = self.file.tell()
+
+
+	def append(self, record):
+		with self.lock:
+			if self.file is None:
+				self.open()
+
+			line = json.dumps(record) + '\n'
+			self.file.write(line)
+			self.file.flush()
+
+			self.size += len(line)
+			self.unsynced += 1
+			if self.unsynced >= self.sync_every or time.time() - self.last_sync >= self.sync_interval:
+				self.sync()
+
+
+	def sync(self):
+		'''
+		Force journalled records to disk: called with the lock held
+		'''
+		if self.file is not None and self.unsynced > 0:
+			os.fsync(self.file.fileno())
+
+		self.unsynced = 0
+		self.last_sync = time.time()
+
+
+	def replay(self):
+		'''
+		Yield every journalled record. A torn last line from a crash is skipped.
+		'''
+		if not os.path.isfile(self.journal_path):
+			return
+
+		with open(self.journal_path, 'r') as journal_file:
+			for line in journal_file:
+				try:
+					yield json.loads(line)
+				except ValueError:
+					logging.warning(f'Skipping malformed journal record: {line[0:80]}')
+
+
+	def needs_checkpoint(self):
+		return self.size >= self.checkpoint_size
+
+
+	def checkpoint(self, persist):
+		'''
+		Call persist to store everything the journal holds, then empty it
+		'''
+		with self.lock:
+			persist()
+
+			if self.file is not None:
+				self.file.close()
+				self.file = None
+
+			open(self.journal_path, 'w').close()
+			self.size = 0
+			self.unsynced = 0
+
+
+	def close(self):
+		with self.lock:
+			if self.file is not None:
+				self.sync()
+				self.file.close()
+				self.file = None
+
+
+class ResponseCache:
+	'''
+	ResponseCache keeps raw get_profile and get_profile_contact_info responses
+	in a SQLite file, keyed by public profile ID and stored as compressed JSON.
+	Entries expire after ttl seconds, and the least recently used ones are
+	evicted once the cache grows past max_bytes.
+	'''
+	def __init__(self, cache_path='liscrape-cache.sqlite', ttl=30 * 86400, max_bytes=256 * 1024 * 1024):
+		self.cache_path = cache_path
+		self.ttl = ttl
+		self.max_bytes = max_bytes
+		self.connection = None
+		self.total_bytes = 0
+		self.lock = threading.Lock()
+
+
+	def open(self):
+		self.connection = sqlite3.connect(self.cache_path, check_same_thread=False)
+		self.connection.execute('''
+			CREATE TABLE IF NOT EXISTS responses (
+				public_id TEXT PRIMARY KEY, response BLOB,
+				fetched REAL, accessed REAL, size INTEGER)''')
+		self.connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+		self.connection.commit()
+
+		self.total_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+
+	def cursor(self):
+		'''
+		Open the cache on first use: called with the lock held
+		'''
+		if self.connection is None:
+			self.open()
+
+		return self.connection
+
+
+	def get(self, public_id):
+		'''
+		Return a cached (profile, contact_info) tuple, or None
+		'''
+		public_id = normalise_public_id(public_id)
+		with self.lock:
+			connection = self.cursor()
+			row = connection.execute(
+				'SELECT response, fetched FROM responses WHERE public_id = ?', (public_id,)).fetchone()
+
+			if row is None:
+				return None
+
+			if time.time() - row[1] > self.ttl:
+				self.delete(public_id)
+				return None
+
+			connection.execute('UPDATE responses SET accessed = ? WHERE public_id = ?', (time.time(), public_id))
+			connection.commit()
+
+		response = json.loads(zlib.decompress(row[0]))
+		return response['profile'], response['contact_info']
+
+
+	def put(self, public_id, profile, contact_info):
+		public_id = normalise_public_id(public_id)
+		blob = zlib.compress(json.dumps({'profile': profile, 'contact_info': contact_info}).encode('utf-8'))
+
+		with self.lock:
+			connection = self.cursor()
+			self.delete(public_id)
+			connection.execute(
+				'INSERT INTO responses VALUES (?, ?, ?, ?, ?)',
+				(public_id, blob, time.time(), time.time(), len(blob)))
+
+			self.total_bytes += len(blob)
+			self.evict()
+			connection.commit()
+
+
+	def delete(self, public_id):
+		'''
+		Remove an entry: called with the lock held
+		'''
+		row = self.connection.execute('SELECT size FROM responses WHERE public_id = ?', (public_id,)).fetchone()
+		if row is not None:
+			self.connection.execute('DELETE FROM responses WHERE public_id = ?', (public_id,))
+			self.total_bytes -= row[0]
+
+
+	def evict(self):
+		'''
+		Drop the least recently used entries until under the size cap: called
+		with the lock held
+		'''
+		while self.total_bytes > self.max_bytes:
+			rows = self.connection.execute(
+				'SELECT public_id, size FROM responses ORDER BY accessed LIMIT 64').fetchall()
+
+			if len(rows) == 0:
+				break
+
+			for public_id, size in rows:
+				self.connection.execute('DELETE FROM responses WHERE public_id = ?', (public_id,))
+				self.total_bytes -= size
+				if self.total_bytes <= self.max_bytes:
+					break
+
+
+	def entries(self):
+		'''
+		Yield (public_id, profile, contact_info) for every unexpired entry
+		'''
+		with self.lock:
+			connection = self.cursor()
+			rows = connection.execute(
+				'SELECT public_id, response FROM responses WHERE fetched >= ? ORDER BY fetched',
+				(time.time() - self.ttl,))
+
+			# sqlite3 cursors stream rows, but fetch in chunks to release the lock in between
+			chunk = rows.fetchmany(256)
+
+		while len(chunk) > 0:
+			for public_id, blob in chunk:
+				response = json.loads(zlib.decompress(blob))
+				yield public_id, response['profile'], response['contact_info']
+
+			with self.lock:
+				chunk = rows.fetchmany(256)
+
+
+	def close(self):
+		with self.lock:
+			if self.connection is not None:
+				self.connection.close()
+				self.connection = None
+
+
+class ProfileIndex:
+	'''
+	ProfileIndex keeps hashed sets of stored profile IDs and public IDs, so
+	duplicates can be detected in constant time before any API call is made.
+	The index is seeded from the output sheet, and persisted along with the
+	sheet's size and modification time so an unchanged sheet isn't re-read.
+	'''
+	def __init__(self, index_path='liscrape-index.json'):
+		self.index_path = index_path
+		self.profile_ids = set()
+		self.public_ids = {}
+		self.sheet_signature = None
+		self.sheet_length = None
+
+
+	def load(self):
+		if not os.path.isfile(self.index_path):
+			return
+
+		with open(self.index_path, 'r') as index_file:
+			try:
+				index = json.load(index_file)
+				self.profile_ids = set(index['profile_ids'])
+				self.public_ids = index['public_ids']
+				self.sheet_signature = index['sheet_signature']
+				self.sheet_length = index.get('sheet_length')
+			except Exception as error:
+				logging.exception(error)
+				os.remove(self.index_path)
+
+
+	def store(self, sheet_path=None, sheet_length=None):
+		'''
+		Store the index, recording the state and length of the sheet it matches
+		'''
+		if sheet_path is not None and os.path.exists(sheet_path):
+			self.sheet_signature = self.signature(sheet_path)
+			self.sheet_length = sheet_length
+
+		index = {
+			'profile_ids': list(self.profile_ids),
+			'public_ids': self.public_ids,
+			'sheet_signature': self.sheet_signature,
+			'sheet_length': self.sheet_length
+		}
+		atomic_write(self.index_path, json.dumps(index))
+
+
+	@staticmethod
+	def signature(sheet_path):
+		stat = os.stat(sheet_path)
+		signature = [os.path.abspath(sheet_path), stat.st_size, stat.st_mtime]
+
+		# a sharded csv grows in its last shard
+		if '.csv' in sheet_path:
+			for shard_path in csv_shards(sheet_path)[1:]:
+				stat = os.stat(shard_path)
+				signature += [stat.st_size, stat.st_mtime]
+
+		return signature
+
+
+	def cached_length(self, sheet_path):
+		'''
+		The sheet's stored length, if the sheet is unchanged since: else None
+		'''
+		if self.sheet_length is None or self.signature(sheet_path) != self.sheet_signature:
+			return None
+
+		return self.sheet_length
+
+
+	def seed_from_sheet(self, sheet_path, sheet_type, sink=None):
+		'''
+		Add the profile IDs already in the output sheet, unless the sheet is
+		unchanged since the index was last stored. Public IDs are added from
+		the URL column, if the sheet has one.
+		'''
+		if not os.path.exists(sheet_path):
+			# a new sheet: nothing stored in it yet
+			self.profile_ids = set()
+			self.public_ids = {}
+			self.sheet_signature = None
+			self.sheet_length = None
+			return
+
+		signature = self.signature(sheet_path)
+		if signature == self.sheet_signature:
+			logging.info(f'Sheet {sheet_path} unchanged: using stored profile index')
+			return
+
+		# rebuild from scratch: the sheet may be a different file, or edited by hand
+		self.profile_ids = set()
+		self.sheet_length = None
+		column, url_column = COLUMN_MAP['profile_id'], EXTRA_COLUMNS['url']
+		urls = []
+		if sheet_type == 'csv':
+			for shard_path in csv_shards(sheet_path):
+				with open(shard_path, 'r', newline='') as csv_file:
+					for row in csv.DictReader(csv_file):
+						if row.get(column):
+							self.profile_ids.add(row[column])
+							urls.append((row[column], row.get(url_column)))
+		elif sheet_type == 'excel':
+			book = load_workbook(sheet_path, read_only=True)
+			rows = book.worksheets[0].iter_rows(values_only=True)
+			header = next(rows, ())
+			if column in header:
+				column_index = header.index(column)
+				url_index = header.index(url_column) if url_column in header else None
+				for row in rows:
+					if len(row) > column_index and row[column_index] not in (None, ''):
+						self.profile_ids.add(str(row[column_index]))
+						if url_index is not None and len(row) > url_index:
+							urls.append((str(row[column_index]), row[url_index]))
+
+			book.close()
+		elif sheet_type == 'sqlite':
+			self.profile_ids.update(sink.profile_ids())
+			urls = sink.profile_urls()
+		elif sheet_type == 'parquet':
+			import pyarrow.parquet
+			for part in parquet_parts(sheet_path):
+				columns = [column, url_column] if url_column in pyarrow.parquet.read_schema(part).names else [column]
+				frame = pd.read_parquet(part, columns=columns)
+				ids = [str(profile_id) for profile_id in frame[column] if profile_id not in (None, '')]
+				self.profile_ids.update(ids)
+				if url_column in columns:
+					urls.extend(zip(frame[column].astype(str), frame[url_column]))
+
+		# forget public IDs whose rows are no longer in the sheet
+		self.public_ids = {
+			public_id: profile_id for public_id, profile_id in self.public_ids.items()
+			if profile_id in self.profile_ids
+		}
+
+		# the URL ends in the public ID: a pasted URL is caught before any API call
+		for profile_id, url in urls:
+			if isinstance(url, str) and url.strip() != '':
+				self.add_public_id(parse_profile_url(url), profile_id)
+
+		self.sheet_signature = signature
+		logging.info(f'Profile index seeded from {sheet_path}: {len(self.profile_ids)} profiles')
+
+
+	def contains_public_id(self, public_id):
+		return normalise_public_id(public_id) in self.public_ids
+
+
+	def contains_profile_id(self, profile_id):
+		return profile_id in self.profile_ids
+
+
+	def add_public_id(self, public_id, profile_id):
+		self.public_ids[normalise_public_id(public_id)] = profile_id
+
+
+	def add_profile_id(self, profile_id):
+		'''
+		Add a profile ID: returns False if it was already indexed
+		'''
+		if profile_id in self.profile_ids:
+			return False
+
+		self.profile_ids.add(profile_id)
+		return True
+
+
+class Account:
+	'''
+	A signed-in Linkedin account: each has its own client and cookie jar
+	'''
+	def __init__(self, username, application):
+		self.username = username
+		self.application = application
+		self.active = True
+
+
+class AccountPool:
+	'''
+	AccountPool spreads API calls across several signed-in accounts. Every
+	profile is routed to the account with the most quota headroom, and an
+	account that runs into a sign-in challenge is taken out of rotation.
+	'''
+	def __init__(self, session):
+		self.session = session
+		self.accounts = []
+		self.lock = threading.Lock()
+
+
+	def sign_in(self, usernames, refresh_cookies=False):
+		'''
+		Sign in every stored login in usernames: returns the number signed in
+		'''
+		for username in usernames:
+			try:
+				password = self.session.load_password_from_config(username)
+				application = Linkedin(username, password, debug=True, refresh_cookies=refresh_cookies)
+			except Exception as error:
+				logging.exception(f'Error signing in {username}: {error}')
+				print(f'⛔️ Could not sign in {username}: {"sign-in challenge" if is_challenge(error) else error}')
+				continue
+
+			self.accounts.append(Account(username, application))
+			print(f'Signed in as {username}')
+
+		return len(self.accounts)
+
+
+	def active_accounts(self):
+		return [account for account in self.accounts if account.active]
+
+
+	def try_acquire(self, profile_id):
+		'''
+		Record a call on the active account with the most headroom. Returns
+		the account, or None if every account's quota is used up.
+		'''
+		with self.lock:
+			accounts = sorted(
+				self.active_accounts(),
+				key=lambda account: self.session.history.limiter_for(account.username).headroom(),
+				reverse=True)
+
+			for account in accounts:
+				if self.session.history.acquire(profile_id, blocking=False, username=account.username):
+					return account
+
+			return None
+
+
+	def next_slot(self):
+		'''
+		Seconds until any active account has a free slot
+		'''
+		return min(
+			(self.session.history.limiter_for(account.username).next_slot() for account in self.active_accounts()),
+			default=0)
+
+
+	def acquire(self, profile_id):
+		'''
+		Block until an account has a free slot: returns None once no accounts are left
+		'''
+		while len(self.active_accounts()) > 0:
+			account = self.try_acquire(profile_id)
+			if account is not None:
+				return account
+
+			time.sleep(max(self.next_slot(), 0.01))
+
+		return None
+
+
+	def retire(self, account):
+		if account.active:
+			account.active = False
+			print(f'⛔️ {account.username} hit a sign-in challenge: removed from rotation')
+			logging.warning(f'Account {account.username} removed from rotation after a challenge')
+
+
+class ExcelSink:
+	'''
+	ExcelSink buffers stored profiles in memory and appends them to the workbook
+	in batches. The workbook is loaded once and kept open, and every flush is
+	written to a temporary file which then replaces the sheet, so a crash
+	mid-write never leaves a half-written workbook behind.
+	'''
+	def __init__(self, sheet_path, columns, batch_size=25, flush_interval=30):
+		self.sheet_path = sheet_path
+		self.columns = list(columns)
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+
+		self.buffer = []
+		self.first_buffered = None
+		self.book = None
+		self.sheet = None
+		self.row_count = 0
+		self.lock = threading.Lock()
+
+
+	def open(self):
+		'''
+		Load the workbook, or create a new one with a header row
+		'''
+		if os.path.isfile(self.sheet_path):
+			self.book = load_workbook(self.sheet_path)
+			self.sheet = self.book.worksheets[0]
+
+			# follow the existing column order, adding any new columns at the end
+			header = [cell.value for cell in self.sheet[1]]
+			for column in self.columns:
+				if column not in header:
+					self.sheet.cell(row=1, column=len(header) + 1, value=column)
+					header.append(column)
+
+			self.columns = header
+		else:
+			self.book = Workbook()
+			self.sheet = self.book.active
+			self.sheet.title = 'Sheet1'
+			self.sheet.append(self.columns)
+
+		# worksheet.max_row scans every cell, so it's only read once here
+		self.row_count = self.sheet.max_row
+
+
+	def flush_threshold(self):
+		'''
+		Each flush rewrites the whole file, so the batch grows with the sheet:
+		this keeps the save cost per contact roughly flat. Loading the workbook
+		is not amortised: it is paid once per session, and grows with the sheet.
+		'''
+		return max(self.batch_size, self.row_count // 100)
+
+
+	def add(self, profile_dict):
+		'''
+		Buffer a profile, flushing if the batch is full or has waited too long
+		'''
+		with self.lock:
+			if self.book is None:
+				self.open()
+
+			self.buffer.append([profile_dict.get(column, '') for column in self.columns])
+			if self.first_buffered is None:
+				self.first_buffered = time.time()
+
+			if len(self.buffer) >= self.flush_threshold() or self.due():
+				self.write_buffer()
+
+
+	def due(self):
+		if self.first_buffered is None:
+			return False
+
+		return time.time() - self.first_buffered >= self.flush_interval
+
+
+	def flush_if_due(self):
+		with self.lock:
+			if self.due():
+				self.write_buffer()
+
+
+	def flush(self):
+		with self.lock:
+			self.write_buffer()
+
+
+	def write_buffer(self):
+		'''
+		Append buffered rows and write the workbook once: called with the lock held
+		'''
+		if len(self.buffer) == 0:
+			return
+
+		for row in self.buffer:
+			self.sheet.append(row)
+
+		tmp_path = f'{self.sheet_path}.tmp'
+		try:
+			self.book.save(tmp_path)
+			os.replace(tmp_path, self.sheet_path)
+		except Exception as error:
+			logging.exception(f'Error writing batch to {self.sheet_path}: {error}')
+			logging.info(traceback.format_exc())
+
+			# drop the appended rows from the in-memory sheet, keep them buffered
+			self.sheet.delete_rows(self.row_count + 1, len(self.buffer))
+			return
+
+		logging.info(f'Wrote batch of {len(self.buffer)} profiles to {self.sheet_path}')
+		self.row_count += len(self.buffer)
+		self.buffer = []
+		self.first_buffered = None
+
+
+	def close(self):
+		self.flush()
+
+
+class CsvSink:
+	'''
+	CsvSink keeps the csv file open and appends profiles through one writer.
+	Rows go to a sized write buffer that is flushed once batch_size rows or
+	flush_interval seconds have passed, and on close. Given max_bytes, rows
+	go to a new shard file (contacts.1.csv, contacts.2.csv...) once a flush
+	leaves the current shard past that size.
+	'''
+	def __init__(self, sheet_path, columns, batch_size=500, flush_interval=5, max_bytes=None, buffer_size=256 * 1024):
+		self.sheet_path = sheet_path
+		self.columns = list(columns)
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.max_bytes = max_bytes
+		self.buffer_size = buffer_size
+
+		self.field_names = None
+		self.shard_path = None
+		self.file = None
+		self.writer = None
+		self.unflushed = 0
+		self.first_buffered = None
+		self.lock = threading.Lock()
+
+
+	def header(self):
+		'''
+		Follow the existing file's columns: a csv can't gain columns without a rewrite
+		'''
+		if os.path.isfile(self.sheet_path):
+			with open(self.sheet_path, 'r', newline='') as csv_file:
+				header = next(csv.reader(csv_file), None)
+
+			if header is not None:
+				missing = [column for column in self.columns if column not in header]
+				if len(missing) > 0:
+					print(f'⚠️ {self.sheet_path} has no columns for {", ".join(missing)}: they are left out')
+
+				return header
+
+		return self.columns
+
+
+	def open(self):
+		'''
+		Open the last shard for appending, or a new one if it's full, and
+		write the header to a new file: called with the lock held
+		'''
+		# the header is read once: every shard has the first one's columns
+		if self.field_names is None:
+			self.field_names = self.header()
+
+		shards = csv_shards(self.sheet_path)
+		shard_path = shards[-1]
+		if self.max_bytes is not None and os.path.isfile(shard_path) and os.path.getsize(shard_path) >= self.max_bytes:
+			shard_path = csv_shard_path(self.sheet_path, len(shards))
+
+		new_file = not os.path.isfile(shard_path) or os.path.getsize(shard_path) == 0
+		self.file = open(shard_path, 'a', newline='', buffering=self.buffer_size)
+		self.writer = csv.DictWriter(self.file, fieldnames=self.field_names, extrasaction='ignore')
+		self.shard_path = shard_path
+
+		if new_file:
+			self.writer.writeheader()
+			print(f'Created file: {shard_path}')
+
+
+	def add(self, profile_dict):
+		with self.lock:
+			if self.file is None:
+				self.open()
+
+			self.writer.writerow(profile_dict)
+			self.unflushed += 1
+			if self.first_buffered is None:
+				self.first_buffered = time.time()
+
+			if self.unflushed >= self.batch_size or self.due():
+				self.write_buffer()
+
+
+	def due(self):
+		return self.first_buffered is not None and time.time() - self.first_buffered >= self.flush_interval
+
+
+	def flush_if_due(self):
+		with self.lock:
+			if self.due():
+				self.write_buffer()
+
+
+	def flush(self):
+		with self.lock:
+			self.write_buffer()
+
+
+	def write_buffer(self):
+		'''
+		Flush the buffered rows to disk, and rotate to a new shard if this one
+		is full: called with the lock held
+		'''
+		if self.file is None:
+			return
+
+		try:
+			self.file.flush()
+		except Exception as error:
+			logging.exception(f'Error writing batch to {self.shard_path}: {error}')
+			logging.info(traceback.format_exc())
+			return
+
+		logging.info(f'Wrote batch of {self.unflushed} profiles to {self.shard_path}')
+		self.unflushed = 0
+		self.first_buffered = None
+
+		# the next row opens a new shard
+		if self.max_bytes is not None and os.path.getsize(self.shard_path) >= self.max_bytes:
+			self.file.close()
+			self.file = None
+
+
+	def close(self):
+		with self.lock:
+			self.write_buffer()
+			if self.file is not None:
+				self.file.close()
+				self.file = None
+
+
+class SqliteSink:
+	'''
+	SqliteSink stores profiles in a SQLite table keyed by profile ID: storing
+	a profile again updates its row instead of adding a duplicate, and the
+	row count is kept up to date by triggers so reading it is O(1). Writes are
+	committed in batches, by row count and by elapsed time.
+	'''
+	def __init__(self, sheet_path, columns, batch_size=100, flush_interval=5):
+		self.sheet_path = sheet_path
+		self.columns = list(columns)
+		self.key = COLUMN_MAP['profile_id']
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+
+		self.connection = None
+		self.pending = 0
+		self.first_pending = None
+		self.lock = threading.Lock()
+
+
+	@staticmethod
+	def quote(column):
+		return '"' + column.replace('"', '""') + '"'
+
+
+	def open(self):
+		self.connection = sqlite3.connect(self.sheet_path, check_same_thread=False)
+		columns = ', '.join(
+			f'{self.quote(column)} TEXT PRIMARY KEY' if column == self.key else f'{self.quote(column)} TEXT'
+			for column in self.columns)
+
+		self.connection.executescript(f'''
+			CREATE TABLE IF NOT EXISTS contacts ({columns});
+			CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+			INSERT OR IGNORE INTO meta VALUES ('row_count', (SELECT COUNT(*) FROM contacts));
+			CREATE TRIGGER IF NOT EXISTS contacts_insert AFTER INSERT ON contacts
+				BEGIN UPDATE meta SET value = value + 1 WHERE key = 'row_count'; END;
+			CREATE TRIGGER IF NOT EXISTS contacts_delete AFTER DELETE ON contacts
+				BEGIN UPDATE meta SET value = value - 1 WHERE key = 'row_count'; END;
+		''')
+
+		# later versions may add columns: keep older databases in step
+		existing = {row[1] for row in self.connection.execute('PRAGMA table_info(contacts)')}
+		for column in self.columns:
+			if column not in existing:
+				self.connection.execute(f'ALTER TABLE contacts ADD COLUMN {self.quote(column)} TEXT')
+
+		self.connection.commit()
+
+		columns = ', '.join(self.quote(column) for column in self.columns)
+		placeholders = ', '.join('?' for column in self.columns)
+		updates = ', '.join(
+			f'{self.quote(column)} = excluded.{self.quote(column)}'
+			for column in self.columns if column != self.key)
+
+		self.upsert = (
+			f'INSERT INTO contacts ({columns}) VALUES ({placeholders}) '
+			f'ON CONFLICT({self.quote(self.key)}) DO UPDATE SET {updates}')
+
+
+	def cursor(self):
+		if self.connection is None:
+			self.open()
+
+		return self.connection
+
+
+	def row_count(self):
+		with self.lock:
+			return self.cursor().execute("SELECT value FROM meta WHERE key = 'row_count'").fetchone()[0]
+
+
+	def profile_ids(self):
+		with self.lock:
+			return [row[0] for row in self.cursor().execute(f'SELECT {self.quote(self.key)} FROM contacts')]
+
+
+	def profile_urls(self):
+		'''
+		(profile ID, profile URL) for every row, if the table has a URL column
+		'''
+		url_column = EXTRA_COLUMNS['url']
+		with self.lock:
+			existing = {row[1] for row in self.cursor().execute('PRAGMA table_info(contacts)')}
+			if url_column not in existing:
+				return []
+
+			return self.cursor().execute(f'SELECT {self.quote(self.key)}, {self.quote(url_column)} FROM contacts').fetchall()
+
+
+	def add(self, profile_dict):
+		with self.lock:
+			self.cursor().execute(self.upsert, [str(profile_dict.get(column, '')) for column in self.columns])
+			self.pending += 1
+			if self.first_pending is None:
+				self.first_pending = time.time()
+
+			if self.pending >= self.batch_size or self.due():
+				self.commit()
+
+
+	def due(self):
+		return self.first_pending is not None and time.time() - self.first_pending >= self.flush_interval
+
+
+	def commit(self):
+		'''
+		Commit the open transaction: called with the lock held
+		'''
+		if self.connection is not None and self.pending > 0:
+			self.connection.commit()
+
+		self.pending = 0
+		self.first_pending = None
+
+
+	def flush_if_due(self):
+		with self.lock:
+			if self.due():
+				self.commit()
+
+
+	def flush(self):
+		with self.lock:
+			self.commit()
+
+
+	def close(self):
+		with self.lock:
+			self.commit()
+			if self.connection is not None:
+				self.connection.close()
+				self.connection = None
+
+
+class ColumnBuffer:
+	'''
+	ColumnBuffer collects rows into one list per column, and turns them into a
+	single DataFrame per batch: text columns are typed as strings, and the
+	few-valued Industry and Location columns as categoricals.
+	'''
+	def __init__(self, columns):
+		self.columns = list(columns)
+		self.clear()
+
+
+	def __len__(self):
+		return self.length
+
+
+	def clear(self):
+		self.values = {column: [] for column in self.columns}
+		self.length = 0
+
+
+	def append(self, row):
+		for column, values in self.values.items():
+			values.append(row.get(column, ''))
+
+		self.length += 1
+
+
+	def frame(self):
+		return pd.DataFrame({
+			column: pd.Series(values, dtype='category' if column in CATEGORICAL_COLUMNS else 'string')
+			for column, values in self.values.items()
+		})
+
+
+def parquet_parts(parquet_path):
+	'''
+	Part files of a parquet output directory, in write order
+	'''
+	if not os.path.isdir(parquet_path):
+		return []
+
+	return sorted(
+		os.path.join(parquet_path, filename) for filename in os.listdir(parquet_path)
+		if filename.startswith('part-') and filename.endswith('.parquet'))
+
+
+class FrameSink:
+	'''
+	FrameSink is the bulk writer used for xlsx and parquet batch runs: a csv
+	streams faster through CsvSink. Rows are buffered column by column, and
+	every batch is written as one DataFrame with a single to_excel or
+	to_parquet call. A parquet output is a directory with one part file per
+	batch.
+	'''
+	def __init__(self, sheet_path, sheet_type, columns, batch_size=1000, flush_interval=30):
+		self.sheet_path = sheet_path
+		self.sheet_type = sheet_type
+		self.columns = list(columns)
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+
+		self.buffer = None
+		self.first_buffered = None
+		self.sheet_name = 'Sheet1'
+		self.header_changed = False
+		self.row_count = 0
+		self.lock = threading.Lock()
+
+
+	def open(self):
+		'''
+		Follow the existing output's columns and count its rows
+		'''
+		if self.sheet_type == 'excel' and os.path.isfile(self.sheet_path):
+			book = load_workbook(self.sheet_path, read_only=True)
+			self.sheet_name = book.sheetnames[0]
+			header = [column for column in next(book.worksheets[0].iter_rows(values_only=True), ()) if column is not None]
+			self.row_count = count_excel_rows(book.worksheets[0])
+			book.close()
+
+			# new columns are added at the end, like the per-profile excel writer does
+			new_columns = [column for column in self.columns if column not in header]
+			self.header_changed = len(new_columns) > 0
+			self.columns = header + new_columns
+
+		elif self.sheet_type == 'parquet':
+			try:
+				import pyarrow.parquet
+			except ImportError:
+				raise Exception('Parquet output requires pyarrow: pip3 install pyarrow')
+
+			parts = parquet_parts(self.sheet_path)
+			if len(parts) > 0:
+				# every part shares the first part's schema
+				self.columns = pyarrow.parquet.read_schema(parts[0]).names
+				self.row_count = sum(pyarrow.parquet.read_metadata(part).num_rows for part in parts)
+			else:
+				os.makedirs(self.sheet_path, exist_ok=True)
+
+		self.buffer = ColumnBuffer(self.columns)
+
+
+	def flush_threshold(self):
+		'''
+		An excel batch rewrites the whole workbook, so its batches grow with
+		the sheet like the per-profile excel writer's do
+		'''
+		if self.sheet_type == 'excel':
+			return max(self.batch_size, self.row_count // 100)
+
+		return self.batch_size
+
+
+	def add(self, profile_dict):
+		with self.lock:
+			if self.buffer is None:
+				self.open()
+
+			self.buffer.append(profile_dict)
+			if self.first_buffered is None:
+				self.first_buffered = time.time()
+
+			if len(self.buffer) >= self.flush_threshold() or self.due():
+				self.write_buffer()
+
+
+	def due(self):
+		return self.first_buffered is not None and time.time() - self.first_buffered >= self.flush_interval
+
+
+	def flush_if_due(self):
+		with self.lock:
+			if self.due():
+				self.write_buffer()
+
+
+	def flush(self):
+		with self.lock:
+			self.write_buffer()
+
+
+	def write_buffer(self):
+		'''
+		Write the buffered batch as one DataFrame: called with the lock held
+		'''
+		if self.buffer is None or len(self.buffer) == 0:
+			return
+
+		frame = self.buffer.frame()
+		try:
+			if self.sheet_type == 'excel':
+				self.write_excel(frame)
+				self.row_count += len(frame.index)
+
+			elif self.sheet_type == 'parquet':
+				part_path = os.path.join(self.sheet_path, f'part-{len(parquet_parts(self.sheet_path)):05d}.parquet')
+				frame.to_parquet(f'{part_path}.tmp', index=False)
+				os.replace(f'{part_path}.tmp', part_path)
+				self.row_count += len(frame.index)
+		except Exception as error:
+			logging.exception(f'Error writing batch to {self.sheet_path}: {error}')
+			logging.info(traceback.format_exc())
+			return
+
+		logging.info(f'Wrote batch of {len(frame.index)} profiles to {self.sheet_path}')
+		self.buffer.clear()
+		self.first_buffered = None
+
+
+	def write_excel(self, frame):
+		'''
+		Append a batch to a copy of the workbook, then replace the workbook with it
+		'''
+		# pandas picks the excel engine by extension, so the extension is kept
+		root, extension = os.path.splitext(self.sheet_path)
+		tmp_path = f'{root}.tmp{extension}'
+		try:
+			if self.row_count == 0:
+				with pd.ExcelWriter(tmp_path, engine='openpyxl') as writer:
+					frame.to_excel(writer, sheet_name=self.sheet_name, index=False)
+
+				self.row_count = 1
+			else:
+				shutil.copyfile(self.sheet_path, tmp_path)
+				with pd.ExcelWriter(tmp_path, engine='openpyxl', mode='a', if_sheet_exists='overlay') as writer:
+					if self.header_changed:
+						pd.DataFrame(columns=self.columns).to_excel(writer, sheet_name=self.sheet_name, index=False)
+
+					frame.to_excel(writer, sheet_name=self.sheet_name, startrow=self.row_count, header=False, index=False)
+
+			os.replace(tmp_path, self.sheet_path)
+		except Exception:
+			if os.path.isfile(tmp_path):
+				os.remove(tmp_path)
+
+			raise
+
+		self.header_changed = False
+
+
+	def close(self):
+		self.flush()
+
+
+def export_sqlite(database_path, export_path, chunk_size=1000):
+	'''
+	Export a SQLite contact database to csv, xlsx or parquet in one streaming
+	pass: only chunk_size rows are held in memory at a time.
+	Returns the number of rows exported.
+	'''
+	connection = sqlite3.connect(database_path)
+	cursor = connection.execute('SELECT * FROM contacts')
+	columns = [description[0] for description in cursor.description]
+	exported = 0
+
+	def chunks():
+		while True:
+			rows = cursor.fetchmany(chunk_size)
+			if len(rows) == 0:
+				return
+
+			yield rows
+
+	try:
+		if export_path.endswith('.csv'):
+			with open(export_path, 'w', newline='') as csv_file:
+				writer = csv.writer(csv_file)
+				writer.writerow(columns)
+				for rows in chunks():
+					writer.writerows(rows)
+					exported += len(rows)
+
+		elif '.xls' in export_path:
+			book = Workbook(write_only=True)
+			sheet = book.create_sheet('Sheet1')
+			sheet.append(columns)
+			for rows in chunks():
+				for row in rows:
+					sheet.append(row)
+
+				exported += len(rows)
+
+			book.save(export_path)
+
+		elif export_path.endswith('.parquet'):
+			try:
+				import pyarrow, pyarrow.parquet
+			except ImportError:
+				raise Exception('Parquet export requires pyarrow: pip3 install pyarrow')
+
+			schema = pyarrow.schema([(column, pyarrow.string()) for column in columns])
+			with pyarrow.parquet.ParquetWriter(export_path, schema) as writer:
+				for rows in chunks():
+					writer.write_table(pyarrow.Table.from_pylist([dict(zip(columns, row)) for row in rows], schema=schema))
+					exported += len(rows)
+
+		else:
+			raise Exception(f'Unsupported export file type: {export_path}')
+	finally:
+		connection.close()
+
+	return exported
+
+
+class SheetEnricher:
+	'''
+	SheetEnricher refreshes the rows of an existing csv or xlsx sheet that
+	have no email address or phone number, or were last fetched more than
+	max_age seconds ago. The sheet is streamed in chunks: stale rows are
+	re-fetched into a staging database next to the sheet, then merged into
+	it in one rewrite pass, so memory use follows the chunk size and not the
+	sheet's. An interrupted run keeps its staged rows, and doesn't fetch
+	them again when resumed. Given profile_ids, only those rows are
+	refreshed, stale or not.
+	'''
+	def __init__(self, sheet_path, sheet_type, max_age=None, chunk_size=1000, profile_ids=None):
+		self.sheet_path = sheet_path
+		self.sheet_type = sheet_type
+		self.max_age = max_age
+		self.profile_ids = profile_ids
+		self.chunk_size = chunk_size
+		self.staging_path = f'{sheet_path}.enrich.sqlite'
+		self.staging = None
+		self.columns = None
+		self.selected = 0
+
+		if sheet_type not in ('csv', 'excel'):
+			raise Exception(f'Only csv and xlsx sheets can be enriched: {sheet_path}')
+
+		# the rewrite keeps the first worksheet only, under its own name
+		self.sheet_name = 'Sheet1'
+		if sheet_type == 'excel':
+			names = excel_sheet_names(sheet_path)
+			if len(names) > 1:
+				raise Exception(f'{sheet_path} has more than one worksheet: only single-sheet workbooks can be enriched')
+
+			self.sheet_name = names[0]
+
+		self.header = next(self.rows(), [])
+
+
+	def rows(self):
+		'''
+		Yield every row of the sheet as a list of strings, header first
+		'''
+		if self.sheet_type == 'csv':
+			with open(self.sheet_path, 'r', newline='') as csv_file:
+				yield from csv.reader(csv_file)
+
+			return
+
+		book = load_workbook(self.sheet_path, read_only=True)
+		try:
+			for row in book.worksheets[0].iter_rows(values_only=True):
+				yield ['' if value is None else str(value) for value in row]
+		finally:
+			book.close()
+
+
+	def chunks(self):
+		'''
+		Yield the sheet's contacts as dictionaries, chunk_size at a time
+		'''
+		rows = self.rows()
+		header = next(rows, [])
+		chunk = []
+		for row in rows:
+			chunk.append(dict(zip(header, row)))
+			if len(chunk) >= self.chunk_size:
+				yield chunk
+				chunk = []
+
+		if len(chunk) > 0:
+			yield chunk
+
+
+	def open(self, columns):
+		'''
+		Open the staging database for rows with the given columns: the
+		rewritten sheet keeps its own columns, and gains any missing ones
+		'''
+		self.staging = SqliteSink(self.staging_path, columns)
+		self.columns = self.header + [column for column in columns if column not in self.header]
+
+
+	def is_stale(self, row, cutoff):
+		if self.profile_ids is not None:
+			return row[COLUMN_MAP['profile_id']] in self.profile_ids
+
+		if row.get(COLUMN_MAP['email_address'], '') == '' or row.get(COLUMN_MAP['phone_numbers'], '') == '':
+			return True
+
+		# fetch times are stored as sortable text: a missing one is as old as it gets
+		return cutoff is not None and row.get(EXTRA_COLUMNS['fetched'], '') < cutoff
+
+
+	def staged(self, profile_ids):
+		'''
+		Staged rows for some profile IDs, keyed by profile ID
+		'''
+		if len(profile_ids) == 0:
+			return {}
+
+		with self.staging.lock:
+			cursor = self.staging.cursor().execute(
+				f'SELECT * FROM contacts WHERE {self.staging.quote(self.staging.key)} IN ({", ".join("?" for i in profile_ids)})',
+				profile_ids)
+
+			columns = [description[0] for description in cursor.description]
+			rows = [dict(zip(columns, row)) for row in cursor]
+
+		return {row[self.staging.key]: row for row in rows}
+
+
+	def profiles(self, stats, duplicates):
+		'''
+		Yield the profile ID of every stale row that isn't staged yet. The
+		arguments are those of Session.run_profiles: nothing here is a duplicate.
+		'''
+		cutoff = None
+		if self.max_age is not None:
+			cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() - self.max_age))
+
+		key = COLUMN_MAP['profile_id']
+		for chunk in self.chunks():
+			stale = [row[key] for row in chunk if row.get(key, '') != '' and self.is_stale(row, cutoff)]
+			staged = self.staged(stale)
+			for profile_id in stale:
+				if profile_id not in staged:
+					self.selected += 1
+					yield profile_id
+
+
+	@staticmethod
+	def merge(row, fresh):
+		'''
+		Update a row with a fresh one: values the fresh row lacks are kept
+		'''
+		for column, value in fresh.items():
+			if value not in (None, ''):
+				row[column] = value
+
+
+	def rewrite(self):
+		'''
+		Merge the staged rows into the sheet in one pass through a temporary
+		file, and remove the staging database. Returns the rows updated.
+		'''
+		self.staging.flush()
+		root, extension = os.path.splitext(self.sheet_path)
+		tmp_path = f'{root}.tmp{extension}'
+		key = COLUMN_MAP['profile_id']
+		updated = 0
+
+		if self.sheet_type == 'csv':
+			out_file = open(tmp_path, 'w', newline='')
+			writer = csv.writer(out_file)
+			append = writer.writerow
+		else:
+			book = Workbook(write_only=True)
+			sheet = book.create_sheet(self.sheet_name)
+			append = sheet.append
+
+		try:
+			append(self.columns)
+			for chunk in self.chunks():
+				staged = self.staged([row[key] for row in chunk if row.get(key, '') != ''])
+				for row in chunk:
+					fresh = staged.get(row.get(key))
+					if fresh is not None:
+						self.merge(row, fresh)
+						updated += 1
+
+					append([row.get(column, '') for column in self.columns])
+
+			if self.sheet_type == 'excel':
+				book.save(tmp_path)
+		finally:
+			if self.sheet_type == 'csv':
+				out_file.close()
+
+		os.replace(tmp_path, self.sheet_path)
+		self.staging.close()
+		os.remove(self.staging_path)
+		return updated
+
+
+class FetchStatistics:
+	'''
+	Thread-safe outcome counts and API latencies for a fetch run
+	'''
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counts = {'stored': 0, 'failed': 0, 'skipped': 0, 'cancelled': 0}
+		self.latencies = []
+
+		# called with (profile ID, outcome) for every outcome recorded
+		self.observers = []
+
+
+	def record(self, outcome, latency=None, profile_id=None):
+		with self.lock:
+			self.counts[outcome] += 1
+			if latency is not None:
+				self.latencies.append(latency)
+
+		for observer in self.observers:
+			observer(profile_id, outcome)
+
+
+	def summary(self):
+		'''
+		Outcome counts and API latency percentiles
+		'''
+		with self.lock:
+			stats = dict(self.counts)
+			latencies = sorted(self.latencies)
+
+		stats['latency_p50'] = percentile(latencies, 50)
+		stats['latency_p90'] = percentile(latencies, 90)
+		stats['latency_p99'] = percentile(latencies, 99)
+		return stats
+
+
+class Metrics:
+	'''
+	Metrics keeps per-stage latency histograms, counters and gauges for the
+	whole session. They can be read as a text summary, or exported in the
+	Prometheus text format to a file or over HTTP.
+	'''
+	# histogram bucket upper bounds, in seconds
+	buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+	def __init__(self, prefix='liscrape'):
+		self.prefix = prefix
+		self.histograms = {}
+		self.counters = collections.Counter()
+		self.gauges = {}
+		self.lock = threading.Lock()
+		self.started = time.time()
+
+		self.exporter = None
+		self.server = None
+		self.textfile_path = None
+		self.stopped = threading.Event()
+
+
+	def observe(self, stage, seconds):
+		with self.lock:
+			histogram = self.histograms.get(stage)
+			if histogram is None:
+				# one count per bucket, plus one for anything over the last bound
+				histogram = self.histograms[stage] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+
+			histogram['counts'][bisect.bisect_left(self.buckets, seconds)] += 1
+			histogram['sum'] += seconds
+			histogram['count'] += 1
+
+
+	@contextlib.contextmanager
+	def timer(self, stage):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(stage, time.perf_counter() - start)
+
+
+	def timed(self, stage, function):
+		'''
+		Wrap function so every call is timed under stage
+		'''
+		def timed_function(*args, **kwargs):
+			with self.timer(stage):
+				return function(*args, **kwargs)
+
+		return timed_function
+
+
+	def increment(self, counter, amount=1):
+		with self.lock:
+			self.counters[counter] += amount
+
+
+	def gauge(self, name, function):
+		'''
+		Register a gauge: function is called for its value on every read
+		'''
+		self.gauges[name] = function
+
+
+	def gauge_values(self):
+		values = {'uptime_seconds': time.time() - self.started}
+		for name, function in list(self.gauges.items()):
+			try:
+				values[name] = function()
+			except Exception as error:
+				logging.warning(f'Error reading gauge {name}: {error}')
+
+		return values
+
+
+	def quantile(self, stage, quantile):
+		'''
+		Estimate a quantile from the histogram, interpolating within the bucket
+		it falls in, like Prometheus' histogram_quantile does
+		'''
+		with self.lock:
+			histogram = self.histograms.get(stage)
+			if histogram is None or histogram['count'] == 0:
+				return 0
+
+			counts = list(histogram['counts'])
+			rank = quantile * histogram['count']
+
+		cumulative = 0
+		for i, count in enumerate(counts):
+			if count > 0 and cumulative + count >= rank:
+				lower = self.buckets[i - 1] if i > 0 else 0
+				upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+				return lower + (upper - lower) * (rank - cumulative) / count
+
+			cumulative += count
+
+		return self.buckets[-1]
+
+
+	def summary(self):
+		'''
+		A human-readable table of stage latencies, counters and gauges
+		'''
+		lines = [f'{"stage":<26}{"count":>8}{"mean":>10}{"p50":>10}{"p90":>10}{"p99":>10}']
+		with self.lock:
+			histograms = {stage: (histogram['count'], histogram['sum']) for stage, histogram in self.histograms.items()}
+			counters = dict(self.counters)
+
+		for stage, (count, total) in sorted(histograms.items()):
+			lines.append(
+				f'{stage:<26}{count:>8}{total / count:>9.3f}s{self.quantile(stage, 0.5):>9.3f}s'
+				f'{self.quantile(stage, 0.9):>9.3f}s{self.quantile(stage, 0.99):>9.3f}s')
+
+		lines.append(', '.join(f'{name}: {value}' for name, value in sorted(counters.items())) or 'no counts yet')
+		lines.append(', '.join(
+			f'{name}: {value:.0f}' for name, value in sorted(self.gauge_values().items())))
+
+		return '\n'.join(lines)
+
+
+	def prometheus(self):
+		'''
+		All metrics in the Prometheus text exposition format
+		'''
+		lines = []
+		with self.lock:
+			histograms = {
+				stage: (list(histogram['counts']), histogram['sum'], histogram['count'])
+				for stage, histogram in self.histograms.items()
+			}
+			counters = dict(self.counters)
+
+		name = f'{self.prefix}_stage_duration_seconds'
+		lines.append(f'# HELP {name} Time spent per stage.')
+		lines.append(f'# TYPE {name} histogram')
+		for stage, (counts, total, count) in sorted(histograms.items()):
+			cumulative = 0
+			for bound, bucket_count in zip(self.buckets, counts):
+				cumulative += bucket_count
+				lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+
+			lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {count}')
+			lines.append(f'{name}_sum{{stage="{stage}"}} {total}')
+			lines.append(f'{name}_count{{stage="{stage}"}} {count}')
+
+		for counter, value in sorted(counters.items()):
+			lines.append(f'# TYPE {self.prefix}_{counter}_total counter')
+			lines.append(f'{self.prefix}_{counter}_total {value}')
+
+		for gauge, value in sorted(self.gauge_values().items()):
+			lines.append(f'# TYPE {self.prefix}_{gauge} gauge')
+			lines.append(f'{self.prefix}_{gauge} {value}')
+
+		return '\n'.join(lines) + '\n'
+
+
+	def start_exporter(self, textfile_path=None, port=None, interval=15):
+		'''
+		Write the Prometheus text file every interval seconds, and/or serve
+		the metrics on http://127.0.0.1:port/metrics
+		'''
+		metrics = self
+		if port is not None:
+			class MetricsHandler(http.server.BaseHTTPRequestHandler):
+				def do_GET(self):
+					if self.path.split('?')[0] != '/metrics':
+						self.send_error(404)
+						return
+
+					body = metrics.prometheus().encode()
+					self.send_response(200)
+					self.send_header('Content-Type', 'text/plain; version=0.0.4')
+					self.send_header('Content-Length', str(len(body)))
+					self.end_headers()
+					self.wfile.write(body)
+
+				def log_message(self, format, *args):
+					pass
+
+			self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+			threading.Thread(target=self.server.serve_forever, name='metrics-http', daemon=True).start()
+			logging.info(f'Serving metrics on http://127.0.0.1:{port}/metrics')
+
+		if textfile_path is not None:
+			self.textfile_path = textfile_path
+
+			def write_textfile():
+				while not self.stopped.wait(interval):
+					self.write_textfile()
+
+			self.exporter = threading.Thread(target=write_textfile, name='metrics-textfile', daemon=True)
+			self.exporter.start()
+
+
+	def write_textfile(self):
+		try:
+			atomic_write(self.textfile_path, self.prometheus())
+		except Exception as error:
+			logging.exception(f'Error writing metrics to {self.textfile_path}: {error}')
+
+
+	def stop(self):
+		'''
+		Stop exporting, writing the text file one last time
+		'''
+		self.stopped.set()
+		if self.exporter is not None:
+			self.exporter.join()
+			self.exporter = None
+			self.write_textfile()
+
+		if self.server is not None:
+			self.server.shutdown()
+			self.server.server_close()
+			self.server = None
+
+
+class BatchQueue:
+	'''
+	A FIFO queue of (sequence number, profile ID) entries for one batch
+	'''
+	def __init__(self, name, weight=1):
+		self.name = name
+		self.weight = weight
+		self.entries = collections.deque()
+
+		# stride scheduling: the batch with the lowest pass value is served next
+		self.pass_value = 0.0
+
+
+	def __len__(self):
+		return len(self.entries)
+
+
+	def put(self, sequence, profile_id):
+		self.entries.append((sequence, profile_id))
+
+
+	def get(self):
+		return self.entries.popleft()
+
+
+class ProfileScheduler:
+	'''
+	ProfileScheduler orders the profiles waiting for a fetch worker. Profiles
+	submitted interactively are served before any batch. Batches share the
+	workers by weight, so a small batch isn't stuck behind a large one. A
+	profile is queued only once: submitting a profile that a batch has queued
+	interactively moves it to the front. Queued profiles can be cancelled one
+	at a time or a batch at a time. At most memory_cap profiles are queued:
+	past that, adding to a batch waits for the workers to take some, so a
+	large batch is read in as it is fetched rather than all at once.
+	'''
+	STOP = object()
+	INTERACTIVE = 'interactive'
+
+	def __init__(self, memory_cap=10000):
+		self.memory_cap = memory_cap
+		self.interactive = collections.deque()
+		self.batches = {}
+		self.condition = threading.Condition()
+		self.closed = False
+
+		# profile ID -> (sequence number, batch) for every profile queued: older entries are stale
+		self.queued = {}
+		self.sequence = 0
+
+
+	def __len__(self):
+		with self.condition:
+			return len(self.queued)
+
+
+	def add_batch(self, name, weight=1):
+		'''
+		Start a batch served in proportion to weight
+		'''
+		with self.condition:
+			# a new batch starts level with the others, rather than ahead of them
+			active = [batch.pass_value for batch in self.batches.values() if len(batch) > 0]
+			batch = BatchQueue(name, weight)
+			batch.pass_value = min(active) if len(active) > 0 else 0.0
+			self.batches[name] = batch
+
+
+	def put(self, profile_id, batch=INTERACTIVE):
+		'''
+		Queue a profile: returns False if it was already queued, or the
+		scheduler is closed. Adding to a batch waits while the queue is full.
+		'''
+		with self.condition:
+			# interactive profiles are never held back
+			while batch != self.INTERACTIVE and len(self.queued) >= self.memory_cap and batch in self.batches and not self.closed:
+				self.condition.wait()
+
+			if self.closed or (batch != self.INTERACTIVE and batch not in self.batches):
+				# shutting down, or the batch was cancelled
+				return False
+
+			if profile_id in self.queued:
+				return False
+
+			self.sequence += 1
+			self.queued[profile_id] = (self.sequence, batch)
+			if batch == self.INTERACTIVE:
+				self.interactive.append((self.sequence, profile_id))
+			else:
+				self.batches[batch].put(self.sequence, profile_id)
+
+			self.condition.notify_all()
+			return True
+
+
+	def promote(self, profile_id):
+		'''
+		Move a profile a batch has queued to the front: returns the batch it
+		was queued in, or None if no batch has it queued
+		'''
+		with self.condition:
+			if self.closed or self.queued.get(profile_id, (None, self.INTERACTIVE))[1] == self.INTERACTIVE:
+				return None
+
+			# the batch entry is left behind, and skipped as stale
+			batch = self.queued[profile_id][1]
+			self.sequence += 1
+			self.queued[profile_id] = (self.sequence, self.INTERACTIVE)
+			self.interactive.append((self.sequence, profile_id))
+			self.condition.notify_all()
+			return batch
+
+
+	def next_entry(self):
+		'''
+		Take the next entry to serve, stale or not: called with the lock held
+		'''
+		if len(self.interactive) > 0:
+			return self.interactive.popleft(), self.INTERACTIVE
+
+		waiting = [batch for batch in self.batches.values() if len(batch) > 0]
+		if len(waiting) == 0:
+			return None, None
+
+		batch = min(waiting, key=lambda batch: batch.pass_value)
+		batch.pass_value += 1 / batch.weight
+		return batch.get(), batch.name
+
+
+	def get(self):
+		'''
+		Wait for the next profile to fetch: returns (profile ID, batch), or
+		STOP once the scheduler is closed and empty
+		'''
+		with self.condition:
+			while True:
+				entry, batch = self.next_entry()
+				if entry is None:
+					if self.closed:
+						return self.STOP
+
+					self.condition.wait()
+					continue
+
+				sequence, profile_id = entry
+				if self.queued.get(profile_id, (None, None))[0] != sequence:
+					# cancelled, or promoted to the front
+					continue
+
+				del self.queued[profile_id]
+
+				# room for a batch that was waiting to add more
+				self.condition.notify_all()
+				return profile_id, batch
+
+
+	def cancel(self, profile_id):
+		'''
+		Drop a queued profile: returns the batch it was queued in, or None if
+		it wasn't queued
+		'''
+		with self.condition:
+			if profile_id not in self.queued:
+				return None
+
+			self.condition.notify_all()
+			return self.queued.pop(profile_id)[1]
+
+
+	def cancel_batch(self, name):
+		'''
+		Drop every queued profile of a batch: returns how many were dropped
+		'''
+		with self.condition:
+			cancelled = [profile_id for profile_id, (sequence, batch) in self.queued.items() if batch == name]
+			for profile_id in cancelled:
+				del self.queued[profile_id]
+
+			self.batches.pop(name, None)
+			self.condition.notify_all()
+			return len(cancelled)
+
+
+	def close(self):
+		'''
+		Let get return STOP once everything queued has been taken
+		'''
+		with self.condition:
+			self.closed = True
+			self.condition.notify_all()
+
+
+class FetchPipeline:
+	'''
+	FetchPipeline feeds scheduled profiles to a fixed pool of worker threads.
+	Every worker waits for a slot from the shared rate limiter, then fetches
+	the profile and its contact info in parallel and normalises it. A single
+	writer thread owns the sink: workers hand it their rows through a bounded
+	queue, so a slow sheet holds the workers back instead of piling up rows.
+	Used as a context manager, leaving the block drains in-flight work.
+	'''
+	STOP = ProfileScheduler.STOP
+
+	def __init__(self, session, workers=2, memory_cap=10000, write_queue_size=256):
+		self.session = session
+		self.workers = workers
+		self.scheduler = ProfileScheduler(memory_cap)
+		self.write_queue = queue.Queue(maxsize=write_queue_size)
+		self.threads = []
+		self.writer_thread = None
+		self.request_pool = None
+		self.stats = FetchStatistics()
+		self.batch_stats = {}
+		self.batch_submitted = collections.Counter()
+		self.submitted = 0
+		self.lock = threading.Lock()
+
+
+	def __enter__(self):
+		self.start()
+		return self
+
+
+	def __exit__(self, exc_type, exc_value, exc_traceback):
+		self.shutdown()
+
+
+	def start(self):
+		self.request_pool = concurrent.futures.ThreadPoolExecutor(
+			max_workers=self.workers, thread_name_prefix='contact-info')
+
+		self.session.metrics.gauge('queue_depth', self.pending)
+		self.session.metrics.gauge('write_queue_depth', self.write_queue.qsize)
+		self.session.metrics.gauge('in_progress', self.remaining)
+
+		self.writer_thread = threading.Thread(target=self.writer, name='sheet-writer', daemon=True)
+		self.writer_thread.start()
+
+		for i in range(self.workers):
+			thread = threading.Thread(target=self.worker, name=f'fetch-worker-{i}', daemon=True)
+			thread.start()
+			self.threads.append(thread)
+
+
+	def add_batch(self, name, weight=1):
+		'''
+		Start a batch of profiles, served alongside other batches in proportion
+		to weight. Returns the statistics of the batch's outcomes.
+		'''
+		self.scheduler.add_batch(name, weight)
+		self.batch_stats[name] = FetchStatistics()
+		self.batch_submitted[name] = 0
+		return self.batch_stats[name]
+
+
+	def submit(self, profile_id, batch=ProfileScheduler.INTERACTIVE):
+		'''
+		Queue a profile, ahead of every batch unless a batch is given. Returns
+		False if the profile was already queued, unless it was queued in a
+		batch and is now moved ahead of it.
+		'''
+		if batch == ProfileScheduler.INTERACTIVE:
+			promoted = self.scheduler.promote(profile_id)
+			if promoted is not None:
+				# its outcome is no longer the batch's: the batch doesn't wait for it
+				with self.lock:
+					self.batch_submitted[promoted] -= 1
+
+				return True
+
+		if not self.scheduler.put(profile_id, batch):
+			if batch in self.batch_stats:
+				# a batch's outcomes add up to what it submitted: this one is done already
+				with self.lock:
+					self.batch_submitted[batch] += 1
+
+				self.batch_stats[batch].record('skipped', profile_id=profile_id)
+
+			return False
+
+		with self.lock:
+			self.submitted += 1
+			self.batch_submitted[batch] += 1
+
+		return True
+
+
+	def cancel(self, profile_id):
+		'''
+		Drop a queued profile: returns False if it wasn't queued
+		'''
+		batch = self.scheduler.cancel(profile_id)
+		if batch is None:
+			return False
+
+		self.record(batch, 'cancelled', profile_id=profile_id)
+		return True
+
+
+	def cancel_batch(self, name):
+		'''
+		Drop every queued profile of a batch: returns how many were dropped
+		'''
+		cancelled = self.scheduler.cancel_batch(name)
+		for i in range(cancelled):
+			self.record(name, 'cancelled')
+
+		return cancelled
+
+
+	def wait_for_batch(self, name):
+		'''
+		Wait until every profile submitted in a batch has been processed
+		'''
+		stats = self.batch_stats[name]
+		while sum(stats.counts.values()) < self.batch_submitted[name]:
+			time.sleep(0.2)
 
 
-# TODO add automated scraping capability: "scrape first-degree contacts"
-# TODO check if profile is duplicate with URL before API call
+	def record(self, batch, outcome, latency=None, profile_id=None):
+		self.stats.record(outcome, latency, profile_id)
+		if batch in self.batch_stats:
+			self.batch_stats[batch].record(outcome, latency, profile_id)
 
 
-class History:
+	def pending(self):
+		return len(self.scheduler)
+
+
+	def remaining(self):
+		'''
+		Profiles submitted but not yet stored, skipped, failed or cancelled
+		'''
+		return self.submitted - sum(self.stats.counts.values())
+
+
+	def shutdown(self):
+		'''
+		Let the workers finish everything already queued, then stop them and
+		the writer once it has stored what they handed over
+		'''
+		self.scheduler.close()
+		for thread in self.threads:
+			thread.join()
+
+		self.threads = []
+		if self.writer_thread is not None:
+			self.write_queue.put(self.STOP)
+			self.writer_thread.join()
+			self.writer_thread = None
+
+		if self.request_pool is not None:
+			self.request_pool.shutdown(wait=True)
+
+
+	def worker(self):
+		while True:
+			item = self.scheduler.get()
+			if item is self.STOP:
+				return
+
+			profile_id, batch = item
+			try:
+				self.process(profile_id, batch)
+			except Exception as error:
+				logging.exception(f'Unhandled exception processing {profile_id}: {error}')
+				logging.info(traceback.format_exc())
+				self.record(batch, 'failed', profile_id=profile_id)
+				self.session.progress()
+
+
+	def writer(self):
+		while True:
+			try:
+				item = self.write_queue.get(timeout=1)
+			except queue.Empty:
+				# write out buffered profiles that have waited long enough, off the GUI thread
+				if self.session.sink is not None:
+					with self.session.store_lock:
+						self.session.sink.flush_if_due()
+
+				continue
+
+			if item is self.STOP:
+				return
+
+			profile_id, batch, response, profile_dict, latency = item
+			try:
+				stored = self.session.commit_profile(*response, public_id=profile_id, profile_dict=profile_dict)
+			except Exception as error:
+				logging.exception(f'Error storing {profile_id}: {error}')
+				logging.info(traceback.format_exc())
+				self.record(batch, 'failed', latency, profile_id)
+			else:
+				self.record(batch, 'stored' if stored else 'skipped', latency, profile_id)
+
+			self.session.progress()
+
+
+	def process(self, profile_id, batch=ProfileScheduler.INTERACTIVE):
+		# a cached response costs no API calls or quota
+		cached = self.session.cached_profile(profile_id)
+		if cached is not None:
+			self.write_queue.put((profile_id, batch, cached, self.session.normalise(*cached, profile_id), None))
+			return
+
+		attempt, account = 0, None
+		while True:
+			self.session.breaker.wait()
+
+			call_start = time.time()
+			try:
+				account = self.session.acquire_account(profile_id)
+				response = self.session.fetch_profile(profile_id, executor=self.request_pool, account=account)
+			except Exception as error:
+				delay = self.session.handle_fetch_error(profile_id, error, account, attempt)
+				if delay is None:
+					self.record(batch, 'failed', profile_id=profile_id)
+					self.session.progress()
+					return
+
+				time.sleep(delay)
+				attempt += 1
+				continue
+
+			self.session.breaker.record_success()
+			self.session.metrics.increment('fetched')
+			latency = time.time() - call_start
+			break
+
+		self.write_queue.put((profile_id, batch, response, self.session.normalise(*response, profile_id), latency))
+
+
+class AsyncLinkedinClient:
 	'''
-	History class loads, stores, and enforces a simple API call-limit to prevent
-	users from getting themselves banned by spamming Linkedin's API.
+	Async adapter for the blocking linkedin_api client. Requests run on a
+	dedicated thread pool sized to the wanted concurrency, and share one
+	HTTP connection pool of the same size.
 	'''
-	def __init__(self, session):
-		self.parent_session = session
-		self.call_count = 0
-		self.hourly_limit = 90
-		self.history = {}
+	def __init__(self, client, concurrency=64, metrics=None):
+		self.client = client
+		self.concurrency = concurrency
+		self.metrics = Metrics() if metrics is None else metrics
+		self.executor = concurrent.futures.ThreadPoolExecutor(
+			max_workers=concurrency, thread_name_prefix='async-client')
 
+		self.mount(client)
 
-	def load(self):
+
+	def mount(self, client):
 		'''
-		Load history from configuration file
+		The default requests adapter keeps only 10 connections per host:
+		size the client's connection pool to the concurrency instead
 		'''
-		if not os.path.isfile('config.json'):
-			with open('config.json', 'w') as config_file:
-				config = {'users': {}, 'history': {}, 'theme': None}
-				json.dump(config, config_file, indent=4)
+		http_session = getattr(getattr(client, 'client', None), 'session', None)
+		if http_session is not None:
+			adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+			http_session.mount('https://', adapter)
 
-			return {}
 
-		with open('config.json', 'r') as config_file:
+	async def call(self, method, *args):
+		loop = asyncio.get_running_loop()
+		return await loop.run_in_executor(self.executor, method, *args)
+
+
+	async def get_profile(self, public_id, client=None):
+		client = self.client if client is None else client
+		return await self.call(self.metrics.timed('get_profile', client.get_profile), public_id)
+
+
+	async def get_profile_skills(self, public_id, client=None):
+		client = self.client if client is None else client
+		return await self.call(self.metrics.timed('get_profile_skills', client.get_profile_skills), public_id)
+
+
+	async def get_profile_contact_info(self, public_id, client=None):
+		client = self.client if client is None else client
+		return await self.call(self.metrics.timed('get_profile_contact_info', client.get_profile_contact_info), public_id)
+
+
+	def close(self):
+		self.executor.shutdown(wait=True)
+
+
+class AsyncFetchEngine:
+	'''
+	asyncio fetch engine for large batch runs: up to `concurrency` profiles are
+	in flight at once under the shared rate limiter. Results go through a
+	bounded queue to a single writer task, so a slow sheet applies
+	backpressure to the fetchers instead of piling up in memory.
+	'''
+	def __init__(self, session, client, concurrency=64, write_queue_size=256):
+		self.session = session
+		self.client = client
+		self.concurrency = concurrency
+		self.write_queue_size = write_queue_size
+		self.stats = FetchStatistics()
+
+
+	async def acquire(self, profile_id):
+		'''
+		Wait for a slot in the quota without blocking the event loop. Returns
+		the account to make the call with: None means the session's own login.
+		'''
+		pool = self.session.account_pool
+		wait_start = time.time()
+		if pool is None:
+			while not self.session.history.acquire(profile_id, blocking=False):
+				await asyncio.sleep(max(self.session.history.limiter.next_slot(), 0.01))
+
+			self.session.record_wait(time.time() - wait_start)
+			return None
+
+		while len(pool.active_accounts()) > 0:
+			account = pool.try_acquire(profile_id)
+			if account is not None:
+				self.session.record_wait(time.time() - wait_start)
+				return account
+
+			await asyncio.sleep(max(pool.next_slot(), 0.01))
+
+		raise Exception('No signed-in accounts left in rotation')
+
+
+	async def fetch(self, profile_id, account=None):
+		'''
+		Fetch profile and contact info concurrently: returns (profile, contact_info),
+		and raises if the profile could not be loaded
+		'''
+		if self.session.debug:
+			return self.session.fetch_profile(profile_id)
+
+		client = None if account is None else account.application
+		wanted = self.session.fetch_requests()
+		wants_profile, wants_skills, wants_contact_info = wanted
+
+		calls = {}
+		if wants_profile:
+			calls['profile'] = self.client.get_profile(profile_id, client)
+
+		if wants_skills:
+			calls['skills'] = self.client.get_profile_skills(profile_id, client)
+
+		if wants_contact_info:
+			calls['contact_info'] = self.client.get_profile_contact_info(profile_id, client)
+
+		responses = dict(zip(calls, await asyncio.gather(*calls.values(), return_exceptions=True)))
+
+		# off the event loop: a failed contact info request is retried with backoff
+		application = self.client.client if client is None else client
+		return await self.client.call(
+			self.session.fetch_result, application, profile_id, wanted,
+			responses.get('profile'), responses.get('skills'), responses.get('contact_info'))
+
+
+	async def fetcher(self, fetch_queue, write_queue):
+		while True:
+			profile_id = await fetch_queue.get()
+			if profile_id is FetchPipeline.STOP:
+				return
+
+			# a cached response costs no API calls or quota
+			cached = self.session.cached_profile(profile_id)
+			if cached is not None:
+				await write_queue.put((profile_id, cached, None))
+				continue
+
+			attempt, account, response = 0, None, None
+			while True:
+				while self.session.breaker.remaining() > 0:
+					await asyncio.sleep(self.session.breaker.remaining())
+
+				call_start = time.time()
+				try:
+					account = await self.acquire(profile_id)
+					response = await self.fetch(profile_id, account)
+				except Exception as error:
+					delay = self.session.handle_fetch_error(profile_id, error, account, attempt)
+					if delay is None:
+						self.stats.record('failed', profile_id=profile_id)
+						break
+
+					await asyncio.sleep(delay)
+					attempt += 1
+					continue
+
+				self.session.breaker.record_success()
+				self.session.metrics.increment('fetched')
+				latency = time.time() - call_start
+				break
+
+			if response is None:
+				continue
+
+			await write_queue.put((profile_id, response, latency))
+
+
+	async def writer(self, write_queue):
+		loop = asyncio.get_running_loop()
+		while True:
+			item = await write_queue.get()
+			if item is FetchPipeline.STOP:
+				return
+
+			profile_id, response, latency = item
+			try:
+				stored = await loop.run_in_executor(
+					None, lambda: self.session.commit_profile(*response, public_id=profile_id))
+			except Exception as error:
+				logging.exception(f'Error storing {profile_id}: {error}')
+				self.stats.record('failed', latency, profile_id)
+				continue
+
+			self.stats.record('stored' if stored else 'skipped', latency, profile_id)
+
+
+	async def run(self, profile_ids):
+		'''
+		Fetch and store every profile ID from an iterable
+		'''
+		loop = asyncio.get_running_loop()
+		fetch_queue = asyncio.Queue(maxsize=self.concurrency)
+		write_queue = asyncio.Queue(maxsize=self.write_queue_size)
+		self.session.metrics.gauge('queue_depth', fetch_queue.qsize)
+		self.session.metrics.gauge('write_queue_depth', write_queue.qsize)
+
+		fetchers = [asyncio.create_task(self.fetcher(fetch_queue, write_queue)) for i in range(self.concurrency)]
+		writer = asyncio.create_task(self.writer(write_queue))
+
+		# read input off the event loop, so a slow stdin doesn't stall the fetchers
+		profile_iterator = iter(profile_ids)
+		while True:
+			profile_id = await loop.run_in_executor(None, next, profile_iterator, FetchPipeline.STOP)
+			if profile_id is FetchPipeline.STOP:
+				break
+
+			await fetch_queue.put(profile_id)
+
+		for fetcher in fetchers:
+			await fetch_queue.put(FetchPipeline.STOP)
+
+		await asyncio.gather(*fetchers)
+		await write_queue.put(FetchPipeline.STOP)
+		await writer
+
+		return self.stats.summary()
+
+
+class ConnectionCrawler:
+	'''
+	ConnectionCrawler pages through the signed-in account's first-degree
+	connections, and yields the ones that are not stored yet. The offset of
+	the first page with unfinished profiles is checkpointed to a file, so an
+	interrupted crawl resumes from there instead of paging from the start.
+	'''
+	def __init__(self, session, cursor_path='liscrape-crawl.json', page_size=49):
+		self.session = session
+		self.cursor_path = cursor_path
+
+		# linkedin_api returns at most 49 search results per request
+		self.page_size = page_size
+		self.offset = 0
+		self.complete = False
+		self.error = None
+		self.stopped = threading.Event()
+
+		# (offset after the page, profile IDs of the page still unfinished) for unfinished pages
+		self.pages = collections.deque()
+		self.outstanding = {}
+		self.lock = threading.Lock()
+
+
+	def load(self):
+		'''
+		Resume from the stored cursor, unless it belongs to another account
+		or the last crawl went through every connection
+		'''
+		self.offset, self.complete = 0, False
+		if not os.path.isfile(self.cursor_path):
+			return
+
+		with open(self.cursor_path, 'r') as cursor_file:
 			try:
-				config = json.load(config_file)
-				self.call_count = len(config['history'].keys())
-				return config['history']
+				cursor = json.load(cursor_file)
 			except Exception as error:
 				logging.exception(error)
-				os.remove('config.json')
-				return {}
+				return
+
+		if cursor['username'] == self.session.username and not cursor['complete']:
+			self.offset = cursor['offset']
+			logging.info(f'Resuming connection crawl from offset {self.offset}')
 
 
 	def store(self):
+		atomic_write(self.cursor_path, json.dumps({
+			'username': self.session.username,
+			'offset': self.offset,
+			'complete': self.complete,
+			'updated': time.time()
+		}))
+
+
+	def reset(self):
+		if os.path.isfile(self.cursor_path):
+			os.remove(self.cursor_path)
+
+
+	def fetch_page(self, offset):
+		search = self.session.metrics.timed('search_connections', self.session.application.search_people)
+		return search(network_depths=['F'], limit=self.page_size, offset=offset)
+
+
+	def stop(self):
 		'''
-		Store history into configuration file
+		Stop yielding connections: the cursor stays on the first page with
+		profiles that were not fetched, so a later crawl picks them up
 		'''
-		if os.path.isfile('config.json'):
-			with open('config.json', 'r') as config_file:
-				config = json.load(config_file)
+		self.stopped.set()
 
-			with open('config.json', 'w') as config_file:
-				config['history'] = self.history
-				json.dump(config, config_file, indent=4)
-		else:
-			with open('config.json', 'w') as config_file:
-				config = {'users': {}, 'history': {}, 'theme': None}
-				config['history'] = self.history
-				json.dump(config, config_file, indent=4)
 
+	def done(self, profile_id, outcome):
+		'''
+		Observes the fetch outcomes: a profile stored, skipped or given up on is
+		finished, while a cancelled one still needs fetching
+		'''
+		if outcome == 'cancelled':
+			return
+
+		with self.lock:
+			page = self.outstanding.pop(profile_id, None)
+			if page is not None:
+				page.discard(profile_id)
 
-	def add(self, user_id, ignore_duplicates):
+
+	def advance(self):
 		'''
-		Add a user profile into history, with the current unix time stamp
+		Move the cursor past every page whose profiles have all finished.
+		Outcomes arrive out of order, so a page is only passed once each of
+		its own profiles has finished, not once enough profiles have.
 		'''
-		self.call_count += 1
-		not_added = False if user_id in self.history.values() else True
-		self.history[time.time()] = user_id
+		moved = False
+		with self.lock:
+			while len(self.pages) > 0 and len(self.pages[0][1]) == 0:
+				self.offset = self.pages.popleft()[0]
+				moved = True
 
-		return not_added if not ignore_duplicates else True
+		if moved:
+			self.store()
 
 
-	def check_validity(self):
+	def profiles(self, stats, duplicates):
 		'''
-		Checks if we have API calls left in our quota, and verifies
-		that the current profile is not a duplicate.
+		Yield the profile ID of every connection not stored yet. stats counts
+		the outcomes of the yielded profiles, duplicates the skipped ones.
 		'''
-		if self.parent_session.debug:
-			return True, None
+		self.load()
+		self.pages.clear()
+		self.outstanding.clear()
+		if self.done not in stats.observers:
+			stats.observers.append(self.done)
 
-		if self.call_count > self.hourly_limit:
-			filtered_history = {}
-			for key, val in self.history.items():
-				if time.time() - float(key) <= 3600:
-					filtered_history[key] = val
+		offset, yielded = self.offset, 0
 
-			self.call_count = len(filtered_history.keys())
-			if self.call_count > self.hourly_limit:
-				earliest_call = min([float(key) for key in self.history.keys()])
-				since_call = time.time() - earliest_call
-				return False, f'{int((3600 - since_call) / 60)} minutes'
+		while not self.stopped.is_set():
+			# keep search calls in step with profile fetches: at most two pages ahead
+			while len(self.outstanding) > 2 * self.page_size and not self.stopped.is_set():
+				time.sleep(0.5)
+				self.advance()
 
-		return True, None
+			self.session.breaker.wait()
+			try:
+				page = self.session.retry.call(self.fetch_page, offset)
+			except Exception as error:
+				logging.exception(f'Error listing connections at offset {offset}: {error}')
+				logging.info(traceback.format_exc())
+				print(f'⛔️ Error listing connections: {error}')
+				self.error = error
+				return
+
+			# private profiles are left out of the results, so a page may come back short
+			if len(page) == 0:
+				self.complete = True
+				return
+
+			page_ids = set()
+			for connection in page:
+				profile_id = connection.get('urn_id')
+				if profile_id is None or self.stopped.is_set():
+					continue
+
+				if not self.session.ignore_duplicates and self.session.index.contains_profile_id(profile_id):
+					duplicates.record('skipped')
+					self.session.metrics.increment('duplicates')
+					continue
+
+				with self.lock:
+					if profile_id in self.outstanding:
+						# listed again as the connections shifted: already on its way
+						continue
+
+					# tracked before it's yielded, as it may finish before the generator resumes
+					page_ids.add(profile_id)
+					self.outstanding[profile_id] = page_ids
+
+				yield profile_id
+				yielded += 1
+				self.advance()
+
+			if self.stopped.is_set():
+				# the rest of this page was never yielded: resume from its start
+				return
+
+			offset += self.page_size
+			with self.lock:
+				self.pages.append((offset, page_ids))
+
+			self.advance()
+			logging.info(f'Listed {offset} connections, {yielded} new')
+
+
+	def finish(self):
+		'''
+		Checkpoint the cursor once every yielded profile has been processed:
+		a page with unfinished profiles is crawled again next time
+		'''
+		self.advance()
+		if len(self.pages) > 0:
+			self.complete = False
+
+		self.store()
+
+
+class GUIOutput:
+	'''
+	A stdout replacement for the GUI. Tkinter widgets may only be touched from
+	the event thread, so printed text is buffered here and the event loop is
+	told to pick it up: prints from worker threads never block or race the GUI.
+	'''
+	def __init__(self, gui):
+		self.gui = gui
+		self.pending = []
+		self.posted = False
+		self.lock = threading.Lock()
+
+
+	def write(self, text):
+		with self.lock:
+			self.pending.append(text)
+			if self.posted:
+				return
+
+			self.posted = True
+
+		if not self.gui.post('-OUTPUT-'):
+			self.hold()
+
+
+	def flush(self):
+		pass
+
+
+	def drain(self):
+		'''
+		Take the buffered text: called from the event thread
+		'''
+		with self.lock:
+			text = ''.join(self.pending)
+			self.pending = []
+			self.posted = False
+
+		return text
+
+
+	def hold(self):
+		'''
+		Keep the buffered text for the next screen that shows output
+		'''
+		with self.lock:
+			self.posted = False
 
 
 class GUI:
@@ -103,9 +3378,111 @@ class GUI:
 		self.parent_session = session
 		self.window = None
 		self.secondary_window = None
+		self.output = GUIOutput(self)
+
+
+	def post(self, key, value=None):
+		'''
+		Send an event to the open window's event loop: safe from any thread.
+		Returns False if there is no window to send it to.
+		'''
+		window = self.window
+		if window is None or getattr(window, 'thread_queue', None) is None:
+			# not shown yet: write_event_value would print a warning, which comes back here
+			return False
+
+		try:
+			window.write_event_value(key, value)
+		except Exception as error:
+			logging.warning(f'Dropped GUI event {key}: {error}')
+			return False
+
+		return True
+
+
+	def run_in_background(self, key, function, *args):
+		'''
+		Run function on a worker thread, and post its return value, or the
+		exception it raised, as event key
+		'''
+		def run():
+			try:
+				result = function(*args)
+			except Exception as error:
+				logging.exception(error)
+				logging.info(traceback.format_exc())
+				result = error
+
+			self.post(key, result)
+
+		threading.Thread(target=run, name=key.strip('-').lower(), daemon=True).start()
+
+
+	def handle_event(self, event, values):
+		'''
+		Handle the events any screen can receive from worker threads: returns
+		True if the event was one of them
+		'''
+		if event == '-OUTPUT-':
+			if 'output_window' in self.window.key_dict:
+				self.window['output_window'].update(self.output.drain(), append=True)
+			else:
+				# no output on this screen: keep the text for the next one
+				self.output.hold()
+
+			return True
+
+		if event == '-NOTIFY-':
+			message, title = values[event]
+			sg.popup(message, title=title, keep_on_top=True)
+			return True
+
+		return False
+
+
+	def load_sheet(self):
+		'''
+		Count and open the chosen sheet on a worker thread, showing a loading
+		screen meanwhile. Returns True once the sheet is open.
+		'''
+		session = self.parent_session
+		self.window = sg.Window(
+			f'Liscrape version {session.version}',
+			[[sg.Text(f'Loading {session.sheet_path}...', font=('Helvetica', 11))]], finalize=True)
+
+		self.run_in_background('-SHEET-LOADED-', session.load_sheet)
+		while True:
+			event, values = self.window.read()
+			if event == '-SHEET-LOADED-':
+				break
+
+			self.handle_event(event, values)
+
+		self.window.close()
+		if isinstance(values[event], Exception):
+			sg.popup(f'Error loading {session.sheet_path}: {values[event]}', title='Error', keep_on_top=True)
+			return False
+
+		return True
+
+
+	def update_counters(self, pipeline):
+		session = self.parent_session
+		self.window['parsed'].update(f'{session.parsed} {"contact" if session.parsed == 1 else "contacts"} stored (this session)\t')
+		self.window['total_parsed'].update(f'Contacts in file: {session.total_parsed}\t')
+		# queued profiles wait in the rate limiter rather than being refused
+		waiting = ''
+		valid, time_until_next = session.history.check_validity()
+		if not valid and pipeline.remaining() > 0:
+			waiting = f', next API call in {time_until_next}'
+
+		self.window['progress'].update(
+			f'{pipeline.remaining()} in progress, {pipeline.pending()} queued, '
+			f'{pipeline.stats.counts["failed"]} failed{waiting}')
 
 
 	def display_signin_screen(self):
+		stored_logins = self.parent_session.load_configuration()
 		layout = [
 			[sg.Text('Sign in to Linkedin to continue', font=('Helvetica Bold', 11))],
 			[sg.Text('Username (email)', font=('Helvetica', 11), size=(15, None)), sg.InputText(key="username")],
@@ -113,8 +3490,8 @@ class GUI:
 			[	
 				sg.Text('Select a stored login', size=(15, None), font=('Helvetica', 11)),
 				sg.Listbox(
-					self.parent_session.load_configuration(), select_mode='LISTBOX_SELECT_MODE_SINGLE', 
-					enable_events=True, size=(40, 1 + len(self.parent_session.load_configuration())),
+					stored_logins, select_mode='LISTBOX_SELECT_MODE_SINGLE', 
+					enable_events=True, size=(40, 1 + len(stored_logins)),
 					key='-USERNAME-', no_scrollbar=True
 					)
 			],
@@ -125,22 +3502,22 @@ class GUI:
 				sg.Checkbox('Debug mode', key='debug_mode'),
 				sg.Checkbox('Dark theme' if self.parent_session.load_theme() == 'SystemDefault' else 'Light theme', key='theme_switch', enable_events=True),
 			],
-				[sg.Output(size=(80, 20), font=('Helvetica', 11), key='output_window')],
+				[sg.Multiline(size=(80, 20), font=('Helvetica', 11), key='output_window', autoscroll=True, disabled=True)],
 				[
 					sg.Button('Tools', font=('Helvetica', 11), key='debug_screen'),
 					sg.Button('Show log', font=('Helvetica', 11), key='show_log'), 
-					sg.Text(f'Log file length: {self.parent_session.get_log_length()} lines', key='log_length' , font=('Helvetica', 11))
+					sg.Text(f'Log file size: {self.parent_session.get_log_size() / 1e6:.1f} MB', key='log_length' , font=('Helvetica', 11))
 				]
 		]
 
-		self.window = sg.Window(f'Liscrape version {self.parent_session.version}', layout=layout, resizable=True, grab_anywhere=True)
+		self.window = sg.Window(f'Liscrape version {self.parent_session.version}', layout=layout, resizable=True, grab_anywhere=True, finalize=True)
 
 
 	def display_sheet_screen(self):
 		layout = [
 			[sg.Text('Choose file to store contacts in', font=('Helvetica', 11))],
 			[sg.FileBrowse(), sg.Input(key="sheet_path")],
-			[sg.Text('Supported file types: .xls, .xlsx, .xlsm, .csv', font=('Helvetica', 9))],
+			[sg.Text('Supported file types: .xls, .xlsx, .xlsm, .csv, .sqlite', font=('Helvetica', 9))],
 			[sg.Button('OK'), sg.Button('Use default')]
 		]
 
@@ -163,15 +3540,21 @@ class GUI:
 		layout = [
 			[sg.Text('Signed in as:', font=('Helvetica', 11)), sg.Text(f'{self.parent_session.username}', font=('Helvetica', 11), text_color='Blue')],
 			[sg.Text('Contact to store (URL)', font=('Helvetica', 11)), sg.InputText(key="profile_url")],
-			[sg.Button('Store contact', font=('Helvetica', 11)), sg.Text(f'{self.parent_session.parsed} contacts stored (this session)\t', key='parsed', font=('Helvetica', 11))],
-			[sg.Output(size=(60, 15), font=('Helvetica', 11))],
+			[
+				sg.Button('Store contact', font=('Helvetica', 11)),
+				sg.Text(f'{self.parent_session.parsed} contacts stored (this session)\t', key='parsed', font=('Helvetica', 11)),
+				sg.Button('Show stats', font=('Helvetica', 9)),
+				sg.Button('Store connections', font=('Helvetica', 9), key='connections')
+			],
+			[sg.Text('', key='progress', font=('Helvetica', 9), size=(50, None))],
+			[sg.Multiline(self.output.drain(), size=(60, 15), font=('Helvetica', 11), key='output_window', autoscroll=True, disabled=True)],
 			[
 				sg.Text(f'Contacts in file: {self.parent_session.total_parsed}', font=('Helvetica', 11), key='total_parsed', size=(15, None)), 
 				sg.Text(f'Session path: {self.parent_session.sheet_path}', font=('Helvetica', 11))
 			]]
 
 		self.window = sg.Window(title=f'Liscrape version {self.parent_session.version}',
-			layout=layout, resizable=True, grab_anywhere=True)
+			layout=layout, resizable=True, grab_anywhere=True, finalize=True)
 
 
 class Session:
@@ -185,51 +3568,175 @@ class Session:
 		self.sheet_path = None
 		self.sheet_type = None
 		self.default_sheet_type = 'excel'
+		self.sink = None
+
+		# csv output rotates to a new shard file past this size, if set
+		self.shard_bytes = None
 
 		# keep track of parse counts in memory
 		self.total_parsed = 0
 		self.parsed = 0
 
-		# additional options
-		self.log_filename = 'liscrape-log.log'
-		self.ignore_duplicates = False
-		self.debug = False
+		# additional options
+		self.log_filename = 'liscrape-log.jsonl'
+		self.log_max_bytes = 16 * 1024 * 1024
+		self.log_backups = 3
+		self.log_tail = 64 * 1024
+		self.log_handler = None
+		self.log_listener = None
+		self.ignore_duplicates = False
+		self.debug = False
+		self.mapper = FieldMapper()
+		self.headless = False
+		self.bulk = False
+		self.workers = 2
+		self.engine = 'threads'
+		self.account_pool = None
+		self.concurrency = 64
+
+		# gui
+		self.gui = GUI(self)
+
+		# configuration: stored logins and theme
+		self.config = Config()
+		self.config.load()
+
+		# duplicate index
+		self.index = ProfileIndex()
+		self.index.load()
+
+		# raw API responses: read_cache is off when responses must be fresh
+		self.cache = ResponseCache()
+		self.read_cache = True
+
+		# stage latencies, counters and gauges
+		self.metrics = Metrics()
+
+		# failed calls: retried with backoff, paused for when LinkedIn refuses, recorded when given up on
+		self.retry = RetryPolicy()
+		self.breaker = CircuitBreaker()
+		self.dead_letter = DeadLetter()
+
+		# contact info: skipped while its endpoint keeps failing, or fetched in a second pass
+		self.contact_breaker = CircuitBreaker(label='contact info requests')
+		self.defer_contact_info = False
+		self.contact_only = False
+		self.deferred = set()
+
+		# write-ahead journal: held while a profile is journalled and stored
+		self.journal = Journal()
+		self.store_lock = threading.RLock()
+
+		# history, load validity
+		self.history = History(self)
+		self.history.history = self.history.load()
+		self.history.check_validity()
+
+
+	def notify(self, message, title):
+		'''
+		Show a popup, or print the message when running without a GUI. Popups
+		from worker threads are shown by the event loop.
+		'''
+		if self.headless:
+			print(f'{title}: {message}')
+		elif threading.current_thread() is not threading.main_thread():
+			self.gui.post('-NOTIFY-', (message, title))
+		else:
+			sg.popup(message, title=title, keep_on_top=True)
+
+
+	def progress(self):
+		'''
+		Tell the GUI a queued profile has been processed
+		'''
+		if not self.headless:
+			self.gui.post('-PROGRESS-')
+
+
+	def start_log(self):
+		'''
+		Log to a size-rotated file of JSON lines. Records are queued, and
+		written by a listener thread, so logging never waits on the disk.
+		'''
+		file_handler = logging.handlers.RotatingFileHandler(
+			self.log_filename, maxBytes=self.log_max_bytes, backupCount=self.log_backups, encoding='utf-8')
+
+		# records are formatted before they're queued: the file gets them as they are
+		file_handler.setFormatter(logging.Formatter('%(message)s'))
+		self.log_handler = LogQueueHandler(queue.Queue(maxsize=10000))
+		self.log_handler.setFormatter(JsonLineFormatter())
+
+		root = logging.getLogger()
+		root.setLevel(logging.DEBUG)
+		root.addHandler(self.log_handler)
+
+		self.log_listener = LogListener(self.log_handler.queue, file_handler)
+		self.log_listener.start()
+
+		# the listener thread is a daemon: write out what's queued before exiting
+		atexit.register(self.stop_log)
 
-		# gui
-		self.gui = GUI(self)
 
-		# history, load validity
-		self.history = History(self)
-		self.history.history = self.history.load()
-		self.history.check_validity()
+	def stop_log(self):
+		'''
+		Write out queued records and close the log file
+		'''
+		if self.log_listener is None:
+			return
 
+		logging.getLogger().removeHandler(self.log_handler)
+		self.log_listener.stop()
+		for handler in self.log_listener.handlers:
+			handler.close()
 
-	def start_log(self):
-		logging.basicConfig(
-		filename=self.log_filename, level=logging.DEBUG,
-		format='%(asctime)s %(message)s', datefmt='%d/%m/%Y %H:%M:%S'
-		)
+		if self.log_handler.dropped > 0:
+			print(f'⚠️ {self.log_handler.dropped} log records were dropped')
+
+		self.log_handler, self.log_listener = None, None
 
 
-	def get_log_length(self):
+	def get_log_size(self):
 		if not os.path.isfile(self.log_filename):
 			return 0
 
-		with open(self.log_filename, 'r') as log_file:
-			return sum(1 for row in log_file)
+		return os.path.getsize(self.log_filename)
 
 
 	def load_log(self):
-		if self.get_log_length() == 0:
+		'''
+		The last log_tail bytes of the log, as readable text
+		'''
+		log_size = self.get_log_size()
+		if log_size == 0:
 			return '-- Log is empty --\n'
 
-		with open(session.log_filename, 'r') as log_file:
-			return log_file.read()
+		with open(self.log_filename, 'rb') as log_file:
+			log_file.seek(max(0, log_size - self.log_tail))
+			lines = log_file.read().decode('utf-8', errors='replace').splitlines()
+
+		# the first line was probably cut in half
+		if log_size > self.log_tail:
+			lines = lines[1:]
+
+		text = []
+		for line in lines:
+			try:
+				entry = json.loads(line)
+			except ValueError:
+				text.append(line)
+				continue
+
+			text.append(f"{entry['time']} {entry['level']} {entry['message']}")
+			if 'exception' in entry:
+				text.append(entry['exception'])
+
+		return '\n'.join(text) + '\n'
 
 
 	def clear_log(self):
 		try:
-			logging.shutdown()
+			self.stop_log()
 		except Exception as e:
 			sg.popup(traceback.format_exc())
 			logging.exception(f'Exception attempting to shutdown logging: {e}')
@@ -237,13 +3744,18 @@ class Session:
 
 		if os.path.isfile(self.log_filename):
 			os.remove(self.log_filename)
+			for backup in range(1, self.log_backups + 1):
+				if os.path.isfile(f'{self.log_filename}.{backup}'):
+					os.remove(f'{self.log_filename}.{backup}')
+
 			sg.popup(f'Log file {self.log_filename} successfully removed!')
 
-			# restart log, refresh log length
+			# restart log, refresh log size
 			self.start_log()
-			self.gui.window['log_length'].update(f'Log file length: {self.get_log_length()} lines')
+			self.gui.window['log_length'].update(f'Log file size: {self.get_log_size() / 1e6:.1f} MB')
 			self.gui.window['output_window'].update(self.load_log())
 		else:
+			self.start_log()
 			sg.popup('Nothing to remove!')
 
 
@@ -259,112 +3771,182 @@ class Session:
 
 	def clear_config(self):
 		self.history.history = {}
-		if os.path.isfile('config.json'):
-			with open('config.json', 'r') as config_file:
-				config = json.load(config_file)
-				users = config['users']
-
-			with open('config.json', 'w') as config_file:
-				config = {'users': users, 'history': {}, 'theme': None}
-				json.dump(config, config_file, indent=4)
-				sg.popup('Configuration file cleared!')
+		self.history.limiters = {}
+		self.history.store()
+		self.config.clear()
+		sg.popup('Configuration file cleared!')
 
 
 	def load_sheet_length(self):
-		if not os.path.isfile(self.sheet_path):
+		if not os.path.exists(self.sheet_path):
 			logging.info(f'Sheet {self.sheet_path} does not exist: returning total_parsed=0')
 			self.total_parsed = 0
 		else:
 			logging.info(f'Sheet {self.sheet_path} exists: getting length.')
-			if self.sheet_type == 'csv':
-				with open(self.sheet_path, 'r') as csv_file:
-					csv_reader = csv.reader(csv_file)
-					self.total_parsed = sum(1 for row in csv_reader)
+			cached_length = self.index.cached_length(self.sheet_path)
+			if cached_length is not None and self.sheet_type in ('csv', 'excel'):
+				logging.info(f'Sheet {self.sheet_path} unchanged: using stored length')
+				self.total_parsed = cached_length
+			elif self.sheet_type == 'csv':
+				# contacts, not counting each shard's header
+				self.total_parsed = sum(max(count_csv_records(shard_path) - 1, 0) for shard_path in csv_shards(self.sheet_path))
 			elif self.sheet_type == 'excel':
-				df = pd.read_excel(self.sheet_path)
-				self.total_parsed = len(df.index)
+				book = load_workbook(self.sheet_path, read_only=True)
+				self.total_parsed = max(count_excel_rows(book.worksheets[0]) - 1, 0)
+				book.close()
+			elif self.sheet_type == 'sqlite':
+				sink = SqliteSink(self.sheet_path, self.mapper.columns)
+				self.total_parsed = sink.row_count()
+				sink.close()
+			elif self.sheet_type == 'parquet':
+				import pyarrow.parquet
+				self.total_parsed = sum(pyarrow.parquet.read_metadata(part).num_rows for part in parquet_parts(self.sheet_path))
 
 		return self.total_parsed
 
 
-	def load_configuration(self):
-		if not os.path.isfile('config.json'):
-			return []
+	def load_sheet(self):
+		'''
+		Count the sheet's contacts and open it for writing
+		'''
+		self.load_sheet_length()
+		self.open_sink()
 
-		with open('config.json', 'r') as config_file:
-			try:
-				config = json.load(config_file)
-			except Exception as error:
-				logging.exception(error)
-				os.remove('config.json')
-				return ()
 
-			return tuple(config['users'].keys()) if len(config['users'].keys()) > 0 else ()
+	def set_sheet_path(self, sheet_path):
+		'''
+		Set the output sheet and infer its type from the extension
+		'''
+		if sheet_path.endswith('.sqlite') or sheet_path.endswith('.db'):
+			self.sheet_type = 'sqlite'
+		elif '.csv' in sheet_path:
+			self.sheet_type = 'csv'
+		elif '.xls' in sheet_path:
+			self.sheet_type = 'excel'
+		elif sheet_path.endswith('.parquet'):
+			self.sheet_type = 'parquet'
+		else:
+			return False
+
+		self.sheet_path = sheet_path
+		return True
 
 
-	def load_theme(self):
-		if not os.path.isfile('config.json'):
-			return 'SystemDefault'
+	def open_sink(self):
+		'''
+		Open the batched writer for the selected sheet, and seed the duplicate
+		index with the profiles already in it
+		'''
+		if self.sheet_type == 'parquet' or (self.bulk and self.sheet_type == 'excel'):
+			self.sink = FrameSink(self.sheet_path, self.sheet_type, self.mapper.columns)
+		elif self.sheet_type == 'csv':
+			# a batch run flushes less often
+			batch_size = 5000 if self.bulk else 500
+			self.sink = CsvSink(self.sheet_path, self.mapper.columns, batch_size, max_bytes=self.shard_bytes)
+		elif self.sheet_type == 'excel':
+			self.sink = ExcelSink(self.sheet_path, self.mapper.columns)
+		elif self.sheet_type == 'sqlite':
+			self.sink = SqliteSink(self.sheet_path, self.mapper.columns)
 
-		with open('config.json', 'r') as config_file:
-			try:
-				config = json.load(config_file)
-			except Exception as error:
-				logging.exception(error)
-				os.remove('config.json')
-				return ()
+		self.index.seed_from_sheet(self.sheet_path, self.sheet_type, self.sink)
 
-			try:
-				return config['theme'] if config['theme'] != None else 'SystemDefault'
-			except KeyError:
-				with open('config.json', 'r') as config_file:
-					config = json.load(config_file)
+		self.replay_journal()
+
+
+	def persist(self):
+		'''
+		Write out buffered profiles, history and the duplicate index
+		'''
+		if self.sink is not None:
+			self.sink.flush()
 
-				config['theme'] = None
-				with open('config.json', 'w') as config_file:
-					json.dump(config, config_file, indent=4)
+		self.history.store()
+		self.config.flush()
+		if self.sheet_path is not None:
+			self.index.store(self.sheet_path, self.total_parsed)
 
-				return self.load_theme()
+
+	def checkpoint(self):
+		'''
+		Persist everything, then empty the journal
+		'''
+		with self.store_lock:
+			self.journal.checkpoint(self.persist)
 
 
-	def save_theme(self, theme):
-		if not os.path.isfile('config.json'):
-			with open('config.json', 'w') as config_file:
-				config = {'users': {}, 'history': {}, 'theme': None}
-		else:
-			with open('config.json', 'r') as config_file:
-				config = json.load(config_file)
+	def replay_journal(self):
+		'''
+		Recover calls and fetched profiles journalled before a crash, without
+		repeating any API calls
+		'''
+		records, recovered = 0, 0
+		for record in self.journal.replay():
+			records += 1
+			if record['type'] == 'call':
+				self.history.restore(record['time'], record['profile'], record['account'])
+
+			elif record['type'] == 'profile':
+				profile_id = record['profile'].get('profile_id', '')
+				if profile_id in self.index.profile_ids:
+					if record['public_id'] is not None:
+						self.index.add_public_id(record['public_id'], profile_id)
+
+					continue
+
+				if self.store_profile(record['profile'], record['contact_info'], record['public_id']):
+					recovered += 1
+
+		if records > 0:
+			print(f'Recovered {recovered} profiles from an interrupted session')
+			logging.info(f'Replayed {records} journal records: {recovered} profiles recovered')
+			self.checkpoint()
+
+
+	def commit_profile(self, profile, contact_info, public_id=None, profile_dict=None):
+		'''
+		Journal a fetched profile, then store it: if the program dies in
+		between, the profile is recovered on the next start
+		'''
+		with self.store_lock:
+			self.journal.append({'type': 'profile', 'public_id': public_id, 'profile': profile, 'contact_info': contact_info})
+			stored = self.store_profile(profile, contact_info, public_id, profile_dict)
+
+		if self.journal.needs_checkpoint():
+			self.checkpoint()
+
+		return stored
+
+
+	def is_duplicate(self, public_id):
+		'''
+		Check the URL's public ID against the index before spending API calls on it
+		'''
+		return not self.ignore_duplicates and not self.debug and self.index.contains_public_id(public_id)
+
 
-		config['theme'] = theme
-		with open('config.json', 'w') as config_file:
-			json.dump(config, config_file, indent=4)
+	def load_configuration(self):
+		return self.config.users()
+
+
+	def load_theme(self):
+		return self.config.theme()
 
+
+	def save_theme(self, theme):
+		self.config.set_theme(theme)
 		return True
 
 
 	def load_password_from_config(self, username):
-		with open('config.json', 'r') as config_file:
-			config = json.load(config_file)
-
 		try:
-			return config['users'][username]
-		except:
-			sg.popup('Error finding password from configuration!', title='Error', keep_on_top=True)
+			return self.config.password(username)
+		except KeyError:
+			self.notify('Error finding password from configuration!', 'Error')
 			raise Exception('Error finding password from configuration!')
 
 
 	def store_login(self, username, password):
-		if not os.path.isfile('config.json'):
-			with open('config.json', 'w') as config_file:
-				config = {'users': {}, 'history': {}, 'theme': None}
-		else:
-			with open('config.json', 'r') as config_file:
-				config = json.load(config_file)
-
-		config['users'][username] = password
-		with open('config.json', 'w') as config_file:
-			json.dump(config, config_file, indent=4)
-
+		self.config.store_login(username, password)
 		return True
 
 
@@ -389,197 +3971,671 @@ class Session:
 		except Exception as error:
 			logging.exception(error)
 			if 'BAD_EMAIL' in error.args:
-				sg.popup('Incorrect email: try again.', title='Incorrect email', keep_on_top=True)
+				self.notify('Incorrect email: try again.', 'Incorrect email')
 			elif 'CHALLENGE' in error.args:
-				sg.popup('Error: LinkedIn requires a sign-in challenge.', title='Linkedin error', keep_on_top=True)
+				self.notify('Error: LinkedIn requires a sign-in challenge.', 'Linkedin error')
 			elif 'Expecting value: line 1 column 1 (char 0)' in error.args:
-				sg.popup('Linkedin is refusing to sign in. Please try again later.', title='Unable to sign in', keep_on_top=True)
+				self.notify('Linkedin is refusing to sign in. Please try again later.', 'Unable to sign in')
 			else:
-				sg.popup(f'Error arguments: {error.args}\n{traceback.format_exc()}', title='Unhandled exception', keep_on_top=True)
+				self.notify(f'Error arguments: {error.args}\n{traceback.format_exc()}', 'Unhandled exception')
 
 			return False
 
 
-	# perform the API calls
-	def linkedin_api_call(self, queue, event):
-		while not event.is_set() or not queue.empty():
-			profile_url = queue.get()
-			if not self.debug:
-				try:
-					# two API requests: profile and contact info
-					profile = self.application.get_profile(profile_url)
-				except Exception as error:
-					logging.exception(f'Error loading profile: {error}')
-					logging.info(traceback.format_exc())
-					return None
-				try:
-					contact_info = self.application.get_profile_contact_info(profile_url)
-				except Exception as error:
-					logging.exception(f'Error loading contact info: {error}')
-					logging.info(traceback.format_exc())
-					contact_info = {}
-			else:
-				try:
-					# a sample profile for debugging purposes
-					profile = {'lastName': 'SquarePants', 'firstName': 'SpongeBob', 'industryName': 'Professional retard', 'profile_id': f'DEBUG-{random.randint(0,99999)}'}
-					contact_info = {'email_address': 'squarepants@bikinibottom.com', 'websites': ['square@pants.bk'], 'twitter': '@pants', 'phone_numbers': ['+001']}
-				except Exception as error:
-					logging.exception(f'Error loading profile: {error}')
-					print(f'⛔️ Error loading profile: {error}')
-					return None
-
-			self.store_profile(profile, contact_info)
-
-
-	def store_profile(self, profile, contact_info):
-		def set_diff(dict, full_set):
-			'''
-			Calculate the difference between the full key set and the provided key set.
-			Return the keys that exist in the dictionary, so the missing ones can be
-			set to Nonetypes.
-			'''
-			ignored_keys = {key for key in full_set if key not in dict.keys()}
-			return full_set.difference(ignored_keys)
-
-		# the full set of keys a complete profile would have
-		profile_keys_full = {
-		'firstName', 'lastName', 'profile_id', 'headline', 
-		'summary', 'industryName', 'geoCountryName', 'languages'}
-		
-		contact_keys_full = {'birthdate', 'email_address', 'phone_numbers'}
-
-		# if the profile is lacking keys, replace their values with Nonetypes
-		profile_keys = set_diff(profile, profile_keys_full)
-		contact_keys = set_diff(contact_info, contact_keys_full)
-
-		# map profile keys to CRM-compatible column names
-		column_map = {
-		'firstName': 'First name',
-		'lastName': 'Last name',
-		'profile_id': 'Linkedin profile ID',
-		'headline': 'Linkedin headline',
-		'summary': 'Linkedin summary',
-		'industryName': 'Industry',
-		'geoCountryName': 'Location',
-		'languages': 'Languages',
-		'birthdate': 'Birthday',
-		'email_address': 'Email address',
-		'phone_numbers': 'Phone number'
-		}
+	def acquire_account(self, profile_id):
+		'''
+		Wait for a slot in the quota. Returns the account to make the call
+		with: None means the session's own login.
+		'''
+		wait_start = time.time()
+		if self.account_pool is None:
+			if not self.history.acquire(profile_id):
+				raise Exception('Closed while waiting for the API call limit')
 
-		# generate the profile: this is stored later
-		profile_dict = {}
+			self.record_wait(time.time() - wait_start)
+			return None
 
-		# generate the profile_dict: map API resp. keys to column names, add Nonetypes
-		for key in profile_keys_full:
-			if key == 'languages' and key in profile_keys:
-				# languages: a list of dictionaries with name:value
-				try:
-					if type(profile['languages']) == list:
-						if len(profile['languages']) != 0:
-							language_string = ''
-							for dict in profile['languages']:
-								language_string += dict['name']
-								language_string += ', '
+		account = self.account_pool.acquire(profile_id)
+		self.record_wait(time.time() - wait_start)
+		if account is None:
+			raise Exception('No signed-in accounts left in rotation')
 
-							profile['languages'] = language_string[0:-2]
-						else:
-							profile['languages'] = ''
+		return account
 
-				except Exception as e:
-					profile['languages'] = ''
-					logging.exception(f'Error setting language: {e}')
-					logging.info(traceback.format_exc())
 
+	def record_wait(self, seconds):
+		'''
+		Count the time spent waiting for the rate limiter
+		'''
+		if seconds > 0.01:
+			self.metrics.increment('rate_limit_waits')
+			self.metrics.observe('rate_limit_wait', seconds)
 
-			if key in profile_keys:
-				profile_dict[column_map[key]] = profile[key]
-			else:
-				profile_dict[column_map[key]] = ''
 
-		# same as above, but for contact keys
-		for key in contact_keys_full:
-			if key == 'phone_numbers' and key in contact_keys:
-				try:
-					for val in contact_info['phone_numbers']:
-						if len(contact_info['phone_numbers']) > 0:
-							numbers = ''
-							for dict in contact_info['phone_numbers']:
-								numbers += dict['number']
-								numbers += f' ({dict["type"]})'
-								numbers += ', '
-
-					contact_info['phone_numbers'] = numbers[0:-2]
-				except:
-					contact_info['phone_numbers'] = ''
-
-			if key in contact_keys:
-				profile_dict[column_map[key]] = contact_info[key]
-			else:
-				profile_dict[column_map[key]] = ''
+	def fetch_profile(self, profile_id, executor=None, account=None):
+		'''
+		Perform the API requests for a profile: the profile, its contact info,
+		and its skills if a column needs them. Returns a tuple of (profile,
+		contact_info), and raises if the profile could not be loaded.
+		If an executor is given, the two requests are made in parallel.
+		Contact info is retried on its own, and left empty if it keeps failing.
+		'''
+		if self.debug:
+			# a sample profile for debugging purposes
+			profile = {'lastName': 'SquarePants', 'firstName': 'SpongeBob', 'industryName': 'Professional retard', 'profile_id': f'DEBUG-{random.randint(0,99999)}'}
+			contact_info = {'email_address': 'squarepants@bikinibottom.com', 'websites': ['square@pants.bk'], 'twitter': '@pants', 'phone_numbers': ['+001']}
+			return profile, contact_info
+
+		application = self.application if account is None else account.application
+		get_profile = self.metrics.timed('get_profile', application.get_profile)
+		get_skills = self.metrics.timed('get_profile_skills', application.get_profile_skills)
+		get_contact_info = self.metrics.timed('get_profile_contact_info', application.get_profile_contact_info)
+		wanted = self.fetch_requests()
+		wants_profile, wants_skills, wants_contact_info = wanted
+
+		contact_future = None
+		if executor is not None and wants_contact_info and wants_profile:
+			contact_future = executor.submit(get_contact_info, profile_id)
+
+		profile, skills, contact_info = None, None, None
+		try:
+			if wants_profile:
+				# checked before spending a skills request on it
+				profile = get_profile(profile_id)
+				check_profile(profile_id, profile)
+
+			if wants_skills:
+				skills = get_skills(profile_id)
+		except Exception:
+			if contact_future is not None:
+				contact_future.cancel()
+
+			raise
+
+		if wants_contact_info:
+			try:
+				if contact_future is not None:
+					contact_info = contact_future.result()
+				else:
+					contact_info = get_contact_info(profile_id)
+			except Exception as error:
+				contact_info = error
+
+		return self.fetch_result(application, profile_id, wanted, profile, skills, contact_info)
+
+
+	def fetch_requests(self):
+		'''
+		The API requests a fetch makes, for both fetch engines: whether to
+		request the profile, its skills and its contact info
+		'''
+		wants_profile = not self.contact_only
+		wants_skills = wants_profile and self.mapper.needs_skills
+		return wants_profile, wants_skills, self.contact_only or self.wants_contact_info()
+
+
+	def fetch_result(self, application, profile_id, wanted, profile=None, skills=None, contact_info=None):
+		'''
+		Build a fetch's (profile, contact_info) from the responses to the
+		requests fetch_requests wanted, for both fetch engines. A response
+		may be the exception its request raised: a failed profile or skills
+		request raises, failed contact info is retried on its own.
+		'''
+		wants_profile, wants_skills, wants_contact_info = wanted
+		if not wants_profile:
+			# the rest of the row is already stored
+			profile = {'profile_id': profile_id}
+		else:
+			if isinstance(profile, Exception):
+				raise profile
+
+			check_profile(profile_id, profile)
+			if wants_skills:
+				if isinstance(skills, Exception):
+					raise skills
+
+				profile = {**profile, 'skills': skills}
+
+		if not wants_contact_info:
+			# None, unlike an empty response, says contact info was never requested
+			self.cache_response(profile_id, profile, None)
+			return profile, None
+
+		if isinstance(contact_info, Exception):
+			contact_info = self.retry_contact_info(application, profile_id, contact_info)
+			if contact_info is None:
+				return profile, {}
+
+		self.contact_breaker.record_success()
+		if wants_profile:
+			self.cache_response(profile_id, profile, contact_info)
+
+		return profile, contact_info
+
+
+	def wants_contact_info(self):
+		'''
+		Whether to request contact info along with a profile: not when no
+		column needs it, when it's deferred to a second pass, or while the
+		contact info endpoint keeps failing
+		'''
+		return self.mapper.needs_contact_info and not self.defer_contact_info and self.contact_breaker.remaining() == 0
+
+
+	def retry_contact_info(self, application, profile_id, error):
+		'''
+		Retry a failed contact info request with backoff: returns the contact
+		info, or None if it can't be loaded
+		'''
+		try:
+			if not is_transient(error):
+				raise error
+
+			get_contact_info = self.metrics.timed('get_profile_contact_info', application.get_profile_contact_info)
+			return self.retry.call(get_contact_info, profile_id, attempt=1)
+		except Exception as error:
+			logging.exception(f'Error loading contact info: {error}')
+			logging.info(traceback.format_exc())
+			print(f'⚠️ No contact info for {profile_id}: {error}')
+			self.contact_breaker.record_failure()
+			return None
+
+
+	def handle_fetch_error(self, profile_id, error, account, attempt):
+		'''
+		Decide what to do after a failed fetch. Returns the seconds to wait
+		before trying again, or None to give up, recording the profile in the
+		dead-letter file.
+		'''
+		if is_challenge(error):
+			if account is not None:
+				# take the challenged account out of rotation, retry on another one
+				self.account_pool.retire(account)
+				return 0
+
+			# every call would hit the same challenge: pause everything
+			self.breaker.trip()
+		elif is_transient(error):
+			self.breaker.record_failure()
+
+		if (is_challenge(error) and attempt < self.retry.attempts) or self.retry.should_retry(error, attempt):
+			self.metrics.increment('retries')
+			delay = self.retry.delay(attempt)
+			logging.warning(f'Retrying {profile_id} in {delay:.1f} s after error: {error}')
+			return delay
+
+		logging.exception(f'Error loading profile {profile_id}: {error}', exc_info=error)
+		print(f'⛔️ Error loading profile {profile_id}: {error}')
+		self.metrics.increment('failures')
+		self.dead_letter.add(profile_id, error)
+		return None
+
+
+	def cached_profile(self, profile_id):
+		'''
+		Return a cached (profile, contact_info) response, or None
+		'''
+		if self.cache is None or not self.read_cache or self.debug or profile_id is None:
+			return None
+
+		response = self.cache.get(profile_id)
+		if response is not None and response[1] is None and self.wants_contact_info():
+			# cached without contact info, which is wanted now
+			return None
+
+		if response is not None and self.mapper.needs_skills and 'skills' not in response[0]:
+			return None
+
+		if response is not None:
+			self.metrics.increment('cache_hits')
+
+		return response
+
+
+	def cache_response(self, profile_id, profile, contact_info):
+		if self.cache is not None and profile_id is not None:
+			self.cache.put(profile_id, profile, contact_info)
+
+
+	def rebuild_from_cache(self, url_file=None):
+		'''
+		Store cached profiles into the sheet with no network calls: every
+		cached profile, or only the URLs in url_file
+		'''
+		stats = FetchStatistics()
+		start = time.time()
+
+		def cached_entries(url_file):
+			for profile_id in self.batch_profiles(url_file, stats):
+				response = self.cache.get(profile_id)
+				if response is None:
+					print(f'⛔️ Profile {profile_id} is not cached')
+					stats.record('failed')
+					continue
+
+				yield profile_id, response[0], response[1]
+
+		entries = self.cache.entries() if url_file is None else cached_entries(url_file)
+		for public_id, profile, contact_info in entries:
+			stored = self.store_profile(profile, contact_info, public_id)
+			stats.record('stored' if stored else 'skipped')
+
+		self.checkpoint()
+
+		stats = stats.summary()
+		stats['elapsed'] = time.time() - start
+		stats['profiles_per_second'] = stats['stored'] / stats['elapsed'] if stats['elapsed'] > 0 else 0
+		return stats
+
+
+	def batch_profiles(self, url_file, duplicates):
+		'''
+		Yield the profile ID on each line of url_file, skipping blank lines,
+		comments and profiles already stored. duplicates counts the skipped ones.
+		'''
+		for line in url_file:
+			if line.strip() == '' or line.startswith('#'):
+				continue
+
+			profile = parse_profile_url(line)
+			logging.info(f'Parsing profile {profile}')
+
+			if self.is_duplicate(profile):
+				print(f'⚠️ Duplicate detected ({profile})')
+				duplicates.record('skipped')
+				self.metrics.increment('duplicates')
+				continue
+
+			yield profile
+
+
+	def run_batch(self, url_file):
+		'''
+		Fetch and store every profile URL in url_file, one line at a time,
+		without the GUI. Returns a dictionary of throughput statistics.
+		'''
+		return self.run_profiles(lambda stats, duplicates: self.batch_profiles(url_file, duplicates))
+
+
+	def crawl_connections(self, crawler, pipeline=None):
+		'''
+		Fetch and store the signed-in account's first-degree connections that
+		are not stored yet. Returns a dictionary of throughput statistics. If a
+		running pipeline is given, the connections are a batch in it, behind
+		any profiles submitted interactively.
+		'''
+		if pipeline is None:
+			stats = self.run_profiles(crawler.profiles)
+			crawler.finish()
+			return stats
+
+		duplicates = FetchStatistics()
+		batch_stats = pipeline.add_batch('connections')
+		for profile in crawler.profiles(batch_stats, duplicates):
+			pipeline.submit(profile, 'connections')
+
+		pipeline.wait_for_batch('connections')
+		crawler.finish()
+
+		stats = batch_stats.summary()
+		stats['skipped'] += duplicates.counts['skipped']
+		return stats
+
+
+	def enrich_sheet(self, enricher):
+		'''
+		Re-fetch the stale rows of the sheet and update them in place. Returns
+		a dictionary of throughput statistics, with the rows updated.
+		'''
+		# fetched rows go to the staging database, with the sheet's own columns
+		only = [key for key, column in {**COLUMN_MAP, **EXTRA_COLUMNS}.items() if column in enricher.header]
+		saved = (self.sink, self.mapper, self.ignore_duplicates, self.read_cache, self.parsed, self.total_parsed)
+		# a contact info pass doesn't refresh the rest of the row, so isn't a fetch time
+		self.mapper = FieldMapper(only=only if self.contact_only else only + ['fetched'])
+		enricher.open(self.mapper.columns)
+
+		# every stale row is already stored: refreshing it is not a duplicate
+		self.sink, self.ignore_duplicates, self.read_cache = enricher.staging, True, False
+		try:
+			stats = self.run_profiles(enricher.profiles)
+		finally:
+			self.sink, self.mapper, self.ignore_duplicates, self.read_cache, self.parsed, self.total_parsed = saved
+
+		stats['selected'] = enricher.selected
+		stats['updated'] = enricher.rewrite()
+
+		# the same contacts in a new file: keep the index from re-reading it
+		self.index.store(self.sheet_path, self.total_parsed)
+		return stats
+
+
+	def run_profiles(self, profile_source):
+		'''
+		Fetch and store every profile ID from profile_source, a function
+		returning an iterable: it is called with the fetch outcome statistics,
+		and the statistics to count skipped duplicates in.
+		'''
+		duplicates = FetchStatistics()
+		start = time.time()
+
+		if self.engine == 'async':
+			# two requests per profile in flight
+			client = AsyncLinkedinClient(getattr(self, 'application', None), 2 * self.concurrency, self.metrics)
+			if self.account_pool is not None:
+				for account in self.account_pool.accounts:
+					client.mount(account.application)
+
+			engine = AsyncFetchEngine(self, client, self.concurrency)
+			try:
+				stats = asyncio.run(engine.run(profile_source(engine.stats, duplicates)))
+			finally:
+				client.close()
+		else:
+			# past the scheduler's memory cap, URLs are read as the workers take them
+			with FetchPipeline(self, self.workers) as pipeline:
+				batch_stats = pipeline.add_batch('batch')
+				for profile in profile_source(batch_stats, duplicates):
+					if not pipeline.submit(profile, 'batch'):
+						duplicates.record('skipped')
+						self.metrics.increment('duplicates')
+
+			stats = pipeline.stats.summary()
+
+		self.checkpoint()
+
+		stats['skipped'] += duplicates.counts['skipped']
+		stats['elapsed'] = time.time() - start
+		stats['profiles_per_second'] = stats['stored'] / stats['elapsed'] if stats['elapsed'] > 0 else 0
+		return stats
+
+
+	def normalise(self, profile, contact_info, public_id=None):
+		'''
+		Map a response to a sheet row: done on the fetch workers, off the writer
+		'''
+		with self.metrics.timer('normalise'):
+			profile_dict = self.mapper.row(profile, contact_info, public_id)
 
 		logging.info(f'profile_dict generated: {profile_dict}')
+		return profile_dict
+
+
+	def store_profile(self, profile, contact_info, public_id=None, profile_dict=None):
+		'''
+		Store a row for a response, normalising it unless profile_dict is given.
+		Only called with store_lock held, or before any workers are started.
+		'''
+		if profile_dict is None:
+			profile_dict = self.normalise(profile, contact_info, public_id)
+
+		# remember which profile the URL points to, so the next paste is caught before the API calls
+		if public_id is not None:
+			self.index.add_public_id(public_id, profile_dict['Linkedin profile ID'])
 
 		# if this contact is not a duplicate, or we are ignoring duplicates, continue: else, return
 		if not self.history.add(profile_dict['Linkedin profile ID'], self.ignore_duplicates):
 			#sg.popup('This profile has already been added: avoiding duplicate.', font=('Helvetica', 11), title='Duplicate', keep_on_top=True)
 			print(f'⚠️ Duplicate detected ({profile_dict["Linkedin profile ID"]})\n')
-			return
-
-		if self.sheet_type == 'csv':
-			field_names = profile_dict.keys()
-			if not os.path.isfile(self.sheet_path) and self.sheet_type == 'csv':
-				with open(self.sheet_path, 'w', newline='') as csv_file:
-					csv.DictWriter(csv_file, fieldnames=field_names).writeheader()
-					print(f'Created file: {self.sheet_path}')
-
-			with open(self.sheet_path, 'a', newline='') as csv_file:
-				csv.DictWriter(csv_file, fieldnames=field_names).writerow(profile_dict)
+			self.metrics.increment('duplicates')
+			return False
 
-		elif self.sheet_type == 'excel':
-			# convert dictionary to a dataframe
-			for key, val in profile_dict.items():
-				profile_dict[key] = [val]
-			try:
-				df = pd.DataFrame(profile_dict, columns=column_map.values())
-			except Exception as error:
-				logging.exception(f'Exception creating df: {error}')
-				logging.info(traceback.format_exc())
+		with self.metrics.timer('sheet_write'):
+			self.sink.add(profile_dict)
 
-			# store (file exists)
-			if os.path.isfile(self.sheet_path):
-				try:
-					book = load_workbook(self.sheet_path)
-					with pd.ExcelWriter(self.sheet_path, engine='openpyxl') as writer:
-						writer.book = book
-						writer.sheets = {ws.title: ws for ws in book.worksheets}
-						for sheetname in writer.sheets:
-							df.to_excel(
-							writer, sheet_name=sheetname, 
-							startrow=writer.sheets[sheetname].max_row, 
-							index = False, header= False
-							)
-
-				except Exception as e:
-					logging.exception(f'Error storing profile in file: {e}')
-					logging.info(traceback.format_exc())
-			else:
-				try:
-					with pd.ExcelWriter(self.sheet_path, engine='openpyxl') as writer:
-						df.to_excel(writer, sheet_name='Sheet1', index=False, header=True)
+		# stored without the contact info it needs: left for a second pass
+		if contact_info is None and self.mapper.needs_contact_info:
+			self.deferred.add(profile_dict['Linkedin profile ID'])
 
-				except Exception as e:
-					logging.exception(f'Error storing first profile in file: {e}')
-					logging.info(traceback.format_exc())
+		self.metrics.increment('stored')
 
 		print(f'✅ Stored profile {profile_dict["Linkedin profile ID"]} to {self.sheet_path}\n')
 		logging.info(f'Stored profile {profile_dict["Linkedin profile ID"]} to {self.sheet_path}')
 
 		self.parsed += 1
 		self.total_parsed += 1
+		return True
+
+
+def finish_metrics(session, args):
+	'''
+	Write the final metrics, and print them if asked to
+	'''
+	session.metrics.stop()
+	if args.stats:
+		print(session.metrics.summary())
+
+
+def batch_main(args):
+	'''
+	Headless entry point: sign in, then scrape every URL in the input file
+	'''
+	session = Session()
+	session.headless = True
+	session.bulk = True
+	session.debug = args.debug
+	session.ignore_duplicates = args.ignore_duplicates
+	session.workers = args.workers
+	session.mapper = FieldMapper(args.columns, args.only)
+	session.defer_contact_info = args.defer_contact_info
+	session.shard_bytes = None if args.shard_size is None else int(args.shard_size * 1024 * 1024)
+	session.engine = args.engine
+	session.concurrency = args.concurrency
+	session.start_log()
+
+	if args.metrics_file is not None or args.metrics_port is not None:
+		session.metrics.start_exporter(args.metrics_file, args.metrics_port)
+
+	if args.no_cache:
+		session.cache = None
+	else:
+		session.cache.ttl = args.cache_ttl * 86400
+
+	if not session.set_sheet_path(args.out):
+		print(f'Unsupported output file type: {args.out}')
+		return 1
+
+	if args.from_cache:
+		if session.cache is None:
+			print('--from-cache cannot be combined with --no-cache')
+			return 1
+
+		session.load_sheet_length()
+		session.open_sink()
+		if args.urls is None:
+			stats = session.rebuild_from_cache()
+		elif args.urls == '-':
+			stats = session.rebuild_from_cache(sys.stdin)
+		else:
+			with open(args.urls, 'r') as url_file:
+				stats = session.rebuild_from_cache(url_file)
+
+		print(f"Stored {stats['stored']} cached profiles in {stats['elapsed']:.1f} s, {stats['skipped']} duplicates, {stats['failed']} not cached")
+		finish_metrics(session, args)
+		return 0
+
+	retry_path = None
+	if args.retry_failed:
+		retry_path = session.dead_letter.take()
+		if retry_path is None:
+			print(f'No failed profiles to retry in {session.dead_letter.dead_letter_path}')
+			return 0
+
+		args.urls = retry_path
+
+	if (args.connections or args.enrich) and (args.urls is not None or session.debug):
+		print('--connections and --enrich take no URL file, and need a signed-in account')
+		return 1
+
+	if args.enrich and (session.sheet_type not in ('csv', 'excel') or not os.path.isfile(session.sheet_path)):
+		print('--enrich works on an existing .csv or .xlsx output file')
+		return 1
+
+	if args.defer_contact_info and session.sheet_type not in ('csv', 'excel'):
+		print('--defer-contact-info works on .csv or .xlsx output files')
+		return 1
+
+	if (args.enrich or args.defer_contact_info) and session.sheet_type == 'excel' and os.path.isfile(session.sheet_path) and len(excel_sheet_names(session.sheet_path)) > 1:
+		print('--enrich and --defer-contact-info rewrite the sheet, and only work on single-sheet workbooks')
+		return 1
+
+	if args.shard_size is not None and session.sheet_type != 'csv':
+		print('--shard-size works on .csv output files')
+		return 1
+
+	# rows are updated in place, which a sheet split across shard files doesn't allow
+	sharded = session.shard_bytes is not None or (session.sheet_type == 'csv' and len(csv_shards(session.sheet_path)) > 1)
+	if (args.enrich or args.defer_contact_info) and sharded:
+		print('--enrich and --defer-contact-info do not work on sharded .csv output')
+		return 1
+
+	if args.urls is None and not args.connections and not args.enrich:
+		print('Specify a file of profile URLs, or - for stdin')
+		return 1
+
+	if session.debug:
+		session.username = 'debug user'
+		session.authenticated = True
+	elif args.accounts is not None:
+		usernames = args.accounts if len(args.accounts) > 0 else session.load_configuration()
+		session.account_pool = AccountPool(session)
+		if session.account_pool.sign_in(usernames, args.refresh_cookies) == 0:
+			print('Failed to sign in.')
+			return 1
+
+		session.username = session.account_pool.accounts[0].username
+		session.application = session.account_pool.accounts[0].application
+		session.authenticated = True
+	else:
+		username = args.username
+		if username is None:
+			stored_logins = session.load_configuration()
+			if len(stored_logins) == 0:
+				print('No stored login found: specify one with --username')
+				return 1
+
+			username = stored_logins[0]
+
+		if username in session.load_configuration():
+			password = session.load_password_from_config(username)
+		else:
+			password = getpass.getpass(f'Password for {username}: ')
+
+		print(f'Signing in as {username}...')
+		if not session.sign_in(username, password, False, args.refresh_cookies):
+			print('Failed to sign in.')
+			return 1
+
+	session.load_sheet_length()
+	session.open_sink()
+
+	crawler = None
+	if args.connections:
+		crawler = ConnectionCrawler(session)
+		if args.restart_crawl:
+			crawler.reset()
+
+		print('Fetching first-degree connections...')
+		stats = session.crawl_connections(crawler)
+	elif args.enrich:
+		max_age = None if args.older_than is None else args.older_than * 86400
+		stats = session.enrich_sheet(SheetEnricher(session.sheet_path, session.sheet_type, max_age))
+		print(f"Updated {stats['updated']} of {stats['selected']} stale rows in {session.sheet_path}")
+	elif args.urls == '-':
+		stats = session.run_batch(sys.stdin)
+	else:
+		with open(args.urls, 'r') as url_file:
+			stats = session.run_batch(url_file)
+
+	# profiles that failed again are back in the dead-letter file
+	if retry_path is not None:
+		os.remove(retry_path)
+
+	if args.defer_contact_info and len(session.deferred) > 0:
+		# contact info only, for the rows just stored
+		print(f'Fetching contact info for {len(session.deferred)} profiles...')
+		session.sink.close()
+		session.defer_contact_info, session.contact_only = False, True
+		enricher = SheetEnricher(session.sheet_path, session.sheet_type, profile_ids=session.deferred)
+		contact_stats = session.enrich_sheet(enricher)
+		session.contact_only = False
+		print(f"Added contact info to {contact_stats['updated']} of {contact_stats['selected']} rows in {session.sheet_path}")
+		stats['failed'] += contact_stats['failed']
+
+	print(
+		f"Stored {stats['stored']} profiles in {stats['elapsed']:.1f} s ({stats['profiles_per_second']:.2f} profiles/s), "
+		f"{stats['skipped']} duplicates, {stats['failed']} failures")
+	print(
+		f"API latency: p50 {stats['latency_p50']:.2f} s, p90 {stats['latency_p90']:.2f} s, "
+		f"p99 {stats['latency_p99']:.2f} s")
+
+	if stats['failed'] > 0:
+		print(f"Failed profiles were saved to {session.dead_letter.dead_letter_path}: retry them with --retry-failed")
+
+	if crawler is not None and not crawler.complete:
+		print(f'Stopped at connection {crawler.offset}: run again to resume from there')
+
+	finish_metrics(session, args)
+
+	if crawler is not None and crawler.error is not None:
+		return 2
+
+	return 0 if stats['failed'] == 0 else 2
+
+
+def parse_arguments():
+	parser = argparse.ArgumentParser(description='Scrape Linkedin profiles into a spreadsheet')
+	subparsers = parser.add_subparsers(dest='command')
+
+	batch_parser = subparsers.add_parser('batch', help='scrape profile URLs from a file without the GUI')
+	batch_parser.add_argument('urls', nargs='?', help='file with one profile URL per line, or - for stdin')
+	batch_parser.add_argument('--out', default='linkedin_scrape.xlsx', help='output .csv, .xlsx, .sqlite or .parquet file')
+	batch_parser.add_argument('--username', help='stored login to sign in with (default: first stored login)')
+	batch_parser.add_argument(
+		'--accounts', nargs='*', metavar='USERNAME',
+		help='spread calls across several stored logins (default: all of them)')
+	batch_parser.add_argument('--refresh-cookies', action='store_true', help='refresh stored session cookies')
+	batch_parser.add_argument('--connections', action='store_true', help="scrape the signed-in account's first-degree connections")
+	batch_parser.add_argument('--restart-crawl', action='store_true', help='page through connections from the start, not from where the last crawl stopped')
+	batch_parser.add_argument('--enrich', action='store_true', help='re-fetch the rows of --out that have no email or phone number, and update them in place')
+	batch_parser.add_argument('--older-than', type=float, metavar='DAYS', help='with --enrich, also re-fetch rows last fetched more than DAYS ago')
+	batch_parser.add_argument('--retry-failed', action='store_true', help='retry the profiles that failed in earlier runs')
+	batch_parser.add_argument('--shard-size', type=float, metavar='MB', help='start a new .csv file (contacts.1.csv, contacts.2.csv...) once the current one reaches this size')
+	batch_parser.add_argument('--ignore-duplicates', action='store_true', help='store profiles that are already in history')
+	batch_parser.add_argument(
+		'--columns', nargs='+', default=[], choices=EXTRA_COLUMNS.keys(),
+		help='extra columns to store: skills take one more API request per profile')
+	batch_parser.add_argument(
+		'--only', nargs='+', metavar='COLUMN', choices=[*COLUMN_MAP.keys(), *EXTRA_COLUMNS.keys()],
+		help='store only these columns (and the profile ID): contact info is not requested unless a contact column is given')
+	batch_parser.add_argument(
+		'--defer-contact-info', action='store_true',
+		help='store profiles first, then fetch their contact info in a second pass (.csv and .xlsx output only)')
+	batch_parser.add_argument('--workers', type=int, default=2, help='number of concurrent fetch workers')
+	batch_parser.add_argument('--engine', choices=('threads', 'async'), default='threads', help='fetch engine to use')
+	batch_parser.add_argument('--concurrency', type=int, default=64, help='profiles in flight with the async engine')
+	batch_parser.add_argument('--from-cache', action='store_true', help='store cached profiles only, with no network calls (all of them if no URLs are given)')
+	batch_parser.add_argument('--cache-ttl', type=float, default=30, help='days before a cached response expires')
+	batch_parser.add_argument('--no-cache', action='store_true', help='neither read nor write cached responses')
+	batch_parser.add_argument('--stats', action='store_true', help='print per-stage timings and counters when done')
+	batch_parser.add_argument('--metrics-file', metavar='PATH', help='keep Prometheus-format metrics up to date in this file')
+	batch_parser.add_argument('--metrics-port', type=int, metavar='PORT', help='serve Prometheus-format metrics on 127.0.0.1:PORT/metrics')
+	batch_parser.add_argument('--debug', action='store_true', help='use a sample profile instead of the API')
+
+	export_parser = subparsers.add_parser('export', help='export a .sqlite contact database')
+	export_parser.add_argument('database', help='.sqlite contact database')
+	export_parser.add_argument('out', help='output .csv, .xlsx or .parquet file')
+
+	return parser.parse_args()
 
 
 if __name__ == '__main__':
+	args = parse_arguments()
+	if args.command == 'batch':
+		sys.exit(batch_main(args))
+	elif args.command == 'export':
+		print(f'Exported {export_sqlite(args.database, args.out)} contacts to {args.out}')
+		sys.exit(0)
+
 	# create session, start log
 	session = Session()
 	session.start_log()
@@ -588,7 +4644,8 @@ if __name__ == '__main__':
 	load_theme = session.load_theme()
 	sg.theme(load_theme)
 
-	# load UI
+	# load UI: printed text goes to the output box through the event loop
+	sys.stdout = session.gui.output
 	session.gui.display_signin_screen()
 	logging.info('Program started')
 
@@ -600,6 +4657,9 @@ if __name__ == '__main__':
 			logging.info('Sign-in window closed')
 			break
 
+		if session.gui.handle_event(event, values):
+			continue
+
 		if values['debug_mode']:
 			session.debug = True
 			session.history.hourly_limit = None
@@ -652,121 +4712,169 @@ if __name__ == '__main__':
 
 				logging.info(f'Signing in with stored login: {username} ({type(username)}): {password} ({type(password)})')
 
-				print('Signing in...')
-				if not session.debug:
-					auth_success = session.sign_in(username, password, values['remember'], values['cookies'])
-				else:
+				if session.debug:
 					logging.info('Authenticated with debug mode enabled')
 					session.username = 'debug user'
 					session.authenticated = True
-					auth_success = True
-
-					session.sheet_type = session.default_sheet_type
-					if session.sheet_type == 'csv':
-						session.sheet_path = 'linkedin_scrape.csv'
-					elif session.sheet_type == 'excel':
-						session.sheet_path = 'linkedin_scrape.xlsx'
-
-					session.gui.window.close()
-					session.gui.display_main_screen()
-					break
-
-				if not auth_success:
-					print('Failed to sign in.\n')
+					session.gui.post('-SIGNED-IN-', True)
 				else:
-					sg.popup('Signed in successfully!', title='Success', keep_on_top=True)
-					session.gui.window.close()
+					# sign in on a worker thread: the window stays responsive meanwhile
+					print('Signing in...')
+					session.gui.window['Sign in'].update(disabled=True)
+					session.gui.run_in_background(
+						'-SIGNED-IN-', session.sign_in, username, password, values['remember'], values['cookies'])
+			else:
+				sg.popup('Please enter your login details!', title='Incorrect login', keep_on_top=True)
 
-					# request sheet/csv location
-					session.gui.display_sheet_screen()
-					while session.sheet_path is None:
-						event, values = session.gui.window.read()
-						if event == 'Use default' or (event == sg.WIN_CLOSED and session.sheet_path is None):
-							session.sheet_type = session.default_sheet_type
-							if session.sheet_type == 'csv':
-								session.sheet_path = 'linkedin_scrape.csv'
-							elif session.sheet_type == 'excel':
-								session.sheet_path = 'linkedin_scrape.xlsx'
-
-							if event == sg.WIN_CLOSED:
-								sg.popup(
-								f'No file path defined. Using default path: {session.sheet_path}', 
-								title='No path defined', keep_on_top=True)
-
-							break
-
-						if values['sheet_path'] != '':
-							if '.csv' in values['sheet_path']:
-								session.sheet_path = values['sheet_path']
-								session.sheet_type = 'csv'
-							elif '.xls' in values['sheet_path']:
-								session.sheet_path = values['sheet_path']
-								session.sheet_type = 'excel'
-
-					try:
-						session.load_sheet_length()
-						session.gui.window.close()
-						session.gui.display_main_screen()
-					except Exception as error:
-						logging.exception(error)
+		elif event == '-SIGNED-IN-':
+			session.gui.window['Sign in'].update(disabled=False)
+			if values[event] is not True:
+				print('Failed to sign in.\n')
+				continue
 
-					break
+			if session.debug:
+				session.sheet_type = session.default_sheet_type
+				if session.sheet_type == 'csv':
+					session.sheet_path = 'linkedin_scrape.csv'
+				elif session.sheet_type == 'excel':
+					session.sheet_path = 'linkedin_scrape.xlsx'
+
+				session.gui.window.close()
 			else:
-				sg.popup('Please enter your login details!', title='Incorrect login', keep_on_top=True)
+				sg.popup('Signed in successfully!', title='Success', keep_on_top=True)
+				session.gui.window.close()
+
+				# request sheet/csv location
+				session.gui.display_sheet_screen()
+				while session.sheet_path is None:
+					event, values = session.gui.window.read()
+					if session.gui.handle_event(event, values):
+						continue
+
+					if event == 'Use default' or (event == sg.WIN_CLOSED and session.sheet_path is None):
+						session.sheet_type = session.default_sheet_type
+						if session.sheet_type == 'csv':
+							session.sheet_path = 'linkedin_scrape.csv'
+						elif session.sheet_type == 'excel':
+							session.sheet_path = 'linkedin_scrape.xlsx'
+
+						if event == sg.WIN_CLOSED:
+							sg.popup(
+							f'No file path defined. Using default path: {session.sheet_path}', 
+							title='No path defined', keep_on_top=True)
+
+						break
+
+					if values['sheet_path'] != '':
+						session.set_sheet_path(values['sheet_path'])
+
+				session.gui.window.close()
+
+			# counting and opening a large sheet takes a while: done on a worker thread
+			if session.gui.load_sheet():
+				session.gui.display_main_screen()
+			else:
+				session.authenticated = False
+
+			break
 
 	# main eventloop
 	try:
-		pipeline = queue.Queue(maxsize=10)
-		threading_event = threading.Event()
-
-		with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+		crawler = None
+		with FetchPipeline(session, session.workers) as pipeline:
 			while True and session.authenticated:
-				event, values = session.gui.window.read()
+				event, values = session.gui.window.read(timeout=1000)
+
+				if session.gui.handle_event(event, values):
+					continue
+
+				if event == sg.TIMEOUT_EVENT:
+					session.gui.update_counters(pipeline)
+					continue
+
+				if event == '-PROGRESS-':
+					# counters only change once a worker has stored the profile
+					session.gui.update_counters(pipeline)
+					continue
+
+				if event == 'Show stats':
+					print(f'{session.metrics.summary()}\n')
+					continue
+
+				if event == 'connections' and crawler is not None:
+					# drop the queued connections: the next crawl picks them up again
+					crawler.stop()
+					print(f"⚠️ Stopped fetching connections: {pipeline.cancel_batch('connections')} queued profiles dropped\n")
+					session.gui.window['connections'].update(disabled=True)
+					continue
+
+				if event == 'connections':
+					if session.debug:
+						print('⚠️ Connections cannot be scraped in debug mode\n')
+						continue
+
+					# a batch in the same pipeline: pasted URLs still go ahead of it
+					print('⏳ Fetching first-degree connections...\n')
+					crawler = ConnectionCrawler(session)
+					session.gui.window['connections'].update('Stop connections')
+					session.gui.run_in_background('-CRAWLED-', session.crawl_connections, crawler, pipeline)
+					continue
+
+				if event == '-CRAWLED-':
+					crawler = None
+					session.gui.window['connections'].update('Store connections', disabled=False)
+					if isinstance(values[event], Exception):
+						print(f'⛔️ Error fetching connections: {values[event]}\n')
+					else:
+						stats = values[event]
+						print(f"✅ Connections done: {stats['stored']} stored, {stats['skipped']} already stored, {stats['failed']} failed\n")
+
+					session.gui.update_counters(pipeline)
+					continue
 
 				if event == sg.WIN_CLOSED:
 					logging.info('Main window closed')
-
-					session.history.store()
 					session.gui.window.close()
 
+					# the crawl would keep the workers busy: leaving the pipeline waits for them
+					if crawler is not None:
+						crawler.stop()
+						pipeline.cancel_batch('connections')
+
+					# profiles still waiting for the call limit go to the dead-letter file
+					session.history.stop_waiting()
+
 					logging.info('Exiting main event loop gracefully')
 					break
 
 				if event == 'Store contact' and (values['profile_url'] != '' or session.debug):
 					if not session.debug:
 						print(f'⏳ Loading {values["profile_url"]}...')
-						values['profile_url'] = values['profile_url'].split('?')[0]
-						if values['profile_url'][-1] == '/':
-							values['profile_url'] = values['profile_url'][0:-1]
-
-						if '/' in values['profile_url']:
-							profile = values['profile_url'].split('/')[-1]
-						else:
-							profile = values['profile_url']
-
+						profile = parse_profile_url(values['profile_url'])
 						logging.info(f'\nParsing profile {profile}')
 					else:
 						profile = None
 						print('⏳ Parsing sample debug profile...')
 
-					validity_status, time_until_next = session.history.check_validity()
-					if validity_status:
-						logging.info(f'Profile {profile} put into pipeline...')
-						pipeline.put(profile)
+					if session.is_duplicate(profile):
+						print(f'⚠️ Duplicate detected ({profile}): already stored\n')
+						session.metrics.increment('duplicates')
+						session.gui.window['profile_url'].update('')
+						continue
 
-						executor.submit(session.linkedin_api_call, pipeline, threading_event)
-						threading_event.set()
+					# past the call limit, the profile waits its turn in the rate limiter
+					logging.info(f'Profile {profile} put into pipeline...')
+					if not pipeline.submit(profile):
+						print(f'⚠️ {profile} is already queued\n')
 
-						# clear input
-						session.gui.window['profile_url'].update('')
-						session.gui.window['parsed'].update(f'{session.parsed} {"contact" if session.parsed == 1 else "contacts"} stored (this session)\t')
-						session.gui.window['total_parsed'].update(f'Contacts in file: {session.total_parsed}\t')
+					# clear input
+					session.gui.window['profile_url'].update('')
+					session.gui.update_counters(pipeline)
 
-					else:
-						sg.popup(f'API call limit reached. Try again in {time_until_next}.', font=('Helvetica', 11), title='Limit reached', keep_on_top=True)
-						logging.info(f'API call limit reached: time until next call {time_until_next}. Limit: {session.history.hourly_limit} calls per hour.')
+		# workers have finished: write out whatever is still buffered
+		session.checkpoint()
 
 	except Exception as error:
 		logging.exception(error)
-		session.history.store()
+		session.checkpoint()
 		session.gui.window.close()
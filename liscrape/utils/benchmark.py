@@ -0,0 +1,831 @@
+'''
+Offline benchmarks for liscrape: no network, and no LinkedIn account needed.
+Run with `python3 benchmark.py <scenario>` from this directory, or
+`python3 benchmark.py --json results.json --baseline previous.json suite`
+to run a quick version of every scenario and fail on regressions.
+'''
+import os, sys, io, csv, time, threading, random, logging, tempfile, argparse, contextlib, platform, tracemalloc, sqlite3
+
+import requests
+import pandas as pd
+import ujson as json
+
+from openpyxl import Workbook, load_workbook
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from liscrape import Session, ExcelSink, CsvSink, SqliteSink, FrameSink, FieldMapper, ProfileIndex, FetchPipeline, SheetEnricher, CircuitBreaker, FetchStatistics, COLUMN_MAP, EXTRA_COLUMNS, csv_shards, count_csv_records, export_sqlite
+
+
+class Results:
+	'''
+	Benchmark results, printed as they come in and kept for the json output.
+	better is 'higher' or 'lower': which way a change is an improvement.
+	'''
+	def __init__(self):
+		self.results = []
+		self.failures = []
+
+
+	def add(self, scenario, metric, value, unit, better, **params):
+		self.results.append({
+			'scenario': scenario, 'metric': metric, 'value': value,
+			'unit': unit, 'better': better, 'params': params
+		})
+
+		described = ', '.join(f'{key}={val}' for key, val in params.items())
+		print(f'  {metric:<22}{value:>14.2f} {unit:<14}{described}')
+
+
+	def check(self, scenario, description, passed):
+		'''
+		Record a correctness check: failed checks make the run exit with an error
+		'''
+		print(f'  {"✅" if passed else "⛔️"} {description}')
+		if not passed:
+			self.failures.append(f'{scenario}: {description}')
+
+
+	@staticmethod
+	def key(result):
+		return (result['scenario'], result['metric'], json.dumps(result['params'], sort_keys=True))
+
+
+	def write(self, json_path):
+		with open(json_path, 'w') as json_file:
+			json.dump({
+				'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+				'python': platform.python_version(),
+				'platform': platform.platform(),
+				'results': self.results,
+				'failures': self.failures
+			}, json_file, indent=1)
+
+
+	def regressions(self, baseline_path, tolerance):
+		'''
+		Results that are worse than the same result in the baseline file by
+		more than tolerance, as a fraction of the baseline value
+		'''
+		with open(baseline_path, 'r') as baseline_file:
+			baseline = {self.key(result): result for result in json.load(baseline_file)['results']}
+
+		regressions = []
+		for result in self.results:
+			previous = baseline.get(self.key(result))
+			if previous is None:
+				continue
+
+			if previous['value'] == 0:
+				# no relative change from zero: any increase of a lower-is-better result counts
+				if result['better'] == 'lower' and result['value'] > 0:
+					regressions.append((result, previous, float('inf')))
+
+				continue
+
+			change = (result['value'] - previous['value']) / previous['value']
+			if (result['better'] == 'higher' and change < -tolerance) or (result['better'] == 'lower' and change > tolerance):
+				regressions.append((result, previous, change))
+
+		return regressions
+
+
+class FakeLinkedin:
+	'''
+	A stand-in for linkedin_api's client. Every request takes `latency`
+	seconds, and a share of them fail the way LinkedIn does under load:
+	dropped connections, and throttled responses with no JSON body. `shape`
+	sets how much is on a profile: minimal, typical or rich.
+	'''
+	shapes = {'minimal': 0, 'typical': 1, 'rich': 4}
+
+	def __init__(self, latency=0.0, error_rate=0.0, shape='typical'):
+		self.latency = latency
+		self.error_rate = error_rate
+		self.size = self.shapes[shape]
+		self.calls = 0
+
+
+	def request(self):
+		self.calls += 1
+		if self.latency > 0:
+			time.sleep(self.latency)
+
+		roll = random.random()
+		if roll < self.error_rate / 2:
+			raise requests.exceptions.ConnectionError('injected: connection dropped')
+		elif roll < self.error_rate:
+			raise ValueError('injected: throttled response with no JSON body')
+
+
+	def response(self, public_id):
+		profile, contact_info = sample_response(int(public_id.split('-')[-1]), random.Random(public_id))
+		if self.size == 0:
+			profile = {key: profile[key] for key in ('firstName', 'lastName', 'profile_id', 'public_id')}
+		else:
+			profile['summary'] *= self.size
+			profile['experience'] *= self.size
+
+		return profile, contact_info
+
+
+	def get_profile(self, public_id):
+		self.request()
+		return self.response(public_id)[0]
+
+
+	def get_profile_contact_info(self, public_id):
+		self.request()
+		return self.response(public_id)[1]
+
+
+	def get_profile_skills(self, public_id):
+		self.request()
+		return [{'name': 'Flipping patties'}, {'name': 'Jellyfishing'}]
+
+
+def sample_row(i):
+	return {
+		'First name': 'SpongeBob', 'Last name': 'SquarePants', 'Linkedin profile ID': f'BENCH-{i}',
+		'Linkedin headline': 'Fry cook', 'Linkedin summary': 'Lives in a pineapple under the sea',
+		'Industry': 'Food & Beverages', 'Location': 'Bikini Bottom', 'Languages': 'English, Squirrel',
+		'Birthday': '', 'Email address': 'squarepants@bikinibottom.com', 'Phone number': '+001 (MOBILE)'
+	}
+
+
+def sample_response(i, rng):
+	'''
+	A synthetic (profile, contact_info) response shaped like linkedin_api's
+	'''
+	profile = {
+		'firstName': f'First{i}', 'lastName': f'Last{i}', 'profile_id': f'BENCH-{i}', 'public_id': f'bench-{i}',
+		'headline': 'Fry cook at the Krusty Krab', 'summary': 'Lives in a pineapple under the sea. ' * rng.randint(0, 5),
+		'industryName': rng.choice(['Food & Beverages', 'Restaurants', 'Hospitality']),
+		'geoCountryName': rng.choice(['Bikini Bottom', 'Rock Bottom', 'New Kelp City']),
+		'languages': [{'name': name} for name in rng.sample(['English', 'Finnish', 'Squirrel', 'Whale'], rng.randint(0, 3))],
+		'experience': [{'title': 'Fry cook', 'companyName': 'Krusty Krab'} for n in range(rng.randint(0, 4))],
+		'education': [{'schoolName': "Mrs. Puff's Boating School", 'degreeName': 'None'}]
+	}
+
+	contact_info = {
+		'email_address': f'first{i}@bikinibottom.com' if rng.random() < 0.5 else None,
+		'birthdate': {'month': 7, 'day': 14} if rng.random() < 0.2 else None,
+		'phone_numbers': [{'number': '+001', 'type': 'MOBILE'}] if rng.random() < 0.3 else []
+	}
+
+	return profile, contact_info
+
+
+def profile_urls(start, end):
+	return io.StringIO('\n'.join(f'https://www.linkedin.com/in/bench-{i}' for i in range(start, end)))
+
+
+@contextlib.contextmanager
+def bench_session(client, sheet_name='bench.csv', workers=2, engine='threads'):
+	'''
+	A headless session in a temporary directory, fetching from client with
+	no rate limits and no response cache
+	'''
+	cwd = os.getcwd()
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		os.chdir(tmp_dir)
+		try:
+			session = Session()
+			session.headless = True
+			session.application = client
+			session.workers = workers
+			session.engine = engine
+			session.concurrency = workers
+			session.cache = None
+			session.history.burst_limit = session.history.hourly_limit = session.history.daily_limit = None
+			session.history.limiters = {}
+			session.retry.base_delay = 0.01
+			session.breaker.cooldown = session.breaker.base_cooldown = 0.1
+
+			session.set_sheet_path(sheet_name)
+			session.load_sheet_length()
+			session.open_sink()
+			yield session
+
+			session.journal.close()
+		finally:
+			os.chdir(cwd)
+
+
+def run_batch(session, urls):
+	with contextlib.redirect_stdout(io.StringIO()):
+		return session.run_batch(urls)
+
+
+def prefill(path, rows):
+	'''
+	An existing sheet of rows contacts, in the format the extension says
+	'''
+	if path.endswith('.xlsx'):
+		book = Workbook(write_only=True)
+		sheet = book.create_sheet('Sheet1')
+		sheet.append(list(COLUMN_MAP.values()))
+		for i in range(rows):
+			sheet.append(list(sample_row(i).values()))
+
+		book.save(path)
+		return
+
+	if path.endswith('.csv'):
+		sink = CsvSink(path, COLUMN_MAP.values(), batch_size=10000)
+	else:
+		sink = SqliteSink(path, COLUMN_MAP.values(), batch_size=10000)
+
+	for i in range(rows):
+		sink.add(sample_row(i))
+
+	sink.close()
+
+
+def bench_end_to_end(args, results):
+	'''
+	Profiles per hour through a whole batch run: fetch, normalise, store.
+	Rate limits are off, so this is the ceiling the quota then caps.
+	'''
+	print(f'end to end: {args.profiles} profiles, {args.latency} s per request, {args.shape} profiles')
+	for engine in args.engines:
+		for workers in args.workers:
+			client = FakeLinkedin(args.latency, args.error_rate, args.shape)
+			with bench_session(client, 'bench.csv', workers, engine) as session:
+				stats = run_batch(session, profile_urls(0, args.profiles))
+
+			results.add(
+				'end-to-end', 'profiles_per_hour', 3600 * stats['stored'] / stats['elapsed'], 'profiles/h', 'higher',
+				engine=engine, workers=workers, latency=args.latency, shape=args.shape, error_rate=args.error_rate)
+
+
+def bench_writer(args, results):
+	'''
+	Per-contact cost of each writer as the existing sheet grows. The xlsx
+	writer's one-off workbook load is part of it, and also reported apart.
+	'''
+	print(f'writers: {args.contacts} contacts appended to sheets of increasing size')
+	writers = {
+		'xlsx': lambda path: ExcelSink(path, COLUMN_MAP.values()),
+		'csv': lambda path: CsvSink(path, COLUMN_MAP.values()),
+		'sqlite': lambda path: SqliteSink(path, COLUMN_MAP.values())
+	}
+
+	for size in args.sizes:
+		for sheet_format in args.formats:
+			with tempfile.TemporaryDirectory() as tmp_dir:
+				path = os.path.join(tmp_dir, f'bench.{sheet_format}')
+				prefill(path, size)
+				sink = writers[sheet_format](path)
+
+				start = time.perf_counter()
+				with contextlib.redirect_stdout(io.StringIO()):
+					if sheet_format == 'xlsx':
+						sink.open()
+						loaded = time.perf_counter() - start
+
+					for i in range(args.contacts):
+						sink.add(sample_row(size + i))
+
+					sink.close()
+
+				elapsed = time.perf_counter() - start
+
+			results.add('writer', 'ms_per_contact', 1000 * elapsed / args.contacts, 'ms/contact', 'lower', format=sheet_format, rows=size)
+			if sheet_format == 'xlsx':
+				results.add('writer', 'load_ms', 1000 * loaded, 'ms', 'lower', format=sheet_format, rows=size)
+
+
+class ReopeningCsvSink:
+	'''
+	The csv writer before CsvSink kept its file open: it checks for the file,
+	opens it and builds a new writer for every row. Kept as a reference point.
+	'''
+	def __init__(self, sheet_path, columns):
+		self.sheet_path = sheet_path
+		self.columns = list(columns)
+
+
+	def add(self, profile_dict):
+		if not os.path.isfile(self.sheet_path):
+			with open(self.sheet_path, 'w', newline='') as csv_file:
+				csv.DictWriter(csv_file, fieldnames=self.columns).writeheader()
+
+		with open(self.sheet_path, 'a', newline='') as csv_file:
+			csv.DictWriter(csv_file, fieldnames=self.columns, extrasaction='ignore').writerow(profile_dict)
+
+
+	def close(self):
+		pass
+
+
+def bench_csv(args, results):
+	'''
+	Rows per second appending to a csv sheet: reopening the file for every
+	row, and the streaming writer with and without shard rotation
+	'''
+	rng = random.Random(0)
+	writers = (
+		('reopening', lambda path: ReopeningCsvSink(path, COLUMN_MAP.values())),
+		('streaming', lambda path: CsvSink(path, COLUMN_MAP.values())),
+		('sharded', lambda path: CsvSink(path, COLUMN_MAP.values(), max_bytes=args.shard_mb * 1e6))
+	)
+
+	print(f'csv: {args.rows} rows appended to a sheet of {args.size}')
+	rows = list(FieldMapper().rows(sample_response(args.size + i, rng) for i in range(args.rows)))
+	for writer, create_sink in writers:
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			path = os.path.join(tmp_dir, 'bench.csv')
+			prefill(path, args.size)
+			sink = create_sink(path)
+
+			start = time.perf_counter()
+			with contextlib.redirect_stdout(io.StringIO()):
+				for row in rows:
+					sink.add(row)
+
+				sink.close()
+
+			elapsed = time.perf_counter() - start
+			shards = csv_shards(path)
+			stored = sum(count_csv_records(shard_path) - 1 for shard_path in shards)
+
+		results.add('csv', 'rows_per_second', args.rows / elapsed, 'rows/s', 'higher', writer=writer, rows=args.rows)
+		results.check('csv', f'{writer}: every row written ({stored} of {args.size + args.rows}, {len(shards)} shards)', stored == args.size + args.rows)
+
+
+def bench_duplicates(args, results):
+	'''
+	Cost of a duplicate check as the history grows, and of seeding the
+	duplicate index from an existing sheet
+	'''
+	print(f'duplicate checks: {args.checks} lookups, half of them hits')
+	for size in args.sizes:
+		index = ProfileIndex(os.devnull)
+		for i in range(size):
+			index.add_public_id(f'bench-{i}', f'BENCH-{i}')
+			index.add_profile_id(f'BENCH-{i}')
+
+		rng = random.Random(0)
+		lookups = [f'bench-{rng.randrange(2 * size)}' for n in range(args.checks)]
+
+		start = time.perf_counter()
+		for public_id in lookups:
+			index.contains_public_id(public_id)
+
+		elapsed = time.perf_counter() - start
+		results.add('duplicates', 'ns_per_check', 1e9 * elapsed / args.checks, 'ns/check', 'lower', history=size)
+
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			path = os.path.join(tmp_dir, 'bench.csv')
+			prefill(path, size)
+
+			index = ProfileIndex(os.path.join(tmp_dir, 'index.json'))
+			start = time.perf_counter()
+			index.seed_from_sheet(path, 'csv')
+			results.add('duplicates', 'seed_ms', 1000 * (time.perf_counter() - start), 'ms', 'lower', history=size)
+
+
+def bench_memory(args, results):
+	'''
+	Memory held by a session as a batch run goes on: it should only grow by
+	the history and duplicate index entries, a few hundred bytes a profile
+	'''
+	print(f'memory: {args.profiles} profiles in {args.steps} steps')
+	tracemalloc.start()
+	with bench_session(FakeLinkedin(shape=args.shape), args.sheet, args.workers) as session:
+		step = args.profiles // args.steps
+		baseline = tracemalloc.get_traced_memory()[0]
+		for n in range(args.steps):
+			run_batch(session, profile_urls(n * step, (n + 1) * step))
+
+		current, peak = tracemalloc.get_traced_memory()
+
+	tracemalloc.stop()
+	results.add('memory', 'bytes_per_profile', (current - baseline) / (args.steps * step), 'B/profile', 'lower', sheet=args.sheet)
+	results.add('memory', 'peak_mb', peak / 1e6, 'MB', 'lower', sheet=args.sheet, profiles=args.profiles)
+
+
+def bench_normalise(args, results):
+	'''
+	Rows per second through the field mapper, with and without the extra columns
+	'''
+	rng = random.Random(0)
+	corpus = [sample_response(i, rng) for i in range(args.profiles)]
+	print(f'normalisation: {args.profiles} synthetic profiles')
+
+	for columns, mapper in (('default', FieldMapper()), ('all', FieldMapper(EXTRA_COLUMNS.keys()))):
+		start = time.perf_counter()
+		for row in mapper.rows(corpus):
+			pass
+
+		elapsed = time.perf_counter() - start
+		results.add('normalise', 'rows_per_second', args.profiles / elapsed, 'rows/s', 'higher', columns=columns)
+
+
+def bench_bulk(args, results):
+	'''
+	Rows per second writing a new sheet: the per-profile writers against the
+	bulk writer, which writes one DataFrame per batch. A csv has no bulk
+	writer: CsvSink streams batches straight to the file.
+	'''
+	rng = random.Random(0)
+	writers = (
+		('csv', 'streaming', lambda path: CsvSink(path, COLUMN_MAP.values())),
+		('xlsx', 'per-profile', lambda path: ExcelSink(path, COLUMN_MAP.values())),
+		('xlsx', 'bulk', lambda path: FrameSink(path, 'excel', COLUMN_MAP.values())),
+		('parquet', 'bulk', lambda path: FrameSink(path, 'parquet', COLUMN_MAP.values()))
+	)
+
+	print('bulk export: rows written to a new sheet')
+	for size in args.sizes:
+		rows = list(FieldMapper().rows(sample_response(i, rng) for i in range(size)))
+		for sheet_format, writer, create_sink in writers:
+			if sheet_format == 'xlsx' and size > args.excel_limit:
+				continue
+
+			with tempfile.TemporaryDirectory() as tmp_dir:
+				sink = create_sink(os.path.join(tmp_dir, f'bench.{sheet_format}'))
+
+				start = time.perf_counter()
+				with contextlib.redirect_stdout(io.StringIO()):
+					for row in rows:
+						sink.add(row)
+
+					sink.close()
+
+				elapsed = time.perf_counter() - start
+
+			results.add('bulk', 'rows_per_second', size / elapsed, 'rows/s', 'higher', format=sheet_format, writer=writer, rows=size)
+
+
+def bench_export(args, results):
+	'''
+	Rows per second exporting a SQLite contact database, and a check that
+	every row reaches the exported sheet
+	'''
+	print(f'export: a database of {args.size} contacts')
+	for export_format in args.formats:
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			database_path = os.path.join(tmp_dir, 'bench.sqlite')
+			export_path = os.path.join(tmp_dir, f'export.{export_format}')
+			prefill(database_path, args.size)
+
+			start = time.perf_counter()
+			exported = export_sqlite(database_path, export_path)
+			elapsed = time.perf_counter() - start
+
+			if export_format == 'csv':
+				stored = count_csv_records(export_path) - 1
+			elif export_format == 'xlsx':
+				book = load_workbook(export_path, read_only=True)
+				stored = sum(1 for row in book.worksheets[0].iter_rows(values_only=True)) - 1
+				book.close()
+			else:
+				stored = len(pd.read_parquet(export_path))
+
+		results.add('export', 'rows_per_second', args.size / elapsed, 'rows/s', 'higher', format=export_format, rows=args.size)
+		results.check('export', f'{export_format}: every row exported ({stored} of {args.size})', exported == stored == args.size)
+
+
+def bench_faults(args, results):
+	'''
+	A batch run against a client that fails a share of requests: how many
+	profiles the retries recover, and how many end up in the dead-letter file.
+	Six retries make a profile fail at a 20% error rate once in 80,000 runs,
+	so every one of them should be stored.
+	'''
+	print(f'fault injection: {args.profiles} profiles, {args.workers} workers')
+	for error_rate in args.error_rates:
+		client = FakeLinkedin(args.latency, error_rate)
+		with bench_session(client, 'bench.csv', args.workers) as session:
+			session.retry.attempts = 6
+			stats = run_batch(session, profile_urls(0, args.profiles))
+
+			dead_letters = 0
+			if os.path.isfile(session.dead_letter.dead_letter_path):
+				with open(session.dead_letter.dead_letter_path, 'r') as dead_letter_file:
+					dead_letters = sum(1 for line in dead_letter_file if not line.startswith('#'))
+
+		results.add('faults', 'stored_share', stats['stored'] / args.profiles, 'of profiles', 'higher', error_rate=error_rate)
+		results.add('faults', 'dead_letters', dead_letters, 'profiles', 'lower', error_rate=error_rate)
+		results.add('faults', 'calls_per_profile', client.calls / args.profiles, 'calls', 'lower', error_rate=error_rate)
+		if error_rate <= 0.2:
+			results.check('faults', f'{error_rate:.0%} errors: every profile stored ({stats["stored"]} of {args.profiles})', stats['stored'] == args.profiles)
+
+	check_dead_letters(args, results)
+	check_breaker(results)
+
+
+def check_dead_letters(args, results):
+	'''
+	Profiles that fail every retry are dead-lettered, and --retry-failed
+	reads them back and stores them once the client recovers
+	'''
+	client = FakeLinkedin(error_rate=1.0)
+	with bench_session(client, 'bench.csv', args.workers) as session:
+		# a failing client opens the breaker: keep its pauses short
+		session.breaker.max_cooldown = 0.2
+		urls = profile_urls(0, 10)
+		expected = list(session.batch_profiles(urls, FetchStatistics()))
+		urls.seek(0)
+		stats = run_batch(session, urls)
+
+		retry_path = session.dead_letter.take()
+		with open(retry_path, 'r') as retry_file:
+			dead_lettered = list(session.batch_profiles(retry_file, FetchStatistics()))
+
+		results.check('faults', f'failed profiles dead-lettered ({stats["failed"]} of {len(expected)})', stats['failed'] == len(expected))
+		results.check('faults', f'dead-lettered profiles parse back ({len(dead_lettered)} of {len(expected)})', sorted(dead_lettered) == sorted(expected))
+
+		client.error_rate = 0.0
+		with open(retry_path, 'r') as retry_file:
+			stats = run_batch(session, retry_file)
+
+		results.check('faults', f'retried profiles stored ({stats["stored"]} of {len(expected)})', stats['stored'] == len(expected))
+
+
+def check_breaker(results):
+	'''
+	The circuit breaker opens after threshold failures, lets requests through
+	after its cooldown, and doubles the cooldown if they fail again. A
+	sign-in challenge opens it straight away.
+	'''
+	breaker = CircuitBreaker(threshold=3, cooldown=0.05)
+	with contextlib.redirect_stdout(io.StringIO()):
+		for i in range(2):
+			breaker.record_failure()
+
+		closed_before = breaker.remaining() == 0
+		breaker.record_failure()
+		opened = breaker.remaining() > 0
+		breaker.wait()
+		cooled_down = breaker.remaining() == 0
+		breaker.record_failure()
+		doubled = breaker.remaining() > 0.05
+		breaker.wait()
+		breaker.record_success()
+		breaker.record_failure()
+		reset = breaker.remaining() == 0
+
+	results.check('faults', 'breaker stays closed below the threshold', closed_before)
+	results.check('faults', 'breaker opens at the threshold', opened)
+	results.check('faults', 'breaker lets requests through after the cooldown', cooled_down)
+	results.check('faults', 'breaker reopens with a doubled cooldown', doubled)
+	results.check('faults', 'a success resets the breaker', reset)
+
+	with bench_session(FakeLinkedin()) as session:
+		with contextlib.redirect_stdout(io.StringIO()):
+			delay = session.handle_fetch_error('bench-0', Exception('CHALLENGE'), None, 0)
+
+		results.check('faults', 'a sign-in challenge opens the breaker', session.breaker.remaining() > 0)
+		results.check('faults', 'a challenged profile is retried', delay is not None)
+
+
+def sheet_profile_ids(path):
+	'''
+	The profile ID of every row in a sheet, in the format the extension says
+	'''
+	column = COLUMN_MAP['profile_id']
+	if path.endswith('.csv'):
+		return list(pd.read_csv(path, dtype=str)[column])
+	elif path.endswith('.xlsx'):
+		return list(pd.read_excel(path, dtype=str)[column])
+
+	with sqlite3.connect(path) as connection:
+		return [row[0] for row in connection.execute(f'SELECT "{column}" FROM contacts')]
+
+
+def bench_stress(args, results):
+	'''
+	Many fetch workers storing into one sheet, with some URLs pasted twice:
+	every profile must end up in the sheet exactly once, and the counters
+	and history must agree with the sheet
+	'''
+	print(f'stress: {args.profiles} profiles, {args.workers} workers')
+	for sheet_format in args.formats:
+		# every fifth URL comes twice, so duplicates race each other to the sheet
+		urls = [f'https://www.linkedin.com/in/bench-{i}' for i in range(args.profiles)]
+		urls += urls[::5]
+		random.Random(0).shuffle(urls)
+
+		client = FakeLinkedin(args.latency)
+		with bench_session(client, f'bench.{sheet_format}', args.workers) as session:
+			# limits too high to wait on, so the history keeps every call
+			session.history.burst_limit = session.history.hourly_limit = session.history.daily_limit = 10 ** 9
+
+			start = time.perf_counter()
+			stats = run_batch(session, io.StringIO('\n'.join(urls)))
+			elapsed = time.perf_counter() - start
+
+			profile_ids = sheet_profile_ids(session.sheet_path)
+			history = len(session.history.history)
+			total_parsed = session.total_parsed
+
+		unique = len(set(profile_ids))
+		results.add('stress', 'rows_per_second', len(profile_ids) / elapsed, 'rows/s', 'higher', format=sheet_format, workers=args.workers)
+		results.check('stress', f'{sheet_format}: no rows lost ({unique} of {args.profiles})', unique == args.profiles)
+		results.check('stress', f'{sheet_format}: no rows duplicated ({len(profile_ids) - unique})', len(profile_ids) == unique)
+		results.check('stress', f'{sheet_format}: stored count matches the sheet ({stats["stored"]}, {total_parsed})', stats['stored'] == total_parsed == len(profile_ids))
+		results.check('stress', f'{sheet_format}: one history entry per API call ({history} of {client.calls // 2})', history == client.calls // 2)
+
+
+def bench_priority(args, results):
+	'''
+	How long a profile submitted interactively waits while a large batch is
+	queued: it should only wait for the fetches already in flight. The batch
+	is submitted from its own thread, as it waits whenever the queue is full.
+	'''
+	print(f'priority: one profile submitted behind {args.profiles} batch ones, {args.latency} s per request')
+	with bench_session(FakeLinkedin(args.latency), 'bench.csv', args.workers) as session:
+		with contextlib.redirect_stdout(io.StringIO()):
+			with FetchPipeline(session, session.workers, memory_cap=args.memory_cap) as pipeline:
+				pipeline.add_batch('batch')
+				submitter = threading.Thread(target=lambda: [pipeline.submit(f'bench-{i}', 'batch') for i in range(args.profiles)])
+				submitter.start()
+
+				while pipeline.pending() < args.memory_cap:
+					time.sleep(0.001)
+
+				time.sleep(10 * args.latency)
+				queued = pipeline.pending()
+				start = time.perf_counter()
+				pipeline.submit(f'bench-{args.profiles}')
+				while not session.index.contains_profile_id(f'BENCH-{args.profiles}'):
+					time.sleep(0.001)
+
+				waited = time.perf_counter() - start
+				fetched = pipeline.stats.counts['stored']
+				pipeline.cancel_batch('batch')
+				submitter.join()
+
+	results.add('priority', 'interactive_wait_ms', 1000 * waited, 'ms', 'lower', queued=args.profiles, workers=args.workers)
+	results.check('priority', f'interactive profile served before the batch ({fetched} of {args.profiles} batch profiles fetched first)', fetched < args.profiles / 2)
+	results.check('priority', f'batch queue held to the memory cap ({queued} of {args.memory_cap} queued)', queued <= args.memory_cap)
+
+
+def bench_columns(args, results):
+	'''
+	API calls per profile for each column selection: profile-only columns
+	should skip the contact info request
+	'''
+	print(f'columns: {args.profiles} profiles with all, profile-only and deferred contact columns')
+	urls = [f'https://www.linkedin.com/in/bench-{i}' for i in range(args.profiles)]
+	selections = {
+		'all': FieldMapper(),
+		'profile-only': FieldMapper(only=['firstName', 'lastName', 'headline', 'industryName']),
+		'deferred': FieldMapper()
+	}
+
+	for selection, mapper in selections.items():
+		client = FakeLinkedin(args.latency)
+		with bench_session(client, 'bench.csv', args.workers) as session:
+			session.mapper = mapper
+			session.open_sink()
+			session.defer_contact_info = selection == 'deferred'
+			stats = run_batch(session, urls)
+
+			# both passes count: deferring moves the contact info requests, it doesn't drop them
+			if selection == 'deferred':
+				session.defer_contact_info, session.contact_only = False, True
+				with contextlib.redirect_stdout(io.StringIO()):
+					session.enrich_sheet(SheetEnricher(session.sheet_path, session.sheet_type, profile_ids=session.deferred))
+
+				emails = pd.read_csv(session.sheet_path, dtype=str, keep_default_na=False)[COLUMN_MAP['email_address']]
+				results.check('columns', f'deferred: contact info added in the second pass ({(emails != "").sum()} emails)', (emails != '').sum() > 0)
+
+			calls = client.calls
+
+		results.add('columns', 'calls_per_profile', calls / stats['stored'], 'calls', 'lower', columns=selection)
+		if selection == 'profile-only':
+			results.check('columns', f'profile-only: one call per profile ({calls} for {stats["stored"]})', calls == stats['stored'])
+
+
+def bench_suite(args, results):
+	'''
+	A quick run of every scenario, small enough to run on every change
+	'''
+	scenarios = (
+		(bench_end_to_end, dict(profiles=200, latency=0.005, error_rate=0.0, shape='typical', engines=['threads', 'async'], workers=[8])),
+		(bench_writer, dict(sizes=[1000, 10000], contacts=200, formats=['xlsx', 'csv', 'sqlite'])),
+		(bench_duplicates, dict(sizes=[1000, 100000], checks=100000)),
+		(bench_memory, dict(profiles=2000, steps=4, shape='typical', sheet='bench.csv', workers=4)),
+		(bench_normalise, dict(profiles=20000)),
+		(bench_bulk, dict(sizes=[1000], excel_limit=1000)),
+		(bench_export, dict(size=2000, formats=['csv', 'xlsx', 'parquet'])),
+		(bench_faults, dict(profiles=200, workers=8, latency=0.0, error_rates=[0.2])),
+		(bench_stress, dict(profiles=500, workers=32, latency=0.002, formats=['xlsx', 'csv', 'sqlite'])),
+		(bench_priority, dict(profiles=5000, workers=4, latency=0.005, memory_cap=1000)),
+		(bench_columns, dict(profiles=200, workers=4, latency=0.0)),
+		(bench_csv, dict(size=10000, rows=10000, shard_mb=2))
+	)
+
+	for scenario, params in scenarios:
+		scenario(argparse.Namespace(**params), results)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Run liscrape benchmarks')
+	parser.add_argument('--json', metavar='PATH', help='write the results to a json file')
+	parser.add_argument('--baseline', metavar='PATH', help='exit with an error if results are worse than in this json file')
+	parser.add_argument('--tolerance', type=float, default=0.25, help='allowed change from the baseline, as a fraction')
+	subparsers = parser.add_subparsers(dest='scenario', required=True)
+
+	suite_parser = subparsers.add_parser('suite', help='a quick run of every scenario')
+	suite_parser.set_defaults(run=bench_suite)
+
+	end_to_end_parser = subparsers.add_parser('end-to-end', help='profiles/hour through a whole batch run')
+	end_to_end_parser.add_argument('--profiles', type=int, default=1000)
+	end_to_end_parser.add_argument('--latency', type=float, default=0.2, help='seconds per request')
+	end_to_end_parser.add_argument('--error-rate', type=float, default=0.0)
+	end_to_end_parser.add_argument('--shape', choices=FakeLinkedin.shapes.keys(), default='typical')
+	end_to_end_parser.add_argument('--engines', nargs='+', choices=('threads', 'async'), default=['threads', 'async'])
+	end_to_end_parser.add_argument('--workers', type=int, nargs='+', default=[2, 8, 32])
+	end_to_end_parser.set_defaults(run=bench_end_to_end)
+
+	writer_parser = subparsers.add_parser('writer', help='writer cost vs sheet size')
+	writer_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000])
+	writer_parser.add_argument('--contacts', type=int, default=1000)
+	writer_parser.add_argument('--formats', nargs='+', choices=('xlsx', 'csv', 'sqlite'), default=['xlsx', 'csv', 'sqlite'])
+	writer_parser.set_defaults(run=bench_writer)
+
+	duplicates_parser = subparsers.add_parser('duplicates', help='duplicate check cost vs history size')
+	duplicates_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000])
+	duplicates_parser.add_argument('--checks', type=int, default=1000000)
+	duplicates_parser.set_defaults(run=bench_duplicates)
+
+	memory_parser = subparsers.add_parser('memory', help='memory growth over a batch run')
+	memory_parser.add_argument('--profiles', type=int, default=20000)
+	memory_parser.add_argument('--steps', type=int, default=10)
+	memory_parser.add_argument('--shape', choices=FakeLinkedin.shapes.keys(), default='typical')
+	memory_parser.add_argument('--sheet', default='bench.csv', help='output sheet, which sets the writer')
+	memory_parser.add_argument('--workers', type=int, default=4)
+	memory_parser.set_defaults(run=bench_memory)
+
+	normalise_parser = subparsers.add_parser('normalise', help='field mapping throughput')
+	normalise_parser.add_argument('--profiles', type=int, default=100000)
+	normalise_parser.set_defaults(run=bench_normalise)
+
+	bulk_parser = subparsers.add_parser('bulk', help='per-profile vs bulk writers')
+	bulk_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+	bulk_parser.add_argument('--excel-limit', type=int, default=10000, help='skip xlsx runs larger than this')
+	bulk_parser.set_defaults(run=bench_bulk)
+
+	export_parser = subparsers.add_parser('export', help='export a SQLite database to csv, xlsx or parquet')
+	export_parser.add_argument('--size', type=int, default=100000, help='contacts in the database')
+	export_parser.add_argument('--formats', nargs='+', choices=('csv', 'xlsx', 'parquet'), default=['csv', 'xlsx', 'parquet'])
+	export_parser.set_defaults(run=bench_export)
+
+	faults_parser = subparsers.add_parser('faults', help='retries and dead letters against a failing client')
+	faults_parser.add_argument('--profiles', type=int, default=500)
+	faults_parser.add_argument('--workers', type=int, default=8)
+	faults_parser.add_argument('--latency', type=float, default=0.001, help='seconds per request')
+	faults_parser.add_argument('--error-rates', type=float, nargs='+', default=[0, 0.05, 0.2, 0.5])
+	faults_parser.set_defaults(run=bench_faults)
+
+	stress_parser = subparsers.add_parser('stress', help='many workers, one sheet: check no rows are lost or duplicated')
+	stress_parser.add_argument('--profiles', type=int, default=2000)
+	stress_parser.add_argument('--workers', type=int, default=32)
+	stress_parser.add_argument('--latency', type=float, default=0.005, help='seconds per request')
+	stress_parser.add_argument('--formats', nargs='+', choices=('xlsx', 'csv', 'sqlite'), default=['xlsx', 'csv', 'sqlite'])
+	stress_parser.set_defaults(run=bench_stress)
+
+	priority_parser = subparsers.add_parser('priority', help='wait for an interactive profile behind a large batch')
+	priority_parser.add_argument('--profiles', type=int, default=50000)
+	priority_parser.add_argument('--workers', type=int, default=4)
+	priority_parser.add_argument('--latency', type=float, default=0.05, help='seconds per request')
+	priority_parser.add_argument('--memory-cap', type=int, default=10000, help='queued profiles kept in memory')
+	priority_parser.set_defaults(run=bench_priority)
+
+	columns_parser = subparsers.add_parser('columns', help='API calls per profile for each column selection')
+	columns_parser.add_argument('--profiles', type=int, default=1000)
+	columns_parser.add_argument('--workers', type=int, default=4)
+	columns_parser.add_argument('--latency', type=float, default=0.0, help='seconds per request')
+	columns_parser.set_defaults(run=bench_columns)
+
+	csv_parser = subparsers.add_parser('csv', help='csv writers: reopening per row, streaming and sharded')
+	csv_parser.add_argument('--size', type=int, default=100000, help='rows already in the sheet')
+	csv_parser.add_argument('--rows', type=int, default=50000, help='rows to append')
+	csv_parser.add_argument('--shard-mb', type=float, default=16, help='shard size for the sharded writer, in MB')
+	csv_parser.set_defaults(run=bench_csv)
+
+	args = parser.parse_args()
+
+	# the session logs every retry and error: keep the output readable
+	logging.disable(logging.CRITICAL)
+
+	results = Results()
+	args.run(args, results)
+
+	if args.json is not None:
+		results.write(args.json)
+
+	regressions = []
+	if args.baseline is not None:
+		regressions = results.regressions(args.baseline, args.tolerance)
+		for result, previous, change in regressions:
+			print(f'⛔️ {result["scenario"]} {result["metric"]} {result["params"]}: {previous["value"]:.2f} -> {result["value"]:.2f} ({change:+.0%})')
+
+	for failure in results.failures:
+		print(f'⛔️ {failure}')
+
+	sys.exit(1 if len(regressions) > 0 or len(results.failures) > 0 else 0)